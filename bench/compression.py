@@ -0,0 +1,99 @@
+"""
+Compression of records made of tests/wiki_sample documents: zlib (level 2),
+lz4, zstd and zstd with a dictionary trained on part of the records.
+
+    python bench/compression.py [--dict-size 16384] [--train 0.2]
+"""
+from __future__ import print_function
+
+import argparse
+import sys
+import time
+from os.path import abspath, dirname, join
+
+from zodbpickle import pickle
+
+from zerodb.models import Model, fields
+from zerodb.transform.compress_lz4 import lz4_compressor
+from zerodb.transform.compress_zlib import zlib_compressor
+from zerodb.transform.compress_zstd import ZstdCompressor
+
+here = dirname(abspath(__file__))
+sys.path.append(join(here, "..", "tests"))
+import wiki  # noqa
+
+
+class WikiPage(Model):
+    id = fields.Field()
+    title = fields.Field()
+    text = fields.Text()
+
+
+def make_records(paragraphs=True):
+    """
+    Pickles which look like ZODB records: class, then state.
+    Wiki articles are split in paragraphs to get many small records,
+    which are typical for us
+    """
+    records = []
+    for doc in wiki.read_docs(join(here, "..", "tests", "wiki_sample")):
+        texts = doc["text"].split("\n\n") if paragraphs else [doc["text"]]
+        for i, text in enumerate(texts):
+            state = {"id": doc["id"], "title": doc["title"], "text": text}
+            records.append(pickle.dumps(WikiPage, 3) + pickle.dumps(state, 3))
+    return records
+
+
+def measure(compressor, records, repeat=3):
+    best_c = best_d = None
+    for i in range(repeat):
+        t0 = time.time()
+        compressed = [compressor.compress(r) for r in records]
+        t1 = time.time()
+        for c in compressed:
+            compressor.decompress(c)
+        t2 = time.time()
+        best_c = t1 - t0 if best_c is None else min(best_c, t1 - t0)
+        best_d = t2 - t1 if best_d is None else min(best_d, t2 - t1)
+    size = sum(len(c) for c in compressed)
+    return size, best_c, best_d
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dict-size", type=int, default=16384)
+    parser.add_argument("--train", type=float, default=0.2,
+                        help="Fraction of records to train dictionary on")
+    parser.add_argument("--whole-docs", action="store_true",
+                        help="One record per document, not per paragraph")
+    args = parser.parse_args()
+
+    records = make_records(paragraphs=not args.whole_docs)
+    ntrain = int(len(records) * args.train)
+    train, test = records[:ntrain], records[ntrain:]
+    raw = sum(len(r) for r in test)
+    mb = raw / 2.0 ** 20
+
+    zstd = ZstdCompressor()
+    zstd_dict = ZstdCompressor()
+    zstd_dict.add_dictionary(
+        "%s.%s" % (WikiPage.__module__, WikiPage.__name__),
+        zstd_dict.train(train, size=args.dict_size))
+
+    compressors = [("zlib-2", zlib_compressor), ("lz4", lz4_compressor),
+                   ("zstd", zstd), ("zstd+dict", zstd_dict)]
+
+    print("%d records, %.1f MB, %d bytes average" % (
+        len(test), mb, raw // max(len(test), 1)))
+    print("%-10s %7s %12s %14s" % (
+        "", "ratio", "compress MB/s", "decompress MB/s"))
+    for name, compressor in compressors:
+        if compressor is None:
+            print("%-10s not installed" % name)
+            continue
+        size, tc, td = measure(compressor, test)
+        print("%-10s %7.3f %12.1f %14.1f" % (name, float(size) / raw, mb / tc, mb / td))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Cost of broadcasting a commit's invalidations depending on the number of
+connected users (each with two sessions).
+
+"commit" is the latency of transaction.commit() of a client while the
+other users' sessions are connected to the same server (and subscribed to
+its invalidations). It should stay flat as the number of users grows.
+
+"grouped" and "scan" are server-side only: the whole
+StorageServer.invalidate (with the invalidation queue and owner cache
+updates) with sessions grouped by user vs the old loop over all sessions of
+the storage.
+
+    python bench/invalidation.py [--commits 200] [--users 0,10,100,250]
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import transaction
+import ZEO.ClientStorage
+import ZEO.tests.testssl
+from ZODB.MappingStorage import MappingStorage
+from ZODB.utils import p64
+
+import zerodb
+import zerodb.db
+from zerodb.crypto import kdf
+from zerodb.permissions.base import get_admin
+from zerodb.permissions.subdb import StorageServer
+from zerodb.testing import TEST_PASSPHRASE
+
+sessions_per_user = 2
+
+
+class Connection(object):
+    def call_soon_threadsafe(self, *args):
+        pass
+
+    def __getattr__(self, name):
+        # connection.async
+        return None
+
+
+class Session(object):
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.connection = Connection()
+
+
+def scan_invalidate(server, conn, storage_id, tid, invalidated):
+    # What StorageServer.invalidate used to do
+    for zs in server.zeo_storages_by_storage_id[storage_id]:
+        if conn and zs.user_id == conn.user_id:
+            connection = zs.connection
+            if invalidated and zs is not conn:
+                connection.call_soon_threadsafe(
+                    'invalidateTransaction', tid, invalidated)
+
+
+def measure(invalidate, server, sessions, commits):
+    oids = [p64(i) for i in range(10)]
+    t0 = time.time()
+    for i in range(commits):
+        invalidate(server, sessions[i % len(sessions)], '1', p64(i), oids)
+    return (time.time() - t0) / commits
+
+
+def plain(username, password, key_file, cert_file, appname, key):
+    # Credentials as they are: scrypt for every user would take longer
+    # than the benchmark itself
+    return password, key
+
+
+def add_users(addr, start, stop):
+    """
+    Users start..stop-1 in the database and sessions connected as them
+    """
+    admin_db = ZEO.DB(addr, ssl=ZEO.tests.testssl.client_ssl(),
+                      wait_timeout=30)
+    with admin_db.transaction() as conn:
+        admin = get_admin(conn)
+        for i in range(start, stop):
+            admin.add_user("user%s" % i, password="password%s" % i,
+                           security=plain)
+    admin_db.close()
+
+    sessions = []
+    for i in range(start, stop):
+        for _ in range(sessions_per_user):
+            sessions.append(ZEO.ClientStorage.ClientStorage(
+                addr,
+                ssl=zerodb.db.make_ssl(
+                    server_cert=ZEO.tests.testssl.server_cert),
+                credentials=dict(name="user%s" % i,
+                                 password="password%s" % i),
+                wait_timeout=30))
+    return sessions
+
+
+def commit_latency(db, commits):
+    """
+    Median and 90th percentile of commit times
+    """
+    root = db._root
+    times = []
+    for i in range(commits):
+        root["counter"] = i
+        t0 = time.time()
+        transaction.commit()
+        times.append(time.time() - t0)
+    times.sort()
+    return times[len(times) // 2], times[len(times) * 9 // 10]
+
+
+def client_bench(users, commits):
+    print("%8s %14s %14s" % ("users", "commit p50 ms", "commit p90 ms"))
+    tempdir = tempfile.mkdtemp()
+    addr, stop = zerodb.server(
+        path=os.path.join(tempdir, "db.fs"),
+        init=dict(password=TEST_PASSPHRASE,
+                  cert=ZEO.tests.testssl.client_cert))
+    sessions = []
+    db = None
+    try:
+        db = zerodb.DB(addr, username="root", password=TEST_PASSPHRASE,
+                       security=kdf.key_from_password,
+                       server_cert=ZEO.tests.testssl.server_cert,
+                       wait_timeout=30)
+        connected = 0
+        for n in users:
+            sessions.extend(add_users(addr, connected, n))
+            connected = n
+            p50, p90 = commit_latency(db, commits)
+            print("%8d %14.2f %14.2f" % (n, p50 * 1e3, p90 * 1e3))
+    finally:
+        if db is not None:
+            db.disconnect()
+        for session in sessions:
+            session.close()
+        stop()
+        shutil.rmtree(tempdir)
+
+
+def server_bench(commits):
+    print("%8s %12s %12s" % ("users", "grouped us", "scan us"))
+    for users in (10, 100, 1000, 10000):
+        server = StorageServer(None, {'1': MappingStorage()})
+        sessions = []
+        for i in range(users * sessions_per_user):
+            zs = Session(p64(i // sessions_per_user + 1))
+            server.register_connection('1', zs)
+            server.register_user('1', zs)
+            sessions.append(zs)
+
+        grouped = measure(StorageServer.invalidate, server, sessions,
+                          commits)
+        scan = measure(scan_invalidate, server, sessions, commits)
+        print("%8d %12.1f %12.1f" % (users, grouped * 1e6, scan * 1e6))
+        server.storages['1'].close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--commits", type=int, default=200)
+    parser.add_argument("--users", default="0,10,100,250",
+                        help="Numbers of connected users to measure with")
+    args = parser.parse_args()
+
+    client_bench([int(n) for n in args.users.split(",")], args.commits)
+    print()
+    server_bench(args.commits * 5)
+
+
+if __name__ == "__main__":
+    main()
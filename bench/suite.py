@@ -0,0 +1,229 @@
+"""
+Benchmarks against a local zerodb.server() on tests/wiki_sample documents:
+bulk indexing with Text (Lucene) and TextOkapi, one- and multi-word search,
+field range queries, sorted paging and commit latency.
+
+For every case we report wall time, round trips, records loaded and bytes
+of (encrypted) records read. Client caches are emptied before every run
+unless --warm is given. Results can be saved as a JSON baseline and
+compared with later:
+
+    python bench/suite.py --save baseline.json
+    python bench/suite.py --compare baseline.json [--tolerance 0.2]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from os.path import abspath, dirname, join
+
+import transaction
+import ZEO.tests.testssl
+
+import zerodb
+from zerodb.catalog.query import Contains, Gt, InRange
+from zerodb.crypto import kdf
+from zerodb.models import Model, fields
+from zerodb.testing import TEST_PASSPHRASE
+
+here = dirname(abspath(__file__))
+sys.path.append(join(here, "..", "tests"))
+import wiki  # noqa
+
+words = ["history", "city", "music", "university", "war"]
+phrases = ["city council", "world war", "music history", "new university"]
+
+# Metrics which are compared with a baseline (bigger is worse)
+compared = ("seconds", "round_trips", "kb")
+
+
+class WikiText(Model):
+    id = fields.Field()
+    title = fields.Field()
+    text = fields.Text()
+
+
+class WikiOkapi(Model):
+    id = fields.Field()
+    title = fields.Field()
+    text = fields.TextOkapi()
+
+
+def read_docs(limit):
+    docs = []
+    for doc in wiki.read_docs(join(here, "..", "tests", "wiki_sample")):
+        docs.append({"id": int(doc["id"]), "title": doc["title"],
+                     "text": doc["text"]})
+        if len(docs) >= limit:
+            break
+    return docs
+
+
+class Bench(object):
+    def __init__(self, db, warm=False, repeat=3):
+        self.db = db
+        self.warm = warm
+        self.repeat = repeat
+        self.results = {}
+
+    def clear_caches(self):
+        self.db._connection.cacheMinimize()
+        self.db._storage.base._cache.clear()
+
+    def run(self, name, f, ops=1, repeat=None):
+        """
+        Best of repeat runs of f, per operation (f does ops of them)
+        """
+        best = None
+        for i in range(repeat or self.repeat):
+            if not self.warm:
+                self.clear_caches()
+            with self.db.explain(name) as profile:
+                t0 = time.time()
+                f()
+                dt = time.time() - t0
+            result = {
+                "seconds": dt / ops,
+                "round_trips": float(profile.total("round_trips")) / ops,
+                "loads": float(profile.total("loads")) / ops,
+                "kb": profile.total("encrypted_bytes") / 1024.0 / ops}
+            if best is None or result["seconds"] < best["seconds"]:
+                best = result
+        self.results[name] = best
+        print("%-20s %10.2f ms %8.1f rt %8.1f loads %10.1f kb" % (
+            name, best["seconds"] * 1000, best["round_trips"], best["loads"],
+            best["kb"]))
+        return best
+
+
+def run_all(db, docs, bench):
+    for model in (WikiText, WikiOkapi):
+        def index(model=model):
+            with transaction.manager:
+                db.add([model(**doc) for doc in docs])
+
+        bench.run("index_%s" % model.__name__, index, ops=len(docs), repeat=1)
+
+    for model in (WikiText, WikiOkapi):
+        name = model.__name__
+
+        def search_one(model=model):
+            for word in words:
+                db[model].query(Contains("text", word), limit=10)
+
+        def search_many(model=model):
+            for phrase in phrases:
+                db[model].query(Contains("text", phrase), limit=10)
+
+        bench.run("search_one_%s" % name, search_one, ops=len(words))
+        bench.run("search_many_%s" % name, search_many, ops=len(phrases))
+
+    ids = sorted(doc["id"] for doc in docs)
+    low, high = ids[len(ids) // 4], ids[len(ids) // 2]
+
+    bench.run("range_limit", lambda: db[WikiText].query(
+        InRange("id", low, high), sort_index="id", limit=20))
+    bench.run("range_count", lambda: db[WikiText].aggregate(
+        "count", queryobj=InRange("id", low, high)))
+
+    def paging(pages=5):
+        cursor = None
+        for i in range(pages):
+            page, cursor = db[WikiText].query_page(
+                Gt("id", 0), limit=20, sort_index="id", cursor=cursor)
+
+    def skip_paging(pages=5):
+        for i in range(pages):
+            db[WikiText].query(Gt("id", 0), sort_index="id",
+                               skip=i * 20, limit=20)
+
+    bench.run("paging_cursor", paging, ops=5)
+    bench.run("paging_skip", skip_paging, ops=5)
+
+    added = []
+
+    def commit(n=10):
+        for doc in docs[:n]:
+            with transaction.manager:
+                added.append(db.add(WikiText(**doc)))
+
+    bench.run("commit", commit, ops=10, repeat=1)
+    with transaction.manager:
+        db[WikiText].remove(added)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print changes against baseline, return names of regressed cases
+    """
+    regressions = []
+    print()
+    print("%-20s %10s %10s %10s" % ("vs baseline", "time", "rt", "kb"))
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        ratios = []
+        for metric in compared:
+            if base[metric]:
+                ratio = result[metric] / base[metric]
+            else:
+                ratio = 1.0 if not result[metric] else float("inf")
+            ratios.append(ratio)
+            if ratio > 1 + tolerance:
+                regressions.append("%s %s" % (name, metric))
+        print("%-20s %9.2fx %9.2fx %9.2fx" % ((name,) + tuple(ratios)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--docs", type=int, default=845,
+                        help="Number of wiki documents to index")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--warm", action="store_true",
+                        help="Don't empty client caches before runs")
+    parser.add_argument("--save", help="Save results to this JSON file")
+    parser.add_argument("--compare", help="Compare with this JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Relative slowdown which counts as regression")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    sock, stop = zerodb.server(
+        path=join(tmpdir, "db.fs"),
+        init=dict(password=TEST_PASSPHRASE, cert=ZEO.tests.testssl.client_cert))
+    db = zerodb.DB(sock, username="root", password=TEST_PASSPHRASE,
+                   security=kdf.key_from_password,
+                   server_cert=ZEO.tests.testssl.server_cert)
+    try:
+        bench = Bench(db, warm=args.warm, repeat=args.repeat)
+        run_all(db, read_docs(args.docs), bench)
+    finally:
+        db.disconnect()
+        stop()
+        shutil.rmtree(tmpdir)
+
+    data = {"docs": args.docs, "warm": args.warm, "results": bench.results}
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+
+    if args.compare and os.path.exists(args.compare):
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if (baseline.get("docs"), baseline.get("warm")) != (args.docs, args.warm):
+            print("Baseline was made with different --docs or --warm")
+        regressions = compare(bench.results, baseline["results"], args.tolerance)
+        if regressions:
+            print("Regressions: " + ", ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
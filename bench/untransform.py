@@ -0,0 +1,70 @@
+"""
+Throughput of untransforming (decrypting and decompressing) a prefetched
+batch of records depending on number of worker threads.
+
+    python bench/untransform.py [--records 2000] [--size 8192] [--no-sodium]
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import time
+from multiprocessing import cpu_count
+
+from zerodb.storage.transforming import WorkerPool
+from zerodb.transform import compress, decompress, encrypt, decrypt
+from zerodb.transform.compress_zlib import zlib_compressor
+from zerodb.transform.encrypt_aes import AES256Encrypter
+
+
+def make_records(n, size):
+    # Half random, half repeating, so that zlib has something to do
+    return [encrypt(compress(os.urandom(size // 4) * 2 + b"x" * (size // 2)))
+            for i in range(n)]
+
+
+def measure(workers, records, repeat=3):
+    pool = WorkerPool(workers)
+    untransform = lambda data: decompress(decrypt(data))
+    pool.map(untransform, records[:workers * 2])  # Warm up the threads
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        pool.map(untransform, records)
+        dt = time.time() - t0
+        best = dt if best is None else min(best, dt)
+    pool.close()
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--records", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=8192,
+                        help="Size of one record before compression")
+    parser.add_argument("--max-workers", type=int, default=cpu_count())
+    parser.add_argument("--no-sodium", action="store_true",
+                        help="Use PyCryptodome instead of libsodium")
+    args = parser.parse_args()
+
+    if args.no_sodium:
+        AES256Encrypter.use_sodium = False
+    AES256Encrypter.register_class(default=True)
+    AES256Encrypter(passphrase="benchmark")
+    zlib_compressor.register(default=True)
+
+    records = make_records(args.records, args.size)
+    mb = args.records * args.size / 2.0 ** 20
+
+    print("workers  seconds    MB/s  speedup")
+    base = None
+    workers = 1
+    while workers <= args.max_workers:
+        dt = measure(workers, records)
+        base = base or dt
+        print("%7d %8.3f %7.1f %8.2f" % (workers, dt, mb / dt, base / dt))
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -42,6 +42,7 @@ TESTS_REQUIRE = [
 entry_points = """
 [console_scripts]
 zerodb-initdb = zerodb.permissions.base:init_db_script
+zerodb-userstats = zerodb.permissions.userstats:main
 """
 
 # The following is to avoid build errors on brand new Amazon Ubuntu
@@ -170,6 +171,8 @@ setup(
     package_data={'zerodb.permissions': ['nobody-key.pem', 'nobody.pem']},
     include_package_data=True,
     install_requires=INSTALL_REQUIRES,
-    extras_require={'testing': TESTS_REQUIRE},
+    extras_require={'testing': TESTS_REQUIRE,
+                    'zstd': ['zstandard'],
+                    'lz4': ['lz4']},
     entry_points=entry_points,
 )
@@ -96,7 +96,7 @@ class WikiPage(Model):
 
 
 def add_wiki_and_close(sock, count=200, dbclass=zerodb.DB):
-    db = zerodb.testing.db(None, sock, dbclass=dbclass)
+    db = zerodb.testing.do_db(None, sock, dbclass=dbclass)
     with transaction.manager:
         for doc in wiki.read_docs(join(dirname(abspath(__file__)), "wiki_sample")):
             p = WikiPage(**doc)
@@ -0,0 +1,81 @@
+import os
+import ZEO.tests.testssl
+from ZEO.cache import ClientCache
+from ZODB.utils import p64, z64
+
+import zerodb
+from zerodb.crypto import kdf
+from zerodb.storage.cache import SharedCache
+from zerodb.testing import TEST_PASSPHRASE
+
+from db import Salary
+
+
+def test_shared_cache(tempdir):
+    path = os.path.join(tempdir, "shared.zec")
+    parent = ClientCache(path, 2 ** 20)
+    parent.store(p64(1), p64(10), None, b"one")
+    parent.store(p64(2), p64(11), None, b"two")
+    parent.store(p64(3), p64(5), p64(11), b"old three")
+    parent.setLastTid(p64(12))
+    parent.f.flush()
+
+    cache = SharedCache(path, 2 ** 20)
+    assert cache.getLastTid() == p64(12)
+    assert len(cache) == 2
+    assert p64(1) in cache.current
+    assert cache.loadBefore(p64(1), p64(20)) == (b"one", p64(10), None)
+    assert cache.loadBefore(p64(1), p64(10)) is None
+    assert cache.loadBefore(p64(3), p64(20)) is None
+
+    # Parent overwrote the record: a miss rather than wrong data
+    parent.invalidate(p64(2), p64(13))
+    parent.clear()
+    parent.store(p64(4), p64(13), None, b"four" * 100)
+    parent.f.flush()
+    assert cache.loadBefore(p64(2), p64(20)) is None
+
+    cache.invalidate(p64(1), p64(14))
+    assert cache.loadBefore(p64(1), p64(20)) is None
+    cache.store(p64(1), p64(14), None, b"new one")
+    cache.setLastTid(p64(14))
+    assert cache.loadBefore(p64(1), p64(20)) == (b"new one", p64(14), None)
+    assert cache.getLastTid() == p64(14)
+
+    cache.close()
+    parent.close()
+
+    assert SharedCache(os.path.join(tempdir, "none.zec")).getLastTid() == z64
+
+
+def test_persistent_cache(zeo_server, tempdir):
+    path = os.path.join(tempdir, "client.zec")
+
+    def open_db():
+        return zerodb.DB(zeo_server,
+                         username='root', password=TEST_PASSPHRASE,
+                         security=kdf.key_from_password,
+                         server_cert=ZEO.tests.testssl.server_cert,
+                         debug=True, wait_timeout=11, cache_file=path)
+
+    db = open_db()
+    uids = [s._p_uid for s in db[Salary].query(name="Hello")]
+    db.disconnect()
+    db._storage.close()
+    assert os.path.exists(path)
+
+    db = open_db()
+    count = db._storage._debug_download_count
+    assert [s._p_uid for s in db[Salary].query(name="Hello")] == uids
+    # Everything came from the cache file
+    assert db._storage._debug_download_count == count
+
+    # This is what a forked process gets
+    cache = SharedCache(path)
+    assert len(cache) > 0
+    oid = db[Salary]._objects[uids[0]]._p_oid
+    assert cache.loadBefore(oid, None)[0] == db._storage.base.loadBefore(oid, p64(2 ** 62))[0]
+    cache.close()
+
+    db.disconnect()
+    db._storage.close()
@@ -1,5 +1,21 @@
+import threading
+
+import pytest
+import transaction
+from zodbpickle import pickle
+from zope.component import getGlobalSiteManager
+
+import zerodb
+from zerodb.testing import do_db, do_zeo_server
 from zerodb.transform import compress, decompress
+from zerodb.transform.compress_lz4 import lz4_compressor
 from zerodb.transform.compress_zlib import zlib_compressor
+from zerodb.transform.compress_zstd import ZstdCompressor, record_class, zstd_compressor
+from zerodb.transform.interfaces import ICompressor
+
+from db import Page
+
+_gsm = getGlobalSiteManager()
 
 
 def test_utilities():
@@ -15,3 +31,90 @@ def test_utilities():
 
     assert decompress(compressed_default) == test_string
     assert decompress(compressed_zlib) == test_string
+
+
+@pytest.mark.skipif(lz4_compressor is None, reason="lz4 is not installed")
+def test_lz4():
+    lz4_compressor.register()
+    test_string = b"This is a test " * 1000
+    compressed = lz4_compressor.compress(test_string)
+    assert compressed.startswith(b".clz4$")
+    assert decompress(compressed) == test_string
+
+
+@pytest.mark.skipif(zstd_compressor is None, reason="zstandard is not installed")
+def test_zstd_dictionaries():
+    compressor = ZstdCompressor()
+    compressor.register()
+    records = [pickle.dumps(Page, 3) + pickle.dumps({"title": "hello %s" % i, "text": "lorem ipsum %s" % (i * 7)}, 3)
+               for i in range(1000)]
+    assert record_class(records[0]) == "db.Page"
+    assert record_class(b"junk") is None
+
+    plain = [compressor.compress(r) for r in records]
+    compressor.add_dictionary("db.Page", compressor.train(records[:500], size=2048))
+    with_dict = [compressor.compress(r) for r in records]
+    assert sum(map(len, with_dict)) < sum(map(len, plain))
+
+    for r, p, d in zip(records, plain, with_dict):
+        assert d.startswith(b".czstd$")
+        assert decompress(p) == r
+        assert decompress(d) == r
+
+    with pytest.raises(LookupError):
+        ZstdCompressor().decompress(with_dict[0])
+
+
+class ZstdDB(zerodb.DB):
+    compressor = zstd_compressor
+
+
+@pytest.fixture
+def zstd_db(request, tempdir):
+    """
+    Factory of ZstdDB clients of a fresh server
+    """
+    sock = do_zeo_server(request, tempdir, name="zstd_server", fsname="zstd.fs")
+    previous = _gsm.queryUtility(ICompressor)
+
+    @request.addfinalizer
+    def restore():
+        if previous is not None:
+            previous.register(default=True)
+        else:
+            _gsm.unregisterUtility(provided=ICompressor)
+
+    return lambda: do_db(request, sock, dbclass=ZstdDB)
+
+
+@pytest.mark.skipif(zstd_compressor is None, reason="zstandard is not installed")
+def test_train_compression(zstd_db):
+    db = zstd_db()
+    other = zstd_db()
+    with transaction.manager:
+        db.add([Page(title="hello %s" % i, text="lorem ipsum %s" % i) for i in range(300)])
+
+    db.train_compression([Page], size=2048)
+    assert "db.Page" in db._compressor.dicts
+    # Dictionaries belong to the database, not to the global compressor
+    assert not zstd_compressor.dicts
+    assert "db.Page" not in other._compressor.dicts
+    with transaction.manager:
+        db.add([Page(title="hello again %s" % i, text="lorem ipsum %s" % i) for i in range(10)])
+    assert len(db[Page].query(title="hello again 5")) == 1
+
+    # A client which was connected before training loads new dictionaries
+    # when it meets them, in any thread
+    other._connection.sync()
+    texts = []
+    thread = threading.Thread(target=lambda: texts.extend(
+        p.text for p in other[Page].query(title="hello again 5")))
+    thread.start()
+    thread.join()
+    assert texts == ["lorem ipsum 5"]
+    assert "db.Page" in other._compressor.dicts
+
+    # Another client loads the dictionary from the database
+    db = zstd_db()
+    assert "db.Page" in db._compressor.dicts
+    assert [p.text for p in db[Page].query(title="hello again 5")] == ["lorem ipsum 5"]
@@ -1,9 +1,20 @@
+import datetime
+import json
 import logging
 import mock
+import pytest
 import transaction
+from ZODB.utils import maxtid
 from itertools import islice
 from db import Page, Salary, Department
 from zerodb.catalog.query import Contains, InRange, Eq, Gt
+from zerodb.catalog.query import estimate_size, _to_set, _Union
+from zerodb import trees
+from zerodb.db import decode_cursor, encode_cursor
+from zerodb.storage.transforming import WorkerPool
+from zerodb.util.iter import Sliceable
+from zerodb.testing import max_roundtrips
+from zerodb.util.query_stats import Histogram, QueryStats
 # Also need to test optimize, Lt(e), Gt(e)
 
 logging.basicConfig(level=logging.DEBUG)
@@ -68,6 +79,390 @@ def test_add(db):
         db.remove(page)
 
 
+def test_add_many(db):
+    pages = [Page(title="bulk %s" % i, text="bulkload%s lorem ipsum" % (i % 3))
+             for i in range(30)]
+    salaries = [Salary(name="Bulk", surname="Load-%s" % i, salary=777)
+                for i in range(5)]
+    with transaction.manager:
+        uids = db.add(pages + salaries)
+    assert uids == [o._p_uid for o in pages + salaries]
+    assert len(set(uids)) == 35
+
+    assert len(db[Page].query(Contains("text", "bulkload1"))) == 10
+    assert db[Page].query(title="bulk 7")[0] is pages[7]
+    assert len(db[Salary].query(salary=777, name="Bulk")) == 5
+
+    with transaction.manager:
+        db.remove(pages + salaries)
+    assert len(db[Page].query(Contains("text", "bulkload1"))) == 0
+
+
+def test_and_selectivity(db):
+    catalog = db[Salary]._catalog
+    assert estimate_size(Eq("name", "Hello"), catalog) == 1
+    assert estimate_size(Eq("name", "Nobody"), catalog) == 0
+    assert estimate_size(InRange("salary", 0, 10 ** 7), catalog) >= 201
+    assert estimate_size(Contains("full_name", "Hello"), catalog) == 1
+
+    with mock.patch("zerodb.catalog.indexes.field.CatalogFieldIndex.applyInRange") as range_mock:
+        # The broad range is checked against the only candidate instead
+        result = db[Salary].query(InRange("salary", 0, 10 ** 7) & Eq("name", "Hello"))
+        assert [s.surname for s in result] == ["World"]
+        assert len(db[Salary].query(InRange("salary", 0, 1000) & Eq("name", "Hello"))) == 0
+        assert len(db[Salary].query(Gt("salary", 0) & Contains("full_name", "Hello"))) == 1
+        assert range_mock.call_count == 0
+
+    with mock.patch("zerodb.catalog.indexes.field.CatalogFieldIndex.applyEq") as eq_mock:
+        # Nothing is fetched when one of the operands is known to be empty
+        assert len(db[Salary].query(Eq("name", "Hello") & Eq("surname", "Nobody"))) == 0
+        assert eq_mock.call_count == 0
+
+    assert len(db[Salary].query(InRange("salary", 130000, 180000) & Eq("name", "John-150"))) == 1
+
+
+def test_ranked_and(db):
+    with transaction.manager:
+        db.add([Salary(name="Ranked", surname=" ".join(["ranked"] * (i % 7 + 1)), salary=i)
+                for i in range(40)])
+
+    catalog = db[Salary]._catalog
+    ranked = list(catalog.query(Contains("full_name", "ranked"))[1])
+    salaries = {o._p_uid: o.salary for o in db[Salary].query(name="Ranked")}
+    expected = [uid for uid in ranked if salaries[uid] >= 10]
+    assert len(expected) == 30
+
+    _, result = catalog.query(Contains("full_name", "ranked") & Gt("salary", 9))
+    assert isinstance(result, Sliceable)
+    assert list(result) == expected
+
+    with mock.patch("zerodb.catalog.indexes.field.CatalogFieldIndex.applyGt") as gt_mock:
+        result = db[Salary].query(Contains("full_name", "ranked") & Gt("salary", 9), limit=3)
+        assert [o._p_uid for o in result] == expected[:3]
+        assert gt_mock.call_count == 0
+
+    # Very selective operands are applied as sets, relevance order is kept
+    result = db[Salary].query(Contains("full_name", "ranked") & Eq("salary", 12) & Gt("salary", 9))
+    assert [o._p_uid for o in result] == [uid for uid in expected if salaries[uid] == 12]
+
+    with transaction.manager:
+        db.remove(list(db[Salary].query(name="Ranked")))
+
+
+def test_sort_topk(db):
+    with transaction.manager:
+        db.add([Salary(name="Top" if i % 3 else "Other", surname="K", salary=i * 7 % 50)
+                for i in range(60)])
+
+    catalog = db[Salary]._catalog
+    index = catalog["salary"]
+    salaries = {o._p_uid: o.salary for o in db[Salary].query(surname="K")}
+    uids = [o._p_uid for o in db[Salary].query(name="Top")]
+
+    for reverse in (False, True):
+        expected = sorted(uids, key=lambda uid: salaries[uid], reverse=reverse)
+        size, result = catalog.query(Eq("name", "Top"), sort_index="salary",
+                                     limit=5, reverse=reverse)
+        assert size.total == len(uids)
+        assert [salaries[uid] for uid in result] == [salaries[uid] for uid in expected[:5]]
+
+        docids = catalog.family.IF.TreeSet(uids)
+        for method in (index._scan_topk, index._heap_topk):
+            topk = method(docids, 5, reverse=reverse)
+            assert [salaries[uid] for uid in topk] == [salaries[uid] for uid in expected[:5]]
+
+    # The result set isn't read as a whole
+    result = catalog["name"].applyEq("Top")
+    docids, size, exact = catalog._sortable(result)
+    assert docids is result.container
+    assert size == len(uids) and exact
+    assert result.stop == 0
+
+    # Sizes of big result sets are estimated, and marked so
+    with mock.patch("zerodb.catalog.exact_length_limit", 0):
+        size, result = catalog.query(Eq("name", "Top"), sort_index="salary",
+                                     limit=5)
+        assert size == 5 and size.estimated
+        size, result = catalog.query(Eq("name", "Top"), sort_index="salary",
+                                     limit=100)
+        assert size == size.total == len(uids) and not size.estimated
+
+    with transaction.manager:
+        db.remove(list(db[Salary].query(surname="K")))
+
+
+def test_query_page(db):
+    with transaction.manager:
+        db.add([Salary(name="Paged", surname="P-%s" % i, salary=i % 7)
+                for i in range(30)])
+
+    salaries = {o._p_uid: o.salary for o in db[Salary].query(name="Paged")}
+
+    for kw in [{}, {"sort_index": "salary"}, {"sort_index": "salary", "reverse": True}]:
+        uids = []
+        cursor = None
+        while True:
+            page, cursor = db[Salary].query_page(name="Paged", limit=4, cursor=cursor, **kw)
+            uids.extend(o._p_uid for o in page)
+            if cursor is None:
+                break
+        assert len(uids) == 30
+        assert sorted(uids) == sorted(salaries)
+        if kw:
+            assert [salaries[uid] for uid in uids] == sorted(salaries.values(), reverse=kw.get("reverse", False))
+        else:
+            assert uids == sorted(uids)
+
+    # Both ways to sort give the same pages
+    _, cursor = db[Salary].query_page(name="Paged", limit=5, sort_index="salary")
+    after = decode_cursor(cursor, "salary")
+    index = db[Salary]._catalog["salary"]
+    docids = db[Salary]._catalog["name"].applyEq("Paged").container
+    for reverse in (False, True):
+        assert index._scan_topk(docids, 5, reverse=reverse, after=after) == \
+            index._heap_topk(docids, 5, reverse=reverse, after=after)
+
+    with pytest.raises(ValueError):
+        db[Salary].query_page(name="Paged", limit=5, cursor=cursor)
+    with pytest.raises(ValueError):
+        db[Salary].query_page(name="Paged", limit=5, cursor="garbage")
+
+    # Unions of ordered results are continued too
+    q = Eq("surname", "P-3") | Eq("surname", "P-11") | Eq("surname", "P-20")
+    uids = []
+    cursor = None
+    while True:
+        page, cursor = db[Salary].query_page(q, limit=2, cursor=cursor)
+        uids.extend(o._p_uid for o in page)
+        if cursor is None:
+            break
+    assert uids == sorted(o._p_uid for o in db[Salary].query(q))
+    assert len(uids) == 3
+
+    # Queries which can't be continued fail on the first page
+    with pytest.raises(ValueError):
+        db[Page].query_page(Contains("text", "something"), limit=5)
+    with pytest.raises(ValueError):
+        db[Salary].query_page(name="Paged", limit=5, reverse=True)
+
+    with transaction.manager:
+        db.remove(list(db[Salary].query(name="Paged")))
+
+
+def test_union_keys():
+    IF = trees.family32.IF
+    read = []
+
+    def reading(docids):
+        for docid in docids:
+            read.append(docid)
+            yield docid
+
+    evens = IF.TreeSet(range(0, 1000, 2))
+    union = _Union(IF, [
+        Sliceable(lambda: reading(evens), ordered=True, container=evens),
+        IF.TreeSet(range(1, 1000, 3))])
+    assert list(islice(union.keys(min=900, excludemin=True), 4)) == \
+        [901, 902, 904, 906]
+    assert list(islice(union.keys(min=902), 1)) == [902]
+    # Continuing doesn't read docids before min
+    assert read == []
+    assert list(union.keys()) == sorted(set(evens) | set(range(1, 1000, 3)))
+
+
+def test_cursor_values():
+    utc = datetime.timezone(datetime.timedelta(hours=2))
+    values = [None, True, 3, 2.5, u"text", b"\x00\xff",
+              datetime.date(2016, 2, 29),
+              datetime.datetime(2016, 2, 29, 12, 30, 15, 7),
+              datetime.datetime(2016, 2, 29, 12, 30, tzinfo=utc),
+              (u"a", (b"b", datetime.date(2000, 1, 1)), 1)]
+    for value in values:
+        cursor = encode_cursor((value, 42), "salary", True)
+        after = decode_cursor(cursor, "salary", True)
+        assert after == (value, 42)
+        assert type(after[0]) is type(value)
+
+    with pytest.raises(ValueError):
+        encode_cursor(({1, 2}, 42), "salary")
+
+
+def test_projection(db):
+    with transaction.manager:
+        db.add([Salary(name="Projected", surname="P-%s" % i, salary=i) for i in range(150)])
+
+    objects = db[Salary].query(name="Projected", sort_index="salary", limit=150)
+    expected = [(o._p_uid, o.surname, o.salary) for o in objects]
+    db._connection.cacheMinimize()
+
+    count = db._storage._debug_download_count
+    rows = db[Salary].query(name="Projected", sort_index="salary", limit=150,
+                            fields=["_p_uid", "surname", "salary"])
+    assert rows == expected
+    rows = db[Salary].query(name="Projected", fields=["_p_uid", "surname", "salary"])
+    assert len(rows) == 150
+    assert sorted(rows) == sorted(expected)
+    # Only index buckets were read, not the objects
+    assert db._storage._debug_download_count - count < 50
+
+    with pytest.raises(ValueError):
+        db[Salary].query(name="Projected", fields=["full_name"])
+
+    with transaction.manager:
+        db.remove(list(db[Salary].query(name="Projected")))
+
+
+def test_aggregate(db):
+    with transaction.manager:
+        db.add([Salary(name="Aggregated", surname="A-%s" % (i % 4), salary=i * 10)
+                for i in range(40)])
+
+    salary = db[Salary]
+    assert salary.aggregate("count") == len(salary)
+    assert salary.aggregate("count", name="Aggregated") == 40
+    assert salary.aggregate("count", queryobj=InRange("salary", 100, 195), name="Aggregated") == 10
+    assert salary.aggregate("min", "salary", name="Aggregated") == 0
+    assert salary.aggregate("max", "salary", name="Aggregated") == 390
+    assert salary.aggregate("max", "salary", name="Aggregated", surname="A-1") == 370
+    assert salary.aggregate("min", "salary") == min(o.salary for o in salary.query(InRange("salary", None, None)))
+    assert salary.aggregate("max", "salary", name="Nobody") is None
+    assert salary.aggregate("distinct", "surname", name="Aggregated") == ["A-0", "A-1", "A-2", "A-3"]
+    assert salary.aggregate("group_by", "surname", Gt("salary", 195), name="Aggregated") == \
+        {"A-0": 5, "A-1": 5, "A-2": 5, "A-3": 5}
+    assert salary.aggregate("group_by", "surname")["A-2"] == 10
+
+    with pytest.raises(ValueError):
+        salary.aggregate("sum", "salary")
+    with pytest.raises(ValueError):
+        salary.aggregate("max", "full_name")
+
+    with transaction.manager:
+        db.remove(list(db[Salary].query(name="Aggregated")))
+
+
+def test_explain(db):
+    db._connection.cacheMinimize()
+    with db.explain() as profile:
+        db[Salary].query(InRange("salary", 130000, 180000) & Eq("name", "Hello"),
+                         sort_index="salary", limit=5)
+    assert [s.name for s in profile.children] == ["And", "sort", "load"]
+    assert sorted(s.name for s in profile.children[0].children) == \
+        ["130000 <= salary <= 180000", "name == 'Hello'"]
+    totals = profile.totals()
+    assert totals["loads"] == totals["cache_hits"] + totals["cache_misses"]
+    assert totals["loads"] >= profile.children[0].total("loads") > 0
+    assert totals["decrypted_bytes"] > 0
+    assert "130000 <= salary <= 180000" in profile.report()
+
+    # Nothing is recorded outside
+    db[Salary].query(name="Hello")
+    assert profile.totals() == totals
+
+
+def test_query_stats(db):
+    # On by default
+    assert isinstance(db.query_stats, QueryStats)
+    saved, db.query_stats = db.query_stats, QueryStats()
+    try:
+        db[Salary].query(InRange("salary", 130000, 180000), sort_index="salary", limit=2)
+        db[Salary].query(InRange("salary", 1, 2), sort_index="salary", limit=2)
+        # Lazy results are measured up to iterating over them
+        db[Salary].query(name="Hello")
+
+        stats = {s["shape"]: s for s in db.query_stats.snapshot()}
+        assert set(stats) == {"InRange(salary) sort=salary limit", "Eq(name)"}
+        stats = stats["InRange(salary) sort=salary limit"]
+        assert stats["model"] == "Salary"
+        assert stats["count"] == 2
+        assert stats["p50"] <= stats["p99"]
+        assert stats["round_trips"] >= 0
+
+        # Round trips are counted the same as explain does
+        db.query_stats.reset()
+        db._connection.cacheMinimize()
+        db._storage.base._cache.clear()
+        db._storage._in_flight.clear()
+        with db.explain() as profile:
+            db[Salary].query(name="Hello", limit=1)
+        [stats] = db.query_stats.snapshot()
+        assert stats["round_trips"] == profile.total("round_trips") > 0
+        # Queries being explained don't get sections of their own
+        assert [s.name for s in profile.children] == ["And", "sort", "load"]
+
+        db.query_stats.slow_threshold = 0
+        with mock.patch("zerodb.util.query_stats.logger") as logger:
+            db[Salary].query(Eq("name", "Hello") & Gt("salary", 10), limit=3)
+        assert logger.warning.call_count == 1
+        line = json.loads(logger.warning.call_args[0][0])
+        assert line["shape"] == "And(Eq(name), Gt(salary)) limit"
+        assert line["model"] == "Salary"
+    finally:
+        db.query_stats = saved
+
+
+def test_histogram():
+    hist = Histogram()
+    for i in range(99):
+        hist.add(0.0015)
+    hist.add(100)
+    assert hist.percentile(50) == 0.002
+    assert hist.percentile(99) == 0.002
+    assert hist.percentile(100) == 100
+    assert hist.count == 100
+
+
+def test_max_roundtrips(db):
+    def clear():
+        db._connection.cacheMinimize()
+        db._storage.base._cache.clear()
+        # Records prefetched before aren't coming any more
+        db._storage._in_flight.clear()
+
+    catalog = db[Salary]._catalog
+    uids = list(catalog["name"]._rev_index.keys())[:150]
+
+    clear()
+    with max_roundtrips(10) as profile:
+        catalog["salary"].get_values(uids)
+    assert 0 < profile.total("round_trips") <= 10
+
+    clear()
+    with max_roundtrips(10):
+        db[Salary].query(InRange("salary", 130000, 180000), sort_index="salary", limit=20)
+
+    # Loading objects one by one is a round trip per object
+    clear()
+    with pytest.raises(AssertionError):
+        with max_roundtrips(10):
+            for uid in uids[:20]:
+                db[Salary]._objects[uid]._p_activate()
+
+
+def test_lazy_or(db):
+    with transaction.manager:
+        db.add([Salary(name="Lazy", surname="Or-%s" % i, salary=i) for i in range(20)] +
+               [Salary(name="Lazy-%s" % i, surname="Or", salary=i) for i in range(20)])
+
+    catalog = db[Salary]._catalog
+    _, result = catalog.query(Eq("name", "Lazy") | Eq("surname", "Or"))
+    assert isinstance(result, Sliceable)
+    # Length comes from the set of docids, read once and kept
+    assert len(result) == 40
+    assert result.stop == 0
+    assert _to_set(catalog.family.IF, result) is result.to_set()
+    uids = list(result)
+    assert len(uids) == 40
+    assert uids == sorted(uids)
+    assert result[0] == uids[0]
+
+    assert len(db[Salary].query(Eq("name", "Lazy") | Eq("surname", "Or"), limit=5)) == 5
+    assert len(db[Salary].query(Eq("name", "Lazy") | Eq("surname", "Nothing"))) == 20
+    assert len(db[Salary].query((Eq("name", "Lazy") | Eq("surname", "Or")) & Eq("salary", 3))) == 2
+
+    with transaction.manager:
+        db.remove(db[Salary].query(Eq("name", "Lazy") | Eq("surname", "Or")))
+
+
 def test_reindex(db):
     with transaction.manager:
         page = Page(title="hello", text="Quick0 brown lazy fox jumps over lorem  ipsum dolor sit amet")
@@ -247,3 +642,16 @@ def test_all_uid(db):
     transaction.commit()
     for obj in objs:
         assert hasattr(obj, "_p_uid")
+
+
+def test_parallel_prefetch(db):
+    storage = db._storage
+    oids = [s._p_oid for s in db[Salary].query(InRange("salary", 0, 10 ** 7))]
+    assert len(oids) > 16
+    with mock.patch.object(storage, "_workers", WorkerPool(4)):
+        storage.prefetch(oids, maxtid)
+    for oid in oids:
+        assert (oid, maxtid) in storage._prefetched
+        data = storage.loadBefore(oid, maxtid)
+        assert (oid, maxtid) not in storage._prefetched
+        assert data == storage.loadBefore(oid, maxtid)
@@ -1,4 +1,7 @@
+import random
 import six
+import transaction
+import ZODB
 
 from zerodb.models import Model
 from zerodb import intid
@@ -30,3 +33,103 @@ def test_initid():
     idstore.remove(ts[1]._p_uid)
 
     assert len(idstore) == 1
+
+
+def test_add_many():
+    ts = [T() for i in range(10)]
+    idstore = intid.IdStore()
+    uids = idstore.add_many(ts)
+
+    assert len(idstore) == 10
+    assert len(set(uids)) == 10
+    assert [t._p_uid for t in ts] == uids
+    assert idstore[uids[5]] is ts[5]
+
+
+def test_sequential_ids():
+    idstore = intid.IdStore()
+    uids = idstore.add_many([T() for i in range(10)])
+    assert uids == list(range(uids[0], uids[0] + 10))
+    assert list(idstore.blocks.keys()) == [uids[0] // idstore.block_size]
+
+    # Another connection gets its own block close to ours
+    other = idstore._get_blocks()
+    intid._new_store_blocks[idstore] = intid._Blocks()
+    uid = idstore.add(T())
+    blocks = list(idstore.blocks.keys())
+    assert len(blocks) == 2
+    first = uids[0] // idstore.block_size
+    second = uid // idstore.block_size
+    assert second != first and second in blocks
+    assert abs(second - first) <= idstore.block_spread
+
+    # Block which wasn't committed is not used
+    del idstore.blocks[second]
+    uid2 = idstore.add(T())
+    assert uid2 // idstore.block_size in idstore.blocks
+    assert idstore.blocks[uid2 // idstore.block_size] == idstore._get_blocks().token
+
+    # Running out of a block releases it
+    state = idstore._get_blocks()
+    for uid in range(state.blockend - idstore.block_size, state.blockend - 1):
+        idstore.tree.insert(uid, None)
+    state.nextid = state.blockend - 1
+    uids = idstore.add_many([T() for i in range(2)])
+    assert uids[0] // idstore.block_size != uids[1] // idstore.block_size
+    assert uids[0] // idstore.block_size not in idstore.blocks
+    assert idstore.blocks[uids[1] // idstore.block_size] == state.token
+    assert first in idstore.blocks and other.token != state.token
+
+
+def test_blocks_survive_ghosting():
+    db = ZODB.DB(None)
+    tm = transaction.TransactionManager()
+    conn = db.open(tm)
+    conn.root()["store"] = idstore = intid.IdStore()
+    uids = idstore.add_many([T() for i in range(5)])
+    tm.commit()
+
+    # Reloaded store goes on with the block of the connection
+    idstore._p_deactivate()
+    assert idstore._p_changed is None
+    uids += idstore.add_many([T() for i in range(5)])
+    tm.commit()
+    assert uids == list(range(uids[0], uids[0] + 10))
+    assert len(idstore.blocks) == 1
+
+    # And so does the same store loaded by a fresh connection
+    conn.cacheMinimize()
+    uids.append(conn.root()["store"].add(T()))
+    tm.commit()
+    assert uids[-1] == uids[0] + 10
+    assert len(conn.root()["store"].blocks) == 1
+
+    # Other connections reserve blocks of their own
+    tm2 = transaction.TransactionManager()
+    conn2 = db.open(tm2)
+    uid = conn2.root()["store"].add(T())
+    tm2.commit()
+    assert uid // intid.IdStore.block_size != uids[0] // intid.IdStore.block_size
+    assert len(conn2.root()["store"].blocks) == 2
+    db.close()
+
+
+def test_sequential_ids_old_store():
+    # Store with random IDs, created before blocks were reserved
+    idstore = intid.IdStore()
+    del idstore.blocks
+    del idstore.first_block
+    for i in range(20000):
+        idstore.tree.insert(random.randrange(0, idstore.family.maxint), T())
+
+    uids = idstore.add_many([T() for i in range(20000)])
+    assert len(set(uids)) == 20000
+    sequential = sum(1 for a, b in zip(uids, uids[1:]) if b == a + 1)
+    assert sequential > 0.95 * len(uids)
+
+
+def test_models_get_different_ids():
+    ids = set()
+    for i in range(10):
+        ids.update(intid.IdStore().add_many([T() for i in range(10)]))
+    assert len(ids) == 100
@@ -0,0 +1,36 @@
+import mock
+from ZODB.MappingStorage import MappingStorage
+from ZODB.utils import p64
+
+from zerodb.permissions.subdb import StorageServer
+
+
+class Session(object):
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.connection = mock.Mock()
+
+    def calls(self):
+        return [c[0][1:] for c in self.connection.call_soon_threadsafe.call_args_list]
+
+
+def test_invalidate_own_sessions():
+    server = StorageServer(None, {'1': MappingStorage()})
+    alice1, alice2, bob = Session(p64(1)), Session(p64(1)), Session(p64(2))
+    for zs in (alice1, alice2, bob):
+        server.register_connection('1', zs)
+        server.register_user('1', zs)
+
+    server.invalidate(alice1, '1', p64(10), [p64(5)])
+    assert alice1.calls() == []
+    assert alice2.calls() == [('invalidateTransaction', p64(10), [p64(5)])]
+    assert bob.calls() == []
+
+    server.invalidate(bob, '1', p64(11), (), info={'size': 1})
+    assert bob.calls() == [('info', {'size': 1})]
+
+    server.close_conn(bob)
+    assert p64(2) not in server.zeo_storages_by_user['1']
+    server.close_conn(alice2)
+    assert server.zeo_storages_by_user['1'][p64(1)] == [alice1]
+    server.storages['1'].close()
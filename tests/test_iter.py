@@ -3,7 +3,7 @@ import pytest
 import six
 from six.moves import map as imap
 
-from zerodb.util.iter import Sliceable
+from zerodb.util.iter import Sliceable, merge_unique
 from zerodb.catalog.query import Gt
 from db import Salary
 
@@ -43,6 +43,11 @@ def test_sliceable():
     assert it[10:] == [str(i) for i in range(10, 100)]
 
 
+def test_merge_unique():
+    merged = merge_unique(iter([1, 3, 5, 7]), iter([2, 3, 4]), iter([]), iter([7, 8]))
+    assert list(merged) == [1, 2, 3, 4, 5, 7, 8]
+
+
 def test_dictify(db):
     test_salaries = db[Salary].query(Gt("salary", 100000)).dictify()
     obj = next(test_salaries)
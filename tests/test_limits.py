@@ -0,0 +1,179 @@
+"""Per-user limits and fair commit lock of the server
+"""
+import mock
+import os
+import threading
+import time
+
+import pytest
+import transaction
+from ZEO.asyncio.server import Delay
+from ZEO.monitor import StorageStats
+from ZEO.StorageServer import StubTimeoutThread
+
+from zerodb.models import Model, fields
+from zerodb.permissions import subdb
+from zerodb.permissions.exceptions import QuotaExceeded, TooManyTransactions
+from zerodb.permissions.limits import FairLockManager, Limits
+from zerodb.testing import db, do_zeo_server
+
+
+class Item(Model):
+    name = fields.Field()
+
+
+class Session(object):
+    # Just enough of ZEOStorage for the lock manager
+    locked = False
+    connected = True
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.calls = []
+
+    def call_soon_threadsafe(self, f, *args):
+        self.calls.append((f, args))
+
+    def run_calls(self):
+        calls, self.calls = self.calls, []
+        for f, args in calls:
+            f(*args)
+
+    def log(self, *args, **kw):
+        pass
+
+
+def vote(zs):
+    def f():
+        zs.locked = True
+        return zs.user_id
+    return f
+
+
+def test_fair_lock():
+    lm = FairLockManager('1', StorageStats(), StubTimeoutThread())
+    a, b, c, d = Session(1), Session(1), Session(2), Session(3)
+
+    assert lm.lock(a, vote(a)) == 1
+    time.sleep(0.05)
+    assert isinstance(lm.lock(b, vote(b)), Delay)
+    assert isinstance(lm.lock(c, vote(c)), Delay)
+
+    # User 1 just held the lock, so user 2 goes first though came later
+    lm.release(a)
+    assert lm.next is c
+    assert not b.calls
+
+    # Newcomers don't jump the queue
+    assert isinstance(lm.lock(d, vote(d)), Delay)
+    c.run_calls()
+    assert lm.locked is c
+
+    # User 3 didn't have the lock yet, user 1 did
+    lm.release(c)
+    assert lm.next is d
+    d.run_calls()
+    assert lm.locked is d
+
+    lm.release(d)
+    b.run_calls()
+    assert lm.locked is b
+    lm.release(b)
+    assert lm.locked is None and lm.holder is None and not lm.queue
+
+    # A waiting transaction which is aborted passes its turn
+    assert lm.lock(a, vote(a)) == 1
+    lm.lock(b, vote(b))
+    lm.lock(c, vote(c))
+    lm.release(a)
+    first = lm.next
+    lm.release(first)
+    assert lm.next is not None and lm.next is not first
+
+
+def test_quota():
+    limits = Limits(max_bytes=100)
+    limits.check_quota(b'u')
+    limits.add_usage(b'u', 60)
+    limits.check_quota(b'u')
+    limits.add_usage(b'u', 60)
+    with pytest.raises(QuotaExceeded):
+        limits.check_quota(b'u')
+    limits.check_quota(b'v')
+
+    # The transaction being committed counts too
+    limits.check_quota(b'v', 100)
+    with pytest.raises(QuotaExceeded):
+        limits.check_quota(b'v', 101)
+
+
+def test_max_transactions():
+    limits = Limits(max_transactions=1)
+    limits.begin(b'u')
+    limits.begin(b'v')  # Other users don't wait
+
+    started = []
+    thread = threading.Thread(
+        target=lambda: (limits.begin(b'u'), started.append(1)))
+    thread.start()
+    time.sleep(0.1)
+    assert not started
+
+    limits.end(b'u')
+    thread.join(1)
+    assert started
+
+    # Waiting for transactions which don't end fails
+    limits.transaction_wait_timeout = 0.1
+    with pytest.raises(TooManyTransactions):
+        limits.begin(b'u')
+    assert limits._transactions[b'u'] == 1
+
+
+def test_throttle_load():
+    limits = Limits(max_loads_per_second=100, load_burst=10)
+    t0 = time.time()
+    for i in range(10):
+        limits.throttle_load(b'u')
+    assert time.time() - t0 < 0.05
+
+    for i in range(10):
+        limits.throttle_load(b'u')
+    assert time.time() - t0 >= 0.08
+
+    # Other users aren't slowed down
+    t0 = time.time()
+    limits.throttle_load(b'v')
+    assert time.time() - t0 < 0.05
+
+
+def test_server_limits(request, tempdir):
+    limits = Limits(max_transactions=1)
+    with mock.patch.object(subdb.ZEOServer, 'limits', limits):
+        sock = do_zeo_server(request, tempdir, name='limits_server')
+    path = os.path.join(tempdir, 'db.fs')
+    limits.load_usage(path)
+    zdb = db(request, sock)
+
+    [(user_id, loaded)] = limits.usage.items()
+    with transaction.manager:
+        zdb.add(Item(name='first'))
+    used = limits.usage[user_id]
+    assert used > loaded
+
+    # The next transaction would be over the quota
+    limits.max_bytes = used + 10
+    with pytest.raises(QuotaExceeded):
+        with transaction.manager:
+            zdb.add(Item(name='second'))
+
+    limits.max_bytes = None
+    with transaction.manager:
+        zdb.add(Item(name='third'))
+    assert limits.usage[user_id] > used
+    assert len(list(zdb[Item].all())) == 2
+
+    # Usage is counted the same way as when it's loaded from the file
+    counted = limits.usage[user_id]
+    limits.load_usage(path)
+    assert limits.usage[user_id] == counted
@@ -1,7 +1,18 @@
 import logging
+import mock
+import random
+from itertools import islice
 import pytest
 import transaction
 import zerodb
+from zope.index.text.lexicon import CaseNormalizer
+from zope.index.text.lexicon import Splitter
+from zope.index.text.lexicon import StopWordRemover
+
+from zerodb import trees
+from zerodb.catalog.indexes.text_lexicon import Lexicon
+from zerodb.catalog.indexes import text_lucene
+from zerodb.catalog.indexes.text_lucene import IncrementalLuceneIndex, WeightedUnion
 from zerodb.query import Contains
 
 from zerodb.testing import do_zeo_server
@@ -14,7 +25,7 @@ logging.basicConfig(level=logging.DEBUG)
 @pytest.fixture(scope="module")
 def many_server(request, tempdir):
     sock = do_zeo_server(request, tempdir, name="many_server", fsname='many.fs')
-    db = zerodb.testing.db(None, sock)
+    db = zerodb.testing.do_db(None, sock)
     with transaction.manager:
         for i in range(2000):
             db.add(Page(title="hello %s" % i, text="lorem ipsum dolor sit amet" * 2))
@@ -29,7 +40,7 @@ def many_server(request, tempdir):
 
 @pytest.fixture(scope="module")
 def many_db(request, many_server):
-    return zerodb.testing.db(request, many_server)
+    return zerodb.testing.do_db(request, many_server)
 
 def get_one(db):
     key = db[WikiPage]._objects.tree.keys()[0]
@@ -125,3 +136,74 @@ def test_search_query(many_db, wiki_db):
 
     assert len(wiki_db[WikiPage].query(text="Austra* rugb?")) > 0
     assert len(wiki_db[WikiPage].query(text="Austra* rugb?", title="Geoff Toovey")) > 0
+
+
+def test_search_phrase(many_db):
+    index = many_db[Page]._catalog["text"].index
+    ids = [x[0] for x in index.search_phrase("something else")]
+    assert len(ids) == 1
+    assert many_db[Page]._objects[ids[0]].title == "extra page"
+    assert list(index.search_phrase("else something")) == []
+    assert list(index.search_phrase("something itisnotthere")) == []
+
+    ids = [x[0] for x in islice(index.search_phrase("something we're looking"), 10)]
+    assert len(ids) == 10
+    lens = [len(many_db[Page]._objects[i].text) for i in ids]
+    assert lens == sorted(lens, reverse=True)
+
+    pages = many_db[Page].query(Contains("text", '"something else"'))
+    assert [p.title for p in pages] == ["extra page"]
+    pages = many_db[Page].query(Contains("text", '"something we\'re looking"'), limit=5)
+    assert [p._p_uid for p in pages] == ids[:5]
+
+
+def test_search_phrase_no_phrases():
+    lexicon = Lexicon(Splitter(), CaseNormalizer(), StopWordRemover())
+    index = IncrementalLuceneIndex(lexicon, family=trees.family32, keep_phrases=False)
+    index.index_doc(1, "something else is here")
+    index.index_doc(2, "else, there is something")
+    index.index_doc(3, "nothing to see")
+
+    # Word order isn't kept, so phrases are searched as words
+    assert sorted(x[0] for x in index.search_phrase("something else")) == [1, 2]
+    assert sorted(index._search_all('"something else"')) == [1, 2]
+    assert list(index.search_phrase("itisnotthere")) == []
+
+
+def test_search_limit(wiki_db):
+    index = get_cat(wiki_db).index
+    results = list(index.search("Australia rugby league"))
+    ids = [docid for docid, _ in results]
+    assert len(ids) == len(set(ids))
+    assert set(ids) == set(docid for term in ["Australia", "rugby", "league"]
+                           for docid, _ in index.search(term))
+    assert list(index.search("Australia rugby league", limit=5)) == results[:5]
+    assert list(index.search("Australia", limit=5)) == list(index.search("Australia"))[:5]
+
+
+def test_weighted_union_limit():
+    rnd = random.Random(0)
+
+    def term(docids):
+        return trees.family32.OO.TreeSet(
+            (-rnd.expovariate(1), docid) for docid in docids)
+
+    L = [(term(range(3000)), 1.0), (term(range(1000, 4000)), 1.0),
+         (term(rnd.sample(range(5000), 2000)), 0.5)]
+    unlimited = WeightedUnion(L)
+    results = list(islice(unlimited, 10))
+    limited = WeightedUnion(L, limit=10)
+    assert [docid for docid, _ in limited] == [docid for docid, _ in results]
+    # Docs which can't get within limit aren't scored
+    assert limited.scored * 2 < unlimited.scored
+
+
+def test_query_limit(wiki_db):
+    with mock.patch.object(text_lucene, "mass_weightedUnion",
+                           wraps=text_lucene.mass_weightedUnion) as union:
+        results = wiki_db[WikiPage].query(Contains("text", "Australia rugby league"), limit=5)
+        assert union.call_args[1]["limit"] == 5
+        union.reset_mock()
+        everything = wiki_db[WikiPage].query(Contains("text", "Australia rugby league"))
+        assert union.call_args[1]["limit"] is None
+    assert [p._p_uid for p in results] == [p._p_uid for p in everything[:5]]
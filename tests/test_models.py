@@ -55,7 +55,7 @@ def test_model():
 
 
 def test_db(zeo_server):
-    db = zerodb.testing.db(None, zeo_server)
+    db = zerodb.testing.do_db(None, zeo_server)
     assert len(db._models) == 0
     assert isinstance(db[ExampleModel], zerodb.db.DbModel)
     assert len(db._models) == 1
@@ -64,7 +64,7 @@ def test_db(zeo_server):
 
 
 def test_dbmodel(zeo_server):
-    db = zerodb.testing.db(None, zeo_server)
+    db = zerodb.testing.do_db(None, zeo_server)
     assert db[ExampleModel]._model == ExampleModel
     assert db[ExampleModel]._db == db
     assert db[ExampleModel]._catalog_name == "catalog__examplemodel"
@@ -0,0 +1,83 @@
+import mock
+import pytest
+from ZODB.MappingStorage import MappingStorage
+from ZODB.POSException import StorageError
+from ZODB.utils import p64, z64
+import transaction
+
+from zerodb.permissions.ownerstorage import OwnerCache, OwnerStorage
+
+
+def commit(storage, records):
+    t = transaction.Transaction()
+    storage.tpc_begin(t)
+    try:
+        for oid, data in records:
+            try:
+                serial = storage.storage.load(oid)[1]
+            except KeyError:
+                serial = z64
+            storage.store(oid, serial, data, '', t)
+        storage.tpc_vote(t)
+    except Exception:
+        storage.tpc_abort(t)
+        raise
+    storage.tpc_finish(t)
+
+
+def test_owner_cache():
+    base = MappingStorage()
+    owners = OwnerCache()
+    alice = OwnerStorage(base, p64(100), owners)
+    bob = OwnerStorage(base, p64(200), owners)
+
+    commit(alice, [(p64(1), b"a1"), (p64(2), b"a2")])
+    # New records aren't known until the commit tells who wrote them
+    owners.update([p64(1), p64(2)], p64(100))
+
+    with mock.patch.object(alice, "_check_owned") as check:
+        commit(alice, [(p64(1), b"a1'"), (p64(2), b"a2'")])
+        assert check.call_count == 0
+
+    # Others are caught in tpc_vote, and the transaction is aborted
+    with pytest.raises(StorageError):
+        commit(bob, [(p64(3), b"b3"), (p64(1), b"b1")])
+    assert base.load(p64(1))[0] == b"a1'" + p64(100)
+
+    # Owners which were checked are remembered
+    owners.invalidate([p64(1), p64(2)])
+    commit(alice, [(p64(1), b"a1''")])
+    assert owners.get(p64(1)) == p64(100)
+    assert owners.get(p64(2)) is None
+
+    # Records of oids given to the user are new, they aren't loaded
+    oid = alice.new_oid()
+    with mock.patch.object(alice, "_check_owned") as check:
+        commit(alice, [(oid, b"a3")])
+        assert check.call_count == 0
+    assert oid not in alice._new_oids
+
+    # Oids which weren't used are forgotten when a transaction ends
+    unused = alice.new_oid()
+    commit(alice, [])
+    assert not alice._new_oids
+    alice.new_oid()
+    t = transaction.Transaction()
+    alice.tpc_begin(t)
+    alice.tpc_abort(t)
+    assert not alice._new_oids
+    with mock.patch.object(alice, "_check_owned") as check:
+        check.return_value = False
+        commit(alice, [(unused, b"a5")])
+        assert check.call_count == 1
+
+    # Oids of others are checked as usual
+    oid = bob.new_oid()
+    with mock.patch.object(alice, "_check_owned") as check:
+        check.return_value = False
+        commit(alice, [(oid, b"a4")])
+        assert check.call_count == 1
+
+    # Without a cache, permissions are checked in store
+    with pytest.raises(StorageError):
+        OwnerStorage(base, p64(200)).store(p64(1), z64, b"b1", '', None)
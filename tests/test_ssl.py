@@ -248,3 +248,107 @@ def test_user_cred_crud_edge_cases():
         admin.change_cert('boss', False, False)
         assert not user.certs
         assert user.password is None
+
+
+def test_certs():
+    certs = zerodb.permissions.base.Certs()
+    pem0, pem1 = pem_data('cert0'), pem_data('cert1')
+    certs.add(pem0)
+    certs.add(pem1)
+    assert certs.version == 2
+    assert (set(pem.strip() for pem in certs.data.strip().split('\n\n')) ==
+            set([pem0.strip(), pem1.strip()]))
+    certs.remove(pem0)
+    assert certs.data.strip() == pem1.strip()
+    assert certs.version == 3
+
+    # Certs of old databases were one string
+    old = zerodb.permissions.base.Certs.__new__(
+        zerodb.permissions.base.Certs)
+    old.__setstate__({'data': '\n\n' + pem0 + '\n\n' + pem1})
+    assert old.data.strip().startswith(pem0.strip())
+    old.remove(pem0)
+    assert old.data.strip() == pem1.strip()
+    assert 'data' not in old.__dict__
+
+
+def test_logins():
+    import ZODB.MappingStorage
+    from zerodb.permissions.base import get_admin, get_der
+    from zerodb.permissions.subdb import Logins
+
+    storage = ZODB.MappingStorage.MappingStorage()
+    pem0, pem1 = pem_data('cert0'), pem_data('cert1')
+    zerodb.permissions.base.init_db(storage, 'boss', pem0, False, 'pw')
+    with open(os.path.join(os.path.dirname(zerodb.permissions.base.__file__),
+                           'nobody.pem')) as f:
+        nobody_der = get_der(f.read())
+
+    def creds(password):
+        password, _ = kdf.hash_password(
+            'boss', password, key_file=None, cert_file=None,
+            appname='zerodb.com', key=None)
+        return dict(name='boss', password=password)
+
+    db = ZODB.DB(storage)
+    logins = Logins(db)
+    with db.transaction() as conn:
+        boss_id = get_admin(conn).users_by_name['boss'].id
+
+    assert logins.authenticate(get_der(pem0)) == boss_id
+    assert logins.authenticate(get_der(pem0), creds('pw')) == boss_id
+    assert logins.authenticate(nobody_der, creds('pw')) == boss_id
+    with pytest.raises(ZEO.Exceptions.AuthError):
+        logins.authenticate(nobody_der)
+    with pytest.raises(ZEO.Exceptions.AuthError):
+        logins.authenticate(nobody_der, creds('x'))
+    with pytest.raises(KeyError):
+        logins.authenticate(get_der(pem1))
+
+    # Changes made elsewhere are seen
+    with db.transaction() as conn:
+        admin = get_admin(conn)
+        admin.change_cert('boss', password='pw2')
+        user = admin.add_user('user', pem1)
+    assert logins.authenticate(get_der(pem1)) == user.id
+    assert logins.authenticate(nobody_der, creds('pw2')) == boss_id
+    with pytest.raises(ZEO.Exceptions.AuthError):
+        logins.authenticate(nobody_der, creds('pw'))
+    db.close()
+
+
+def test_failed_handshakes_end_threads():
+    import socket
+    import ssl
+    import threading
+    import time
+
+    def handlers():
+        return [t for t in threading.enumerate()
+                if t.name == 'zeo_client_hander']
+
+    addr, stop = zerodb.server(
+        init=dict(cert=ZEO.tests.testssl.client_cert))
+    try:
+        before = len(handlers())
+        # Client with a certificate which isn't registered
+        context = ssl.create_default_context(
+            cafile=ZEO.tests.testssl.server_cert)
+        context.check_hostname = False
+        context.load_cert_chain(pem_path('cert0'), pem_path('key0'))
+        for _ in range(20):
+            sock = socket.create_connection(addr)
+            try:
+                sock = context.wrap_socket(sock)
+                sock.recv(1)
+            except (ssl.SSLError, socket.error):
+                pass
+            finally:
+                sock.close()
+
+        deadline = time.time() + 10
+        while len(handlers()) > before and time.time() < deadline:
+            time.sleep(0.01)
+        assert len(handlers()) <= before
+    finally:
+        stop()
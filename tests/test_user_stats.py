@@ -1,14 +1,17 @@
 """Test user statistic script
 """
+import mock
 import os
 import ZEO
 import ZEO.tests.testssl
+import ZODB
+import ZODB.FileStorage
 
 import zerodb
 import zerodb.permissions.base
 
 from zerodb.crypto import kdf
-from zerodb.permissions.userstats import userstats
+from zerodb.permissions.userstats import Scanner, scan, userstats
 
 here = os.path.dirname(__file__)
 pem_path = lambda name: os.path.join(here, name + '.pem')
@@ -33,7 +36,6 @@ def test_userstats(tempdir):
         admin = zerodb.permissions.base.get_admin(conn)
         admin.add_user('user0', pem_data=(pem_data('cert0')))
         admin.add_user('user1', pem_data=(pem_data('cert1')))
-    admin_db.close()
 
     # Now, let's try connecting
     def user_db_factory(n='0'):
@@ -52,12 +54,65 @@ def test_userstats(tempdir):
             db._connection.transaction_manager.commit()
         db._db.close()
 
-    stats = userstats(path)
+    with admin_db.transaction() as conn:
+        stats = userstats(path, conn=conn)
+    admin_db.close()
 
     assert sorted(stats) == [
-        (b'\x00\x00\x00\x00\x00\x00\x00\x02', 'root', 23759),
-        (b'\x00\x00\x00\x00\x00\x00\x00\x08', 'user0', 1120),
-        (b'\x00\x00\x00\x00\x00\x00\x00\t', 'user1', 1154),
+        (b'\x00\x00\x00\x00\x00\x00\x00\x02', 'root', 23759, 13),
+        (b'\x00\x00\x00\x00\x00\x00\x00\x08', 'user0', 1120, 3),
+        (b'\x00\x00\x00\x00\x00\x00\x00\t', 'user1', 1154, 3),
         ]
 
+    # Splitting the file between processes gives the same
+    totals = scan(path)
+    assert scan(path, workers=3) == totals
+
+    # Incremental accounting only reads new transactions
+    checkpoint = os.path.join(tempdir, 'stats.json')
+    assert scan(path, checkpoint) == totals
+
+    db = user_db_factory('0')
+    db._root['new'] = db._root.__class__()
+    db._connection.transaction_manager.commit()
+    db._db.close()
+
+    new_totals = scan(path, checkpoint)
+    assert new_totals == scan(path)
+    [user0] = [uid for uid, name, _, _ in stats if name == 'user0']
+    assert new_totals[user0][1] == totals[user0][1] + 1
+
     stop()
+
+
+def test_resync(tempdir):
+    path = os.path.join(tempdir, 'resync.fs')
+    db = ZODB.DB(ZODB.FileStorage.FileStorage(path))
+    with db.transaction() as conn:
+        conn.root.items = conn.root().__class__()
+    for i in range(30):
+        with db.transaction() as conn:
+            # Data full of zeros looks like transaction lengths
+            conn.root.items[i] = b'\x00' * (i * 37) + b'x'
+    db.close()
+
+    scanner = Scanner(path)
+    try:
+        starts = [pos for pos, _ in scanner.transactions()] + [scanner.size]
+        for start, next_start in zip(starts, starts[1:]):
+            assert scanner.resync(start) == start
+            for pos in (start + 1, (start + next_start) // 2, next_start - 1):
+                assert scanner.resync(pos) == next_start
+    finally:
+        scanner.close()
+
+    totals = scan(path)
+    for workers in (2, 5, 17):
+        assert scan(path, workers=workers) == totals
+
+    # Parts starting at a wrong place are read again from where the
+    # previous part ended
+    resync = Scanner.resync
+    with mock.patch.object(Scanner, 'resync',
+                           lambda self, pos: resync(self, pos) + 1):
+        assert scan(path, workers=5) == totals
@@ -0,0 +1,52 @@
+import pytest
+import time
+import ZEO.tests.testssl
+from ZODB.utils import maxtid
+
+import zerodb
+from zerodb.catalog.query import InRange
+from zerodb.crypto import kdf
+from zerodb.testing import TEST_PASSPHRASE, max_roundtrips
+
+from db import Salary
+
+
+@pytest.fixture(scope="module")
+def wan_db(request, wan_server):
+    zdb = zerodb.DB(wan_server,
+                    username='root', password=TEST_PASSPHRASE,
+                    security=kdf.key_from_password,
+                    server_cert=ZEO.tests.testssl.server_cert,
+                    wait_timeout=11)
+    request.addfinalizer(zdb.disconnect)
+    return zdb
+
+
+def test_wan_latency(wan_db):
+    storage = wan_db._storage
+    oid = wan_db[Salary]._objects._p_oid
+    storage.base._cache.clear()
+
+    # The link really is slow: a round trip can't take less than 2 * 50 ms.
+    # Everything else is checked by counting round trips, not by timing
+    with max_roundtrips(1) as profile:
+        t0 = time.time()
+        storage.loadBefore(oid, maxtid)
+        assert time.time() - t0 >= 0.1
+    assert profile.total("round_trips") == 1
+
+    # ZEO puts loaded records to the cache right after returning them
+    deadline = time.time() + 5
+    while oid not in storage._cache.current and time.time() < deadline:
+        time.sleep(0.01)
+    with max_roundtrips(0):
+        storage.loadBefore(oid, maxtid)
+
+    wan_db._connection.cacheMinimize()
+    storage.base._cache.clear()
+    storage._in_flight.clear()
+    with max_roundtrips(10) as profile:
+        result = wan_db[Salary].query(InRange("salary", 130000, 180000),
+                                      sort_index="salary", limit=5)
+        assert len(result) == 5
+    assert profile.total("round_trips") > 0
@@ -1,15 +1,126 @@
+import six
 from zerodbext.catalog.catalog import ResultSetSize
 from zerodbext.catalog.catalog import Catalog as _Catalog
+from zerodbext.catalog.catalog import assertint
+from zerodbext.catalog.query import parse_query
 from zerodb import trees
+from zerodb.catalog.query import Contains, Eq, _is_text, _keys
+from zerodb.storage import estimate_length, prefetch_trees
+from zerodb.util import explain
+from zerodb.util.iter import Sliceable
+
+# TreeSets of results estimated to be shorter are counted exactly (their
+# buckets are fetched at once), longer ones only estimated
+exact_length_limit = 1000
 
 
 class Catalog(_Catalog):
     family = trees.family32
 
+    def index_docs(self, docs):
+        """
+        Register many (docid, obj) pairs in indexes of this catalog.
+        Indexes which support it process the whole batch at once, so that
+        tree traversals are done once per index rather than once per document
+        """
+        docs = list(docs)
+        for docid, _ in docs:
+            assertint(docid)
+        for index in self.values():
+            if hasattr(index, "index_docs"):
+                index.index_docs(docs)
+            else:
+                for docid, obj in docs:
+                    index.index_doc(docid, obj)
+
+    def _sortable(self, result):
+        """
+        Set-like object with the same docids as result, its size and whether
+        the size is exact. Tries to avoid reading all the docids: sizes of
+        big TreeSets are only estimated
+        """
+        IF = self.family.IF
+        container = getattr(result, "container", None)
+        if isinstance(container, IF.TreeSet):
+            size = estimate_length(container)
+            if size > exact_length_limit:
+                return container, size, False
+            prefetch_trees([container])
+            return container, len(container), True
+        if isinstance(result, Sliceable):
+            result = IF.Set(result)
+        elif not isinstance(result, (IF.Set, IF.TreeSet, IF.Bucket)):
+            result = IF.Set(result)
+        return result, len(result), True
+
+    def ordered_by_docid(self, result):
+        """
+        Whether query result is a set or a stream of docids in increasing
+        order, which can be continued after some docid
+        """
+        IF = self.family.IF
+        container = getattr(result, "container", result)
+        if isinstance(container, (IF.Set, IF.TreeSet, IF.Bucket)):
+            return True
+        return isinstance(result, Sliceable) and result.ordered
+
+    def _after(self, result, after):
+        """
+        Docids of result greater than after. Result should be ordered by docid
+        """
+        if not self.ordered_by_docid(result):
+            raise ValueError("Can only continue results ordered by docid "
+                             "or by sort_index")
+        return _keys(self.family.IF, result, after, excludemin=True)
+
+    def query(self, queryobject, sort_index=None, limit=None, sort_type=None,
+              reverse=False, names=None, after=None):
+        """
+        Same as zerodbext's query, but can continue results after some point
+        (keyset pagination).
+
+        :param after: (value, docid) of the last result when sort_index is
+            used, otherwise last docid
+        """
+        if isinstance(queryobject, six.string_types):
+            queryobject = parse_query(queryobject)
+        if limit and not sort_index and isinstance(queryobject, (Contains, Eq)) \
+                and _is_text(queryobject, self):
+            # Results come in relevance order, so the text index only needs
+            # to score docs which can get within limit
+            results = queryobject._apply(self, names, limit=limit)
+        else:
+            results = queryobject._apply(self, names)
+        with explain.section("sort"):
+            return self.sort_result(results, sort_index, limit, sort_type,
+                                    reverse, after=after)
+
     def sort_result(self, result, sort_index=None, limit=None, sort_type=None,
-                    reverse=False):
+                    reverse=False, after=None):
+
+        if after is not None:
+            if not limit or sort_type is not None or reverse and not sort_index:
+                raise ValueError("Continuing results needs limit and can't "
+                                 "use sort_type or reverse without sort_index")
+            if not sort_index:
+                result = self._after(result, after)
+                return ResultSetSize(limit, None), result
+
+        if sort_index and limit and sort_type is None and \
+                hasattr(self[sort_index], "sort_topk"):
+            docids, total, exact = self._sortable(result)
+            result = self[sort_index].sort_topk(
+                docids, limit, total, reverse=reverse, after=after)
+            if len(result) < limit and after is None:
+                # Seen all of them
+                total, exact = len(result), True
+            size = ResultSetSize(len(result), total)
+            size.estimated = not exact
+
+        elif after is not None:
+            raise ValueError("Index %s can't continue results" % sort_index)
 
-        if sort_index:
+        elif sort_index:
             result = set(result)
             numdocs = total = len(result)
             index = self[sort_index]
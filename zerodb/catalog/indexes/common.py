@@ -19,7 +19,7 @@ class CallableDiscriminatorMixin(object):
             self.discriminator = discriminator
             self.discriminator_callable = False
 
-    def index_doc(self, docid, obj):
+    def _discriminate(self, obj):
         if self.discriminator_callable:
             # Model class definition has a list of virtual fields
             virtuals = getattr(obj.__class__, "_z_virtual_fields", {})
@@ -31,6 +31,10 @@ class CallableDiscriminatorMixin(object):
                     value = _marker
         else:
             value = getattr(obj, self.discriminator, _marker)
+        return value
+
+    def index_doc(self, docid, obj):
+        value = self._discriminate(obj)
 
         if value is _marker:
             # unindex the previous value
@@ -54,3 +58,30 @@ class CallableDiscriminatorMixin(object):
             self._not_indexed.remove(docid)
 
         return super(CatalogIndex, self).index_doc(docid, value)
+
+    def index_docs(self, docs):
+        """
+        Index many documents at once
+
+        :param list docs: (docid, obj) pairs
+        """
+        values = []
+        for docid, obj in docs:
+            value = self._discriminate(obj)
+            if value is _marker or isinstance(value, (Persistent, Broken)):
+                # Rare cases, index_doc knows how to handle them
+                self.index_doc(docid, obj)
+            else:
+                if docid in self._not_indexed:
+                    self._not_indexed.remove(docid)
+                values.append((docid, value))
+        if values:
+            self._index_values(values)
+
+    def _index_values(self, values):
+        """
+        Index already discriminated (docid, value) pairs.
+        Indexes which can batch tree traversals override this
+        """
+        for docid, value in values:
+            super(CatalogIndex, self).index_doc(docid, value)
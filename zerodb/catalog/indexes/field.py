@@ -1,3 +1,4 @@
+import heapq
 import itertools as it
 
 import six
@@ -8,12 +9,41 @@ from zerodbext.catalog.indexes.common import CatalogIndex
 from zerodbext.catalog import RangeValue
 from zerodb import trees
 from zerodb.catalog.indexes.common import CallableDiscriminatorMixin
+from zerodb.storage import estimate_length, parallel_traversal, prefetch, prefetch_trees
 from zerodb.util.iter import ListPrefetch
 
 _marker = ()
 
 threshold = 10
 
+# How many keys we're ready to look at to estimate number of docs in a range
+estimate_keys_limit = 100
+
+# Top-k sort reads values of this many candidates from _rev_index at once
+sort_batch_size = 1000
+
+
+class _Reversed(object):
+    """
+    Reverses order of values for heapq
+    """
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __gt__(self, other):
+        return self.value < other.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
 
 def multiunion1(set_type, seqs):
     result = set_type()
@@ -75,7 +105,126 @@ class CatalogFieldIndex(CallableDiscriminatorMixin, _CatalogFieldIndex):
         elif isinstance(docs, tuple):
             return Set(docs)
         else:
-            return ListPrefetch(lambda: iter(docs))
+            return ListPrefetch(lambda: iter(docs), ordered=True, container=docs)
+
+    def _docs_length(self, docs):
+        if docs is None:
+            return 0
+        elif isinstance(docs, six.integer_types):
+            return 1
+        elif isinstance(docs, tuple):
+            return len(docs)
+        else:
+            return estimate_length(docs)
+
+    def estimateEq(self, value):
+        """
+        Estimated number of docs for Eq query. Posting sets are not fetched
+        """
+        return self._docs_length(self._fwd_index.get(value, None))
+
+    def estimateInRange(self, start, end, excludemin=False, excludemax=False):
+        """
+        Estimated number of docs in range. If the range has too many keys,
+        we just say that it covers all the docs
+        """
+        docsets = list(it.islice(
+            self._fwd_index.values(
+                start, end, excludemin=excludemin, excludemax=excludemax),
+            estimate_keys_limit + 1))
+        if len(docsets) > estimate_keys_limit:
+            return self._num_docs.value
+        prefetch(docsets)
+        return sum(map(self._docs_length, docsets))
+
+    def filter_docids(self, docids, predicate):
+        """
+        Check value of each of docids against predicate using the reverse
+        index, without fetching posting sets for the value
+
+        :param docids: Candidate docids
+        :param callable predicate: Function value -> bool
+        :returns: Set of docids which pass
+        """
+        docids = list(docids)
+        parallel_traversal(self._rev_index, docids)
+        rev_index = self._rev_index
+        result = []
+        for docid in docids:
+            value = rev_index.get(docid, _marker)
+            if value is not _marker and predicate(value):
+                result.append(docid)
+        return self.family.IF.Set(result)
+
+    def get_values(self, docids, default=None):
+        """
+        Values of docids from the reverse index (so, without loading the
+        documents), in the same order
+
+        :param docids: Docids
+        :param default: Value for docids which are not indexed
+        :returns: List of values
+        """
+        docids = list(docids)
+        parallel_traversal(self._rev_index, docids)
+        rev_index = self._rev_index
+        return [rev_index.get(docid, default) for docid in docids]
+
+    def _count(self, docs):
+        if isinstance(docs, six.integer_types):
+            return 1
+        else:
+            return len(docs)
+
+    def value_counts(self, docids=None):
+        """
+        Number of docs for each value. Posting sets are counted when docids
+        is None, otherwise values of docids are read from the reverse index
+
+        :param docids: Docids to count values for, or None for all docs
+        :returns: Dict value -> number of docs
+        """
+        if docids is None:
+            prefetch_trees([self._fwd_index])
+            items = list(self._fwd_index.items())
+            prefetch_trees([docs for _, docs in items])
+            return {value: self._count(docs) for value, docs in items}
+
+        counts = {}
+        docids = iter(docids)
+        while True:
+            batch = list(it.islice(docids, sort_batch_size))
+            if not batch:
+                return counts
+            for value in self.get_values(batch, _marker):
+                if value is not _marker:
+                    counts[value] = counts.get(value, 0) + 1
+
+    def _extreme_value(self, docids, size, reverse):
+        if docids is None:
+            try:
+                if reverse:
+                    return self._fwd_index.maxKey()
+                else:
+                    return self._fwd_index.minKey()
+            except ValueError:
+                return None
+        top = self.sort_topk(docids, 1, size, reverse=reverse)
+        if top:
+            return self._rev_index[top[0]]
+
+    def min_value(self, docids=None, size=None):
+        """
+        Smallest value of docids (of all docs if None), or None if nothing
+        is indexed. Size of docids helps to choose how to search
+        """
+        return self._extreme_value(docids, size, False)
+
+    def max_value(self, docids=None, size=None):
+        """
+        Largest value of docids (of all docs if None), or None
+        """
+        return self._extreme_value(docids, size, True)
 
     def scan_forward(self, docids, limit=None):
         # Batch-prefetch treesets
@@ -98,18 +247,132 @@ class CatalogFieldIndex(CallableDiscriminatorMixin, _CatalogFieldIndex):
                         if limit and n >= limit:
                             raise StopIteration
 
-    def index_doc(self, docid, obj):
-        if self.discriminator_callable:
-            # Model class definition has a list of virtual fields
-            virtuals = getattr(obj.__class__, "_z_virtual_fields", {})
-            value = virtuals.get(self.discriminator, _marker)
-            if value != _marker:
-                try:
-                    value = value(obj)
-                except:
-                    value = _marker
+    def _items_reversed(self, tree, start=_marker):
+        """
+        Items of tree (up to start) from the last one, walking raw states of
+        tree nodes backwards: buckets are only linked forwards
+        """
+        state = tree.__getstate__()
+        if not state:
+            return
+        state = state[0]
+        if len(state) == 1 and isinstance(state[0], tuple):
+            # The only bucket is inlined in the tree state
+            for item in self._bucket_items_reversed(state[0][0], start):
+                yield item
+            return
+
+        # state = (child, key, child, ... , key, child)
+        for i in range(len(state) - 1, -1, -2):
+            if start is not _marker and i > 0 and state[i - 1] > start:
+                continue
+            child = state[i]
+            if isinstance(child, type(tree)):
+                for item in self._items_reversed(child, start):
+                    yield item
+            else:
+                for item in self._bucket_items_reversed(
+                        child.__getstate__()[0], start):
+                    yield item
+
+    def _bucket_items_reversed(self, items, start):
+        for i in range(len(items) - 2, -1, -2):
+            if start is _marker or items[i] <= start:
+                yield items[i], items[i + 1]
+
+    def _scan_items(self, reverse=False, start=_marker):
+        """
+        Items of _fwd_index from start, prefetching posting TreeSets in
+        batches
+        """
+        if reverse:
+            items = self._items_reversed(self._fwd_index, start)
+        elif start is _marker:
+            items = iter(self._fwd_index.items())
         else:
-            value = getattr(obj, self.discriminator, _marker)
+            items = iter(self._fwd_index.items(min=start))
+        while True:
+            batch = list(it.islice(items, ListPrefetch.prefetch_size))
+            if not batch:
+                break
+            prefetch([docs for _, docs in batch if isinstance(docs, Persistent)])
+            for item in batch:
+                yield item
+
+    def _scan_topk(self, docids, limit, reverse=False, after=None):
+        """
+        Go through _fwd_index in order and pick docids which are in docids
+        """
+        if after is None:
+            start = _marker
+        else:
+            start, after_docid = after
+        result = []
+        for value, curdocids in self._scan_items(reverse, start):
+            if isinstance(curdocids, six.integer_types):
+                curdocids = (curdocids,)
+            for docid in curdocids:
+                if after is not None and value == start and docid <= after_docid:
+                    continue
+                if docid in docids:
+                    result.append(docid)
+                    if len(result) >= limit:
+                        return result
+        return result
+
+    def _heap_topk(self, docids, limit, reverse=False, after=None):
+        """
+        Read values of all docids from _rev_index in batches and keep the best
+        """
+        rev_index = self._rev_index
+
+        def pairs():
+            iterator = iter(docids)
+            while True:
+                batch = list(it.islice(iterator, sort_batch_size))
+                if not batch:
+                    break
+                parallel_traversal(rev_index, batch)
+                for docid in batch:
+                    value = rev_index.get(docid, _marker)
+                    if value is not _marker:
+                        yield value, docid
+
+        if reverse:
+            key = lambda pair: (_Reversed(pair[0]), pair[1])
+        else:
+            key = None
+        candidates = pairs()
+        if after is not None:
+            after = key(after) if key else after
+            candidates = (pair for pair in candidates
+                          if (key(pair) if key else pair) > after)
+        return [docid for _, docid in heapq.nsmallest(limit, candidates, key=key)]
+
+    def sort_topk(self, docids, limit, size, reverse=False, after=None):
+        """
+        First limit docids sorted by value of this index (and by docid when
+        values are equal, in both directions).
+        Scanning the index in order needs about limit * numdocs / size steps
+        (if docids are spread evenly), reading values of all docids needs
+        size steps, we do what's cheaper
+
+        :param docids: Set-like docids to sort (with cheap membership check)
+        :param int limit: Number of docids to return
+        :param int size: (Estimated) number of docids
+        :param tuple after: (value, docid) to continue after (for pagination)
+        :returns: List of docids
+        """
+        numdocs = self._num_docs.value
+        if not numdocs or not size:
+            return []
+        if limit * numdocs < size * size:
+            return self._scan_topk(docids, limit, reverse=reverse, after=after)
+        else:
+            return self._heap_topk(docids, limit, reverse=reverse, after=after)
+
+    def index_doc(self, docid, obj):
+        value = self._discriminate(obj)
 
         if value is _marker:
             # unindex the previous value
@@ -134,6 +397,20 @@ class CatalogFieldIndex(CallableDiscriminatorMixin, _CatalogFieldIndex):
 
         return self.inner_index_doc(docid, value)
 
+    def _index_values(self, values):
+        # Fill up cache for all the documents at once
+        docids, keys = zip(*values)
+        parallel_traversal(self._rev_index, docids)
+        parallel_traversal(self._fwd_index, keys)
+        # Buckets of big TreeSets where new docids will land
+        docsets = [(self._fwd_index.get(k), d) for d, k in values]
+        docsets = [(s, d) for s, d in docsets
+                   if isinstance(s, self.family.IF.TreeSet)]
+        if docsets:
+            parallel_traversal(*zip(*docsets))
+        for docid, value in values:
+            self.inner_index_doc(docid, value)
+
     def inner_index_doc(self, docid, value):
         """See interface IInjection"""
         rev_index = self._rev_index
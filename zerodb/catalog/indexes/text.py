@@ -28,11 +28,32 @@ class CatalogTextIndex(CallableDiscriminatorMixin, _CatalogTextIndex):
         ZopeTextIndex.__init__(self, lexicon, index)
         self.clear()
 
+    def _index_values(self, values):
+        if hasattr(self.index, "index_docs"):
+            self.index.index_docs(values)
+        else:
+            super(CatalogTextIndex, self)._index_values(values)
+
+    def estimateContains(self, querytext):
+        if hasattr(self.index, "estimate_size"):
+            return self.index.estimate_size(querytext)
+
+    estimateEq = estimateContains
+
+    def applyContains(self, value, limit=None):
+        """
+        :param int limit: Only this many of the most relevant docs are needed
+        """
+        return self.apply(value, count=limit)
+
+    applyEq = applyContains
+
     def apply(self, querytext, start=0, count=None):
         # For now, let's parse querytext ourselves
         # and later make the queryparser capable to be iterative
         if hasattr(self.index, "_search_all"):
-            return Sliceable(lambda: self.index._search_all(querytext))
+            return Sliceable(
+                lambda: self.index._search_all(querytext, limit=count))
         else:
             return super(CatalogTextIndex, self).apply(
                     querytext, start=start, count=count)
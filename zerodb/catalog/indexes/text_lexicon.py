@@ -1,3 +1,5 @@
+from itertools import chain
+
 from BTrees.Length import Length
 from zope.index.text.lexicon import Lexicon as _Lexicon
 
@@ -48,6 +50,24 @@ class Lexicon(_Lexicon):
         parallel_traversal(self._wids, last)
         return list(map(self._getWordIdCreate, last))
 
+    def sourcesToWordIds(self, texts):
+        """
+        Same as sourceToWordIds, but for many texts with one tree traversal
+        """
+        words = []
+        for text in texts:
+            if text is None:
+                text = ''
+            last = _text2list(text)
+            for element in self._pipeline:
+                last = element.process(last)
+            words.append(last)
+        if not isinstance(self.wordCount, Length):
+            self.wordCount = Length(self.wordCount())
+        self.wordCount._p_deactivate()
+        parallel_traversal(self._wids, sorted(set(chain(*words))))
+        return [list(map(self._getWordIdCreate, last)) for last in words]
+
     def termToWordIds(self, text):
         last = _text2list(text)
         for element in self._pipeline:
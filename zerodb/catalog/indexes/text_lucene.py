@@ -5,9 +5,9 @@ import logging
 import six
 from BTrees.Length import Length
 from BTrees.OOBTree import TreeSet as SortedSet  # sorted set implemented in C
-from collections import Counter, defaultdict
+from collections import Counter
 from itertools import islice
-from six.moves import zip as izip, map as imap, xrange
+from six.moves import zip as izip, map as imap
 from math import sqrt, log
 from persistent import Persistent
 from zope.interface import implementer
@@ -20,6 +20,11 @@ from zope.index.text.queryparser import _tokenizer_regex
 from zerodb.storage import prefetch, parallel_traversal
 from zerodb.catalog.indexes.pwid import PersistentWid
 
+# Phrase search checks candidates in batches starting with this size
+# and doubling up to the max
+phrase_batch_size = 20
+phrase_batch_size_max = 1000
+
 
 class LengthyTree(object):
     def __init__(self, obj, L):
@@ -203,6 +208,48 @@ class IncrementalLuceneIndex(Persistent):
 
         return len(wids)
 
+    def index_docs(self, docs):
+        """
+        Index many (docid, text) pairs at once.
+        Tree traversals are done once for the whole batch rather than per doc
+        """
+        docs = list(docs)
+        parallel_traversal(self._docwords, [docid for docid, _ in docs])
+        new_docs = []
+        for docid, text in docs:
+            if docid in self._docwords:
+                self._reindex_doc(docid, text)
+            else:
+                new_docs.append((docid, text))
+        if not new_docs:
+            return
+
+        docids, texts = zip(*new_docs)
+        all_wids = self._lexicon.sourcesToWordIds(texts)
+
+        docscores = []
+        all_widset = set()
+        for docid, wids in izip(docids, all_wids):
+            widcnt = Counter(wids)
+            self._docwords[docid] = PersistentWid.encode_wid(
+                wids if self.keep_phrases else widcnt.keys())
+            docscores.append(self._get_widscores(widcnt, docid))
+            all_widset.update(widcnt)
+
+        if all_widset:
+            weights, lengths = self._get_doctrees(list(all_widset))
+            parallel_traversal(*zip(*[
+                (weights[w], score)
+                for scores in docscores for w, score in scores.items()]))
+            prefetch(list(lengths.values()) + [self.documentCount])
+
+            for scores in docscores:
+                for w, score in scores.items():
+                    weights[w].add(score)
+                    lengths[w].change(1)
+
+        self.documentCount.change(len(new_docs))
+
     def _reindex_doc(self, docid, text):
         # We should change Length only for new wids used
         old_wids = self.get_words(docid)
@@ -296,19 +343,22 @@ class IncrementalLuceneIndex(Persistent):
         """
         return [(LengthyTree(*self._wordinfo[w]), self.idf2(w)) for w in wids]
 
-    def search(self, term):
+    def search(self, term, limit=None):
         wids = self._lexicon.termToWordIds(term)
         wids = self._remove_oov_wids(wids)
         if not wids:
             return []
-        return mass_weightedUnion(self._search_wids(wids))
+        return mass_weightedUnion(self._search_wids(wids), limit=limit)
 
     def search_glob(self, pattern):
         wids = self._lexicon.globToWordIds(pattern.lower())
         wids = self._remove_oov_wids(wids)
         return mass_weightedUnion(self._search_wids(wids))
 
-    def _search_all(self, term):
+    def _query_wids(self, term):
+        """
+        Word ids for all words and globs in the query (which are in the index)
+        """
         tokens = [t.lower() for t in _tokenizer_regex.findall(term)]
         glob_cond = lambda t: ('?' in t) or ('*' in t)
         glob_tokens = filter(glob_cond, tokens)
@@ -316,159 +366,223 @@ class IncrementalLuceneIndex(Persistent):
         wids = set()
         wids.update(self._lexicon.termToWordIds(word_tokens))
         wids.update(itertools.chain(*map(self._lexicon.globToWordIds, glob_tokens)))
-        wids = self._remove_oov_wids(wids)
+        return list(self._remove_oov_wids(wids))
+
+    def estimate_size(self, term):
+        """
+        Upper estimate of number of docs matching the query.
+        Uses Length of each word's doc list, doesn't fetch any doc lists
+        """
+        wids = self._query_wids(term)
+        lengths = [self._wordinfo[w][1] for w in wids]
+        prefetch(lengths + [self.documentCount])
+        return min(sum(l.value for l in lengths), self.documentCount.value)
+
+    def _search_all(self, term, limit=None):
+        term = term.strip()
+        if self.keep_phrases and len(term) > 1 and \
+                term[0] == term[-1] == '"' and '"' not in term[1:-1]:
+            # The whole query is one phrase
+            return imap(lambda x: x[0],
+                        islice(self.search_phrase(term[1:-1]), limit))
+        wids = self._query_wids(term)
         # XXX
         # We should have OrderedDict-like lazy objects
         # and we should have weightedIntersection and weightedUnion
         # working lazily in a for of zerodbext.catalog
         # This is just a workaround for simpler queries
         # XXX
-        return imap(lambda x: x[0], mass_weightedUnion(self._search_wids(wids)))
+        return imap(lambda x: x[0],
+                    mass_weightedUnion(self._search_wids(wids), limit=limit))
 
     def search_phrase(self, phrase):
-        # Need to do mass_weightedIntersection here.
-        # Simplest version of it would be:
-        #   fetch (score, docid) info for the rarest keyword
-        #   find same docids in different keywords
-        #   do intersection in memory
-        #   fetch widcode to search for phrase
-        # XXX we'd require to maintain also BTree(docid -> score)
-        raise NotImplementedError
+        """
+        Lazily find docs which contain the phrase.
+        Candidates come from the rarest word of the phrase (most relevant
+        first), so they already contain it. Widcodes of candidates are fetched
+        in batches and checked for the phrase words going one after another
+        (which also checks that the other words are there).
 
+        Without keep_phrases word order isn't stored, so this is the same
+        as search of the words.
 
-def mass_weightedUnion(L):
+        :returns: iterable of (docid, score) ordered by score of the rarest word
+        """
+        if not self.keep_phrases:
+            return self.search(phrase)
+        wids = self._lexicon.termToWordIds(phrase)
+        if not wids or 0 in wids:
+            return iter([])
+        widset = list(set(wids))
+        parallel_traversal(self._wordinfo, widset)
+        records = [self._wordinfo.get(w) for w in widset]
+        if None in records:
+            return iter([])
+        prefetch([length for _, length in records] + [self.documentCount])
+        rarest = min(izip(widset, records), key=lambda x: x[1][1].value)[0]
+        return self._search_phrase(wids, rarest)
+
+    def _search_phrase(self, wids, rarest):
+        tree, _ = self._wordinfo[rarest]
+        weight = self.idf2(rarest)
+        size = len(wids)
+        it = iter(tree)
+        batch_size = phrase_batch_size
+        while True:
+            batch = list(islice(it, batch_size))
+            if not batch:
+                break
+            docids = [docid for _, docid in batch]
+            parallel_traversal(self._docwords, docids)
+            prefetch([self._docwords[docid] for docid in docids])
+            for score, docid in batch:
+                docwids = self.get_words(docid)
+                if size == 1 or any(
+                        docwids[i:i + size] == wids
+                        for i, w in enumerate(docwids) if w == wids[0]):
+                    yield docid, -score * weight
+            batch_size = min(batch_size * 2, phrase_batch_size_max)
+
+
+def mass_weightedUnion(L, limit=None):
     """
     Incremental version of mass_weightedUnion
     :param list L: (TreeSet((-score, docid)), weight) elements
+    :param int limit: Stop after this many docs
     :returns: iterable ordered from large to small sum(score*weight)
     """
-    cache_size = 40
-    order_size = 15
-    order_violation = 3
-    cache_updated = None
-
     if len(L) == 0:
-        return
+        return iter([])
 
     elif len(L) == 1:
         # Trivial
         tree, weight = L[0]
-        # XXX need to make it possible to advance the tree N elements ahead!
-        for (score, docid) in tree:
-            yield (docid, -score * weight)
+        return islice(((docid, -score * weight) for score, docid in tree), limit)
 
     else:
-        # XXX make into an iterator class
-
-        trees, weights = zip(*L)
-        prefetch(trees)
-        prefetch([x._firstbucket for x in trees if x._firstbucket is not None])
-
-        unread_max = [-t.minKey()[0] * w for t, w in L]
-        lengths = map(len, trees)
-        iters = dict(enumerate(map(iter, trees)))
-        caches = [{} for i in range(len(L))]
-        docid2cacheid = defaultdict(list)
-        cache_len = None
-        maxscores = [-1] * len(L)
-        used = set()
-        sorted_mins = SortedSet()  # Contains tuples (-min_weight, docid)
-        mins_dict = {}  # {docid -> min_weight}
-        docids = []
-
-        def precache(i, size):
-            try:
-                for j in xrange(size):
-                    score, docid = next(iters[i])
-                    score = -score * weights[i]
-                    if unread_max[i] > score:
-                        unread_max[i] = score
-                    if docid not in used:
-                        caches[i][docid] = score
-                        docid2cacheid[docid].append(i)
-                        if maxscores[i] < 0:
-                            maxscores[i] = score
-
-                        # documents are not repeated in iterators
-                        # it means that for the iterator i we didn't meet docid before
-                        # which means that we should just add score to the current minscore
-                        total_score = mins_dict.get(docid, 0.0) + score
-                        if docid in mins_dict:
-                            sorted_mins.remove((-mins_dict[docid], docid))
-                        mins_dict[docid] = total_score
-                        sorted_mins.add((-total_score, docid))
-            except StopIteration:
-                del iters[i]
-                unread_max[i] = 0
+        return WeightedUnion(L, limit=limit)
 
-        while True:
-            # Main cycle in which we yield values to make an iterator
-
-            # Advance iterators when needed / fill caches to keep them long enough
-            # Perhaps, some better algorithm is needed to pre-read, this is the simplest
-
-            cache_updated = False
-            for i in list(iters.keys()):
-                cache = caches[i]
-                if len(cache) < cache_size / 2:
-                    precache(i, cache_size - len(cache))
-                    cache_len = sum(map(len, caches))
-                    cache_updated = True
-
-            if cache_updated or (cache_len is not None and (cache_len > order_violation) and (len(docids) < order_violation)):
-                while True:
-                    max_sum = sum(unread_max)
-                    mins = []
-                    docids = []
-                    maxs = []
-                    for w, docid in islice(iter(sorted_mins), order_size):
-                        mins.append(-w)
-                        docids.append(docid)
-                        cacheids = docid2cacheid[docid]
-                        # Slower equivalent:
-                        # maxs = sum(c.get(docid, m) for c, m in izip(caches, unread_max))
-                        # because
-                        # -w   = sum(c.get(docid, 0) for c, m in izip(caches, unread_max))
-                        maxs.append(max_sum - sum(unread_max[i] for i in cacheids) - w)
-                    violated = False
-                    for i in xrange(len(mins) - order_violation - 1):
-                        # Naive implementation. Can go from tail and do faster
-                        # in batches of size of order_violation
-                        for m in maxs[i + order_violation:]:
-                            if m > mins[i]:
-                                violated = True
-                                break
-                        if violated:
-                            break
-                    if len(mins) == order_size:
-                        # Last check: can the order be violated by out-of-cache elements?
-                        if mins[len(mins) - order_violation] < max_sum:
-                            violated = True
-                    if not violated:
-                        break
-                    else:
-                        # XXX instead we could download enough elements to change
-                        # sum(unread_max) by much enough
-                        # We need something like "advance_to" method
-                        precache(
-                                max(enumerate(m / max(l - len(c), 1) for m, l, c in izip(unread_max, lengths, caches)), key=lambda x: x[1])[0],
-                                cache_size / 2)
-                        cache_len = sum(map(len, caches))
-
-            if not docids:
+
+class WeightedUnion(six.Iterator):
+    """
+    Lazy union of posting lists sorted by score (MaxScore-like).
+
+    For every term we keep an upper bound of scores we haven't read yet (the
+    last score read from it). A doc seen in some of the terms has a known
+    score (lower bound) and an upper bound: known score plus bounds of the
+    terms it wasn't seen in yet.
+
+    The best known doc is returned once nothing unread can beat it and no
+    more than order_violation of the seen docs possibly can. Otherwise, we
+    read the next block of the term with the highest bound, which tightens
+    the bounds the most. Blocks double up to the bucket size, so long posting
+    lists take few round trips, and nothing more is read after limit docs
+    """
+    block_size = 40
+    max_block_size = 500  # max_leaf_size of OO trees
+    order_violation = 3
+
+    def __init__(self, L, limit=None):
+        self.trees, self.weights = zip(*L)
+        self.limit = limit
+        self.returned = 0
+
+        prefetch(self.trees)
+        prefetch([x._firstbucket for x in self.trees if x._firstbucket is not None])
+
+        self.iters = {i: iter(t) for i, t in enumerate(self.trees)}
+        self.block_sizes = [self.block_size] * len(L)
+        self.unread_max = [-t.minKey()[0] * w if len(t) else 0.0 for t, w in L]
+        self.known = {}  # {docid -> (score, frozenset of terms seen)}
+        self.sorted_known = SortedSet()  # Contains tuples (-score, docid)
+        self.used = set()
+        self.pruned = set()  # Docs which can't get within limit
+        self.scored = 0  # Postings added to scores of docs
+
+    def __iter__(self):
+        return self
+
+    def _read(self, i):
+        """
+        Read the next block of the term i
+        """
+        weight = self.weights[i]
+        size = self.block_sizes[i]
+        self.block_sizes[i] = min(size * 2, self.max_block_size)
+        block = list(islice(self.iters[i], size))
+        threshold = self._threshold()
+        # Most a doc first seen here can get from the other terms
+        rest = sum(self.unread_max) - self.unread_max[i]
+        for score, docid in block:
+            if docid in self.used or docid in self.pruned:
+                continue
+            score = -score * weight
+            total, terms = self.known.get(docid, (0.0, frozenset()))
+            if terms:
+                self.sorted_known.remove((-total, docid))
+            elif threshold is not None and score + rest <= threshold:
+                self.pruned.add(docid)
+                continue
+            self.scored += 1
+            self.known[docid] = (total + score, terms | {i})
+            self.sorted_known.add((-total - score, docid))
+        if len(block) < size:
+            # Nothing left in this tree
+            del self.iters[i]
+            self.unread_max[i] = 0.0
+        else:
+            self.unread_max[i] = -block[-1][0] * weight
+
+    def _threshold(self):
+        """
+        Score which docs should beat to be returned within limit: the lowest
+        of known scores of the best docs left to return (MaxScore). Known
+        scores only grow, so a doc below it stays out
+        """
+        if self.limit is None:
+            return None
+        left = self.limit - self.returned
+        if len(self.sorted_known) < left:
+            return None
+        return -next(islice(self.sorted_known, left - 1, None))[0]
+
+    def _upper(self, docid):
+        score, terms = self.known[docid]
+        return score + sum(m for i, m in enumerate(self.unread_max) if i not in terms)
+
+    def _can_return(self, score):
+        """
+        Whether the best known doc (with known score) can be returned already
+        """
+        unread = sum(self.unread_max)
+        if unread > score:
+            return False
+        violations = 0
+        for w, docid in islice(self.sorted_known, 1, None):
+            if -w + unread <= score:
+                # Neither this doc nor the ones after it can beat the best
                 break
-            minw = mins.pop(0)
-            maxw = maxs.pop(0)
-            docid = docids.pop(0)
-            for i, c in enumerate(caches):
-                if docid in c:
-                    if c[docid] == unread_max[i]:
-                        del c[docid]
-                        unread_max[i] = max(six.itervalues(c))
-                    else:
-                        del c[docid]
-                    cache_len -= 1
-            used.add(docid)
-            sorted_mins.remove((-minw, docid))
-            del mins_dict[docid]
-            yield docid, (minw + maxw) / 2.0
+            if self._upper(docid) > score:
+                violations += 1
+                if violations > self.order_violation:
+                    return False
+        return True
+
+    def __next__(self):
+        if self.limit is not None and self.returned >= self.limit:
+            raise StopIteration
+        while True:
+            if self.sorted_known:
+                w, docid = self.sorted_known.minKey()
+                if not self.iters or self._can_return(-w):
+                    break
+            elif not self.iters:
+                raise StopIteration
+            self._read(max(self.iters, key=lambda i: self.unread_max[i]))
+
+        maxw = self._upper(docid)
+        self.sorted_known.remove((w, docid))
+        del self.known[docid]
+        self.used.add(docid)
+        self.returned += 1
+        return docid, (-w + maxw) / 2.0
@@ -1,15 +1,78 @@
+from itertools import islice
 from zerodbext.catalog import query
 from zerodb import trees
-from zerodb.util.iter import Sliceable
+from zerodb.util import explain
+from zerodb.util.iter import Sliceable, merge_unique
 
 
 def _to_set(flavor, data):
-    if isinstance(data, Sliceable):
-        return flavor.Set(data)
+    if isinstance(data, _Union):
+        return data.to_set()
+    elif isinstance(data, Sliceable):
+        if isinstance(data.container, (flavor.Set, flavor.TreeSet)):
+            return data.container
+        # Read the iterator once, without caching every item
+        return flavor.Set(data.f())
     else:
         return data
 
 
+def _keys(IF, data, min, excludemin=False):
+    """
+    Docids of an ordered result from min on, without reading the ones before
+    """
+    container = getattr(data, "container", data)
+    if isinstance(container, (IF.Set, IF.TreeSet, IF.Bucket)):
+        return container.keys(min=min, excludemin=excludemin)
+    if isinstance(data, _Union):
+        return data.keys(min=min, excludemin=excludemin)
+    return (docid for docid in data
+            if docid > min or docid == min and not excludemin)
+
+
+def _is_ordered(IF, data):
+    """
+    Whether query result is a stream of docids in increasing order
+    (and without weights which we'd lose)
+    """
+    if isinstance(data, Sliceable):
+        return data.ordered
+    else:
+        return isinstance(data, (IF.Set, IF.TreeSet))
+
+
+class _Union(Sliceable):
+    """
+    Union of ordered results, merged lazily when iterated. Its length needs
+    all the docids: they are read in one pass into a set, which is kept for
+    set operations
+    """
+
+    def __init__(self, IF, results):
+        self.IF = IF
+        self.results = results
+        self._set = None
+        super(_Union, self).__init__(
+            lambda: merge_unique(*[iter(r) for r in results]),
+            ordered=True, length=lambda: len(self.to_set()))
+
+    def keys(self, min=None, excludemin=False):
+        """
+        Docids from min on (like keys of a TreeSet), merged from where each
+        of the results reaches min
+        """
+        if min is None:
+            return iter(self)
+        return merge_unique(*[_keys(self.IF, r, min, excludemin)
+                              for r in self.results])
+
+    def to_set(self):
+        if self._set is None:
+            self._set = self.IF.multiunion(
+                [_to_set(self.IF, r) for r in self.results])
+        return self._set
+
+
 class LogicMixin:
     def __and__(self, right):
         self._check_type("and", right)
@@ -34,8 +97,12 @@ class Contains(LogicMixin, query.Comparator):
     CQE equivalent: 'foo' in index
     """
 
-    def _apply(self, catalog, names):
+    @explain.profiled
+    def _apply(self, catalog, names, limit=None):
         index = self._get_index(catalog)
+        if limit is not None:
+            # Full-text index, see Catalog.query
+            return index.applyContains(self._get_value(names), limit=limit)
         return index.applyContains(self._get_value(names))
 
     def __str__(self):
@@ -49,6 +116,7 @@ class DoesNotContain(LogicMixin, query.Comparator):
     """CQE equivalent: 'foo' not in index
     """
 
+    @explain.profiled
     def _apply(self, catalog, names):
         index = self._get_index(catalog)
         return index.applyDoesNotContain(self._get_value(names))
@@ -61,11 +129,17 @@ class DoesNotContain(LogicMixin, query.Comparator):
 
 
 class Eq(LogicMixin, query.Eq):
-    pass
+    @explain.profiled
+    def _apply(self, catalog, names, limit=None):
+        if limit is not None:
+            # Full-text index, see Catalog.query
+            index = self._get_index(catalog)
+            return index.applyEq(self._get_value(names), limit=limit)
+        return super(Eq, self)._apply(catalog, names)
 
 
 class NotEq(LogicMixin, query.NotEq):
-    pass
+    _apply = explain.profiled(query.NotEq._apply)
 
 
 class Gt(Comparator):
@@ -75,6 +149,7 @@ class Gt(Comparator):
     """
     operator = '>'
 
+    @explain.profiled
     def _apply(self, catalog, names):
         index = self._get_index(catalog)
         return index.applyGt(self._get_value(names))
@@ -90,6 +165,7 @@ class Lt(Comparator):
     """
     operator = '<'
 
+    @explain.profiled
     def _apply(self, catalog, names):
         index = self._get_index(catalog)
         return index.applyLt(self._get_value(names))
@@ -105,6 +181,7 @@ class Ge(Comparator):
     """
     operator = '>='
 
+    @explain.profiled
     def _apply(self, catalog, names):
         index = self._get_index(catalog)
         return index.applyGe(self._get_value(names))
@@ -120,6 +197,7 @@ class Le(Comparator):
     """
     operator = '<='
 
+    @explain.profiled
     def _apply(self, catalog, names):
         index = self._get_index(catalog)
         return index.applyLe(self._get_value(names))
@@ -135,6 +213,7 @@ class InRange(LogicMixin, query.InRange):
                    lower <= index <= upper
     """
 
+    @explain.profiled
     def _apply(self, catalog, names):
         index = self._get_index(catalog)
         return index.applyInRange(
@@ -153,6 +232,7 @@ class NotInRange(LogicMixin, query.NotInRange):
                    not(lower <= index <= upper)
     """
 
+    @explain.profiled
     def _apply(self, catalog, names):
         index = self._get_index(catalog)
         return index.applyNotInRange(
@@ -165,19 +245,19 @@ class NotInRange(LogicMixin, query.NotInRange):
 
 
 class Any(LogicMixin, query.Any):
-    pass
+    _apply = explain.profiled(query.Any._apply)
 
 
 class NotAny(LogicMixin, query.NotAny):
-    pass
+    _apply = explain.profiled(query.NotAny._apply)
 
 
 class All(LogicMixin, query.All):
-    pass
+    _apply = explain.profiled(query.All._apply)
 
 
 class NotAll(LogicMixin, query.NotAll):
-    pass
+    _apply = explain.profiled(query.NotAll._apply)
 
 
 class BoolOp(LogicMixin, query.BoolOp):
@@ -187,13 +267,18 @@ class BoolOp(LogicMixin, query.BoolOp):
 class Or(LogicMixin, query.Or):
     family = trees.family32
 
+    @explain.profiled
     def _apply(self, catalog, names):
-        # XXX Or query can be done lazily using heapq's sorted join
         IF = self.family.IF
-        queries = self.queries
-        result = queries[0]._apply(catalog, names)
-        for q in queries[1:]:
-            next_result = q._apply(catalog, names)
+        results = [q._apply(catalog, names) for q in self.queries]
+
+        if all(_is_ordered(IF, r) for r in results):
+            # Merge docid streams lazily, so that the first results come
+            # before all the posting lists are downloaded
+            return _Union(IF, results)
+
+        result = results[0]
+        for next_result in results[1:]:
             if len(result) == 0:
                 result = next_result
             elif len(next_result) > 0:
@@ -204,23 +289,85 @@ class Or(LogicMixin, query.Or):
 class And(LogicMixin, query.And):
     family = trees.family32
 
+    @explain.profiled
     def _apply(self, catalog, names):
-        # XXX figure out doing smallest part first for performance
         IF = self.family.IF
         queries = self.queries
-        result = queries[0]._apply(catalog, names)
-        for q in queries[1:]:
-            if len(result) == 0:
-                return IF.Set()
-            next_result = q._apply(catalog, names)
+        estimates = [estimate_size(q, catalog, names) for q in queries]
+        if 0 in estimates:
+            return IF.Set()
+
+        # Most selective operands first, those we know nothing about go last
+        order = sorted(range(len(queries)),
+                       key=lambda i: (estimates[i] is None, estimates[i] or 0))
+
+        applied = {}
+        text = [i for i in order if _is_text(queries[i], catalog)]
+        if len(queries) > 1 and len(text) == 1:
+            ranked = applied[text[0]] = queries[text[0]]._apply(catalog, names)
+            if isinstance(ranked, Sliceable) and not ranked.ordered:
+                others = [i for i in order if i != text[0]]
+                return self._apply_ranked(
+                    catalog, names, ranked, estimates[text[0]],
+                    [queries[i] for i in others], [estimates[i] for i in others])
+
+        result = None
+        for i in order:
+            q = queries[i]
+            if result is not None:
+                if len(result) == 0:
+                    return IF.Set()
+                # When we have few candidates left, it's cheaper to check
+                # them one by one than to download a huge posting list
+                if estimates[i] is not None and \
+                        len(result) * filter_ratio < estimates[i]:
+                    filtered = filter_docids(q, catalog, names, result)
+                    if filtered is not None:
+                        result = filtered
+                        continue
+            if i in applied:
+                next_result = applied[i]
+            else:
+                next_result = q._apply(catalog, names)
+            if result is None:
+                result = next_result
+                continue
             if len(next_result) == 0:
                 return IF.Set()
             _, result = IF.weightedIntersection(_to_set(IF, result), _to_set(IF, next_result))
         return result
 
+    def _apply_ranked(self, catalog, names, ranked, ranked_estimate,
+                      queries, estimates):
+        """
+        Intersect full-text search results with other operands keeping
+        relevance order. Very selective operands are applied to get a set of
+        allowed docids, the rest check text search candidates lazily
+        """
+        IF = self.family.IF
+        filters = []
+        rest = []
+        for q, estimate in zip(queries, estimates):
+            f = _filter(q, catalog, names)
+            if f is None or (
+                    estimate is not None and ranked_estimate is not None and
+                    estimate * filter_ratio < ranked_estimate):
+                rest.append(q)
+            else:
+                filters.append(f)
+
+        required = None
+        if rest:
+            required = _to_set(IF, And(*rest)._apply(catalog, names))
+            if len(required) == 0:
+                return IF.Set()
+
+        return Sliceable(
+            lambda: ranked_intersection(ranked, required, filters))
+
 
 class Not(LogicMixin, query.Not):
-    pass
+    _apply = explain.profiled(query.Not._apply)
 
 
 class Name(LogicMixin, query.Name):
@@ -228,3 +375,186 @@ class Name(LogicMixin, query.Name):
 
 optimize = query.optimize
 parse_query = query.parse_query
+
+# And checks remaining candidates one by one rather than fetching
+# a posting list if the posting list is estimated to be this many times bigger
+filter_ratio = 100
+
+# Candidates from ranked text search are checked against other And operands
+# in batches starting with this size and doubling up to the max
+ranked_batch_size = 20
+ranked_batch_size_max = 1000
+
+_negative = (NotEq, NotAny, NotAll, NotInRange, DoesNotContain,
+             query.NotEq, query.NotAny, query.NotAll, query.NotInRange,
+             query.DoesNotContain)
+
+
+def _range_args(q, names):
+    """
+    (start, end, excludemin, excludemax) for range-like queries or None
+    """
+    if isinstance(q, query.InRange):
+        return (q._get_start(names), q._get_end(names),
+                q.start_exclusive, q.end_exclusive)
+    op = getattr(q, "operator", None)
+    if op not in ('>', '>=', '<', '<=') or isinstance(q, query._Range):
+        return None
+    value = q._get_value(names)
+    if op == '>':
+        return value, None, True, False
+    elif op == '>=':
+        return value, None, False, False
+    elif op == '<':
+        return None, value, False, True
+    else:
+        return None, value, False, False
+
+
+def estimate_size(q, catalog, names=None):
+    """
+    Estimate number of documents a query would return without fetching
+    posting lists.
+
+    :returns: Estimated size or None if we don't know
+    """
+    if isinstance(q, query.And):
+        sizes = [estimate_size(x, catalog, names) for x in q.queries]
+        sizes = [x for x in sizes if x is not None]
+        return min(sizes) if sizes else None
+
+    elif isinstance(q, query.Or):
+        sizes = [estimate_size(x, catalog, names) for x in q.queries]
+        if None in sizes:
+            return None
+        return sum(sizes)
+
+    elif not isinstance(q, query.Comparator):
+        return None
+
+    index = q._get_index(catalog)
+
+    if isinstance(q, _negative):
+        # Anything not matching something is, well, most of the docs
+        return index.documentCount()
+
+    elif isinstance(q, (Contains, query.Contains)):
+        if hasattr(index, "estimateContains"):
+            return index.estimateContains(q._get_value(names))
+
+    elif isinstance(q, query.Eq):
+        if hasattr(index, "estimateEq"):
+            return index.estimateEq(q._get_value(names))
+
+    elif isinstance(q, query.Any):
+        if hasattr(index, "estimateEq"):
+            sizes = [index.estimateEq(v) for v in q._get_value(names)]
+            if None not in sizes:
+                return sum(sizes)
+
+    else:
+        args = _range_args(q, names)
+        if args is not None and hasattr(index, "estimateInRange"):
+            return index.estimateInRange(*args)
+
+
+def _predicate(q, names):
+    """
+    Function which checks one indexed value against query q, or None
+    """
+    if isinstance(q, query.Eq):
+        value = q._get_value(names)
+        return lambda v: v == value
+
+    elif isinstance(q, query.Any):
+        values = q._get_value(names)
+        return lambda v: v in values
+
+    args = _range_args(q, names)
+    if args is None:
+        return None
+    start, end, excludemin, excludemax = args
+
+    def check(v):
+        if start is not None:
+            if v < start or (excludemin and v == start):
+                return False
+        if end is not None:
+            if v > end or (excludemax and v == end):
+                return False
+        return True
+
+    return check
+
+
+def _filter(q, catalog, names):
+    """
+    (index, predicate) to check docids against query q one by one,
+    or None if it's not possible for this query
+    """
+    if not isinstance(q, query.Comparator) or isinstance(q, _negative):
+        return None
+    index = q._get_index(catalog)
+    if not hasattr(index, "filter_docids"):
+        return None
+    predicate = _predicate(q, names)
+    if predicate is None:
+        return None
+    return index, predicate
+
+
+def filter_docids(q, catalog, names, docids):
+    """
+    Check candidate docids against query q one by one using index values.
+    Returns None if it's not possible for this query and we need to apply it
+    the usual way
+    """
+    f = _filter(q, catalog, names)
+    if f is None:
+        return None
+    index, predicate = f
+    return index.filter_docids(docids, predicate)
+
+
+def _is_text(q, catalog):
+    """
+    Whether q is a full-text query (which can give results in relevance order)
+    """
+    if not isinstance(q, (Contains, query.Contains, query.Eq)) or \
+            isinstance(q, _negative):
+        return False
+    return hasattr(q._get_index(catalog), "estimateContains")
+
+
+def ranked_intersection(ranked, required=None, filters=()):
+    """
+    Lazily pick docids from the relevance-ordered stream which are also in
+    required set and pass all the filters.
+    Candidates are checked in batches which grow as we go, so that a query
+    with a small limit doesn't check (or download) more than it needs to
+
+    :param ranked: Iterable of docids in relevance order
+    :param required: Set of docids all the results must be in (or None)
+    :param filters: List of (index, predicate) to check candidates against
+    """
+    it = iter(ranked)
+    batch_size = ranked_batch_size
+    found = 0
+    while True:
+        batch = list(islice(it, batch_size))
+        if not batch:
+            break
+        if required is not None:
+            batch = [docid for docid in batch if docid in required]
+        for index, predicate in filters:
+            if not batch:
+                break
+            passed = index.filter_docids(batch, predicate)
+            batch = [docid for docid in batch if docid in passed]
+        for docid in batch:
+            yield docid
+        found += len(batch)
+        if required is not None and found >= len(required):
+            # Nothing else can pass
+            break
+        batch_size = min(batch_size * 2, ranked_batch_size_max)
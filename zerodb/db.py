@@ -1,7 +1,13 @@
+import base64
+import binascii
+import datetime
 import itertools
+import json
 import os
 import ssl
 import threading
+import time
+from collections import defaultdict
 
 import six
 from six.moves import zip as izip
@@ -10,6 +16,8 @@ from Crypto import Random
 import transaction
 import ZODB
 import ZODB.Connection
+from persistent.mapping import PersistentMapping
+from ZODB.utils import maxtid
 
 from zerodbext.catalog.query import optimize
 from zerodb.collective.indexing.indexer import PortalCatalogProcessor
@@ -20,14 +28,20 @@ from zope import component
 from zerodb import models
 from zerodb.catalog.query import And, Eq
 from zerodb.models.exceptions import ModelException
-from zerodb.storage import client_storage
+from zerodb.storage import client_storage, prefetch_trees
+from zerodb.storage.cache import SharedCache
+from zerodb.util import explain
+from zerodb.util.query_stats import QueryStats, query_shape
 from zerodb.util.thread_watcher import ThreadWatcher
-from zerodb.util.iter import DBList, DBListPrefetch, Sliceable
+from zerodb.util.iter import DBList, DBListPrefetch, ProjectionList, Sliceable
 
 from zerodb.transform.encrypt_aes import AES256Encrypter, AES256EncrypterV0
 from zerodb.transform import init_crypto
 from zerodb.crypto import kdf
 
+# Fixed-offset timezones for datetimes in cursors (Python 3 only)
+_timezone = getattr(datetime, "timezone", None)
+
 
 class AutoReindexQueueProcessor(PortalCatalogProcessor):
     def __init__(self, db, enabled=True):
@@ -40,6 +54,88 @@ class AutoReindexQueueProcessor(PortalCatalogProcessor):
             self.db.reindex(obj, attributes)
 
 
+def _encode_value(value):
+    """
+    JSON-friendly form of an index value. Types JSON doesn't have are
+    tagged, so that they come back as they were (and compare the same)
+    """
+    if value is None or isinstance(
+            value, (bool, float, six.text_type) + six.integer_types):
+        return value
+    elif isinstance(value, bytes):
+        return {"b": binascii.hexlify(value).decode()}
+    elif isinstance(value, tuple):
+        return {"t": [_encode_value(v) for v in value]}
+    elif isinstance(value, datetime.datetime):
+        offset = value.utcoffset()
+        if offset is not None and _timezone is None:
+            raise ValueError("Can't make a cursor with a timezone-aware "
+                             "datetime")
+        return {"dt": [value.year, value.month, value.day, value.hour,
+                       value.minute, value.second, value.microsecond],
+                "tz": None if offset is None else _total_seconds(offset)}
+    elif isinstance(value, datetime.date):
+        return {"d": value.toordinal()}
+    else:
+        raise ValueError("Can't make a cursor with a value of type %s" %
+                         type(value).__name__)
+
+
+def _decode_value(value):
+    if isinstance(value, list):
+        # Only tagged values are JSON containers
+        raise ValueError("Invalid cursor")
+    elif not isinstance(value, dict):
+        return value
+    elif "b" in value:
+        return binascii.unhexlify(value["b"])
+    elif "t" in value:
+        return tuple(_decode_value(v) for v in value["t"])
+    elif "dt" in value:
+        tz = value.get("tz")
+        if tz is not None:
+            tz = _timezone(datetime.timedelta(seconds=tz))
+        return datetime.datetime(*value["dt"], tzinfo=tz)
+    elif "d" in value:
+        return datetime.date.fromordinal(value["d"])
+    raise ValueError("Invalid cursor")
+
+
+def _total_seconds(delta):
+    return delta.days * 86400 + delta.seconds
+
+
+def encode_cursor(after, sort_index=None, reverse=False):
+    """
+    Opaque pagination token. Values of sort_index can be of JSON types,
+    bytes, dates, datetimes and tuples of those
+    """
+    if sort_index:
+        value, docid = after
+        after = (_encode_value(value), docid)
+    data = json.dumps([sort_index, bool(reverse), after], separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(cursor, sort_index=None, reverse=False):
+    """
+    Continuation point out of a pagination token.
+    Raises ValueError when the token is invalid or made for another ordering
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(str(cursor)).decode())
+        token_index, token_reverse, after = data
+        if token_index:
+            value, docid = after
+            after = (_decode_value(value), docid)
+    except (TypeError, ValueError, KeyError, OverflowError,
+            UnicodeDecodeError, binascii.Error):
+        raise ValueError("Invalid cursor")
+    if token_index != sort_index or token_reverse != bool(reverse):
+        raise ValueError("Cursor was made for another sort order")
+    return after
+
+
 class DbModel(object):
     """
     Class where model is combined with db.
@@ -131,6 +227,23 @@ class DbModel(object):
         obj._p_uid = uid
         return uid
 
+    def add_many(self, objs):
+        """
+        Add many newly created Model objects to the database at once.
+        Uids are allocated in one pass, and indexes are updated for the whole
+        batch, with one set of tree traversals per index
+
+        :param list objs: Objects to add to the database
+        :return: Added objects' uids
+        :rtype: list
+        """
+        objs = list(objs)
+        for obj in objs:
+            assert obj.__class__ == self._model
+        uids = self._objects.add_many(objs)
+        self._catalog.index_docs(izip(uids, objs))
+        return uids
+
     def reindex_one(self, obj, attributes=None):
         """
         Reindex one object which is already in the database
@@ -197,7 +310,53 @@ class DbModel(object):
         del self._objects[uid]
         return 1
 
-    def query(self, queryobj=None, skip=None, limit=None, prefetch=True, **kw):
+    def _make_query(self, queryobj, kw):
+        """
+        Query object out of queryobj and <field=...> keyword arguments.
+        The latter are removed from kw
+        """
+        eq_args = []
+        for k in list(kw.keys()):
+            if k not in set(["sort_index", "sort_type", "reverse", "names", "limit"]):
+                eq_args.append(Eq(k, kw.pop(k)))
+
+        if queryobj:
+            return optimize(optimize(queryobj) & And(*eq_args))
+        else:
+            return And(*eq_args)
+
+    def _load(self, uids, prefetch=True):
+        with explain.section("load"):
+            objects = [self._objects[uid] for uid in uids]
+            if objects and prefetch:
+                self._db._connection.prefetch(objects)
+            for obj, uid in izip(objects, uids):
+                obj._p_uid = uid
+            return objects
+
+    def _projection(self, fields):
+        """
+        Function which reads fields of a list of uids from field indexes
+        """
+        getters = []
+        for name in fields:
+            if name == "_p_uid":
+                getters.append(list)
+                continue
+            index = self._catalog[name] if name in self._catalog else None
+            if not hasattr(index, "get_values"):
+                raise ValueError("%s is not a field index of %s" % (
+                    name, self._model.__name__))
+            getters.append(index.get_values)
+
+        def project(uids):
+            with explain.section("fields"):
+                return list(izip(*[get(uids) for get in getters]))
+
+        return project
+
+    def query(self, queryobj=None, skip=None, limit=None, prefetch=True,
+              fields=None, **kw):
         """
         Smart proxy to catalog's query.
         One can add <field=...> keyword arguments to make queries where fields
@@ -207,7 +366,29 @@ class DbModel(object):
             logical, range queries etc
         :param int skip: Offset to start the result iteration from
         :param int limit: Limit number of results to this
+        :param list fields: Return tuples of these fields (read from field
+            indexes, "_p_uid" for uid) instead of objects. Objects are not
+            loaded then. Fields which are None aren't indexed, so are None
         """
+        Q = self._make_query(queryobj, kw)
+        stats = self._db.query_stats
+        if stats is None:
+            return self._query(Q, skip, limit, prefetch, fields, kw)
+
+        # Without limit results are lazy, and only the work done before
+        # iterating over them is measured
+        storage = self._db._storage
+        round_trips, loads = storage.counts()
+        t0 = time.time()
+        result = self._query(Q, skip, limit, prefetch, fields, kw)
+        dt = time.time() - t0
+        round_trips_after, loads_after = storage.counts()
+        stats.record(self._model.__name__,
+                     query_shape(Q, kw.get("sort_index"), limit), dt,
+                     round_trips_after - round_trips, loads_after - loads)
+        return result
+
+    def _query(self, Q, skip, limit, prefetch, fields, kw):
         # Catalog's query returns only integers
         # We must be smart here and return objects
         # But no, we must be even smarter and batch-preload objects
@@ -221,33 +402,116 @@ class DbModel(object):
         if limit:
             kw["limit"] = skip + limit
 
-        eq_args = []
-        for k in list(kw.keys()):
-            if k not in set(["sort_index", "sort_type", "reverse", "names", "limit"]):
-                eq_args.append(Eq(k, kw.pop(k)))
-
-        if queryobj:
-            Q = optimize(optimize(queryobj) & And(*eq_args))
-        else:
-            Q = And(*eq_args)
-
         q = lambda: self._catalog.query(Q, **kw)
+        project = fields and self._projection(fields)
 
         if limit:
             _, q = q()
             # XXX islice -> [:]
             qids = list(itertools.islice(q, skip, skip + limit))
-            objects = [self._objects[uid] for uid in qids]
-            if objects and prefetch:
-                self._db._connection.prefetch(objects)
-            for obj, uid in izip(objects, qids):
-                obj._p_uid = uid
-            return objects
+            if project:
+                return project(qids)
+            return self._load(qids, prefetch=prefetch)
+
+        elif project:
+            return ProjectionList(q, project)
 
         else:
             db_list = DBListPrefetch if prefetch else DBList
             return db_list(q, self)
 
+    def aggregate(self, op, field=None, queryobj=None, **kw):
+        """
+        Aggregate over query results (or over all objects) using only the
+        catalog, without loading objects.
+        One can add <field=...> keyword arguments like for query
+
+        :param str op: "count", "min", "max", "distinct" (sorted list of
+            values) or "group_by" (dict value -> number of objects)
+        :param str field: Field index to aggregate (not needed for count)
+        :param zerodb.catalog.query.Query queryobj: Query to filter by
+        """
+        if op not in ("count", "min", "max", "distinct", "group_by"):
+            raise ValueError("Unknown aggregation %s" % op)
+
+        if op != "count":
+            index = self._catalog[field] if field in self._catalog else None
+            if not hasattr(index, "value_counts"):
+                raise ValueError("%s is not a field index of %s" % (
+                    field, self._model.__name__))
+
+        if queryobj or kw:
+            _, result = self._catalog.query(self._make_query(queryobj, kw))
+            docids, size, _ = self._catalog._sortable(result)
+        else:
+            docids = size = None
+
+        if op == "count":
+            if docids is None:
+                return len(self)
+            if isinstance(docids, self._catalog.family.IF.TreeSet):
+                prefetch_trees([docids])
+            return len(docids)
+        elif op == "min":
+            return index.min_value(docids, size)
+        elif op == "max":
+            return index.max_value(docids, size)
+        elif op == "distinct":
+            return sorted(index.value_counts(docids))
+        else:
+            return index.value_counts(docids)
+
+    def query_page(self, queryobj=None, limit=20, cursor=None, prefetch=True,
+                   **kw):
+        """
+        One page of query results, for paginating through them.
+        Unlike skip, cursor makes the next page continue where the previous
+        one stopped, so that page N doesn't cost reading N pages.
+
+        Without sort_index, results are ordered by uid. Text search results
+        must be sorted by an index to be paginated this way (ValueError is
+        raised otherwise, as for sort_type and indexes which can't continue
+        results).
+
+        :param zerodb.catalog.query.Query queryobj: Query
+        :param int limit: Page size
+        :param str cursor: Cursor returned with the previous page
+        :returns: (objects, cursor of the next page or None for the last page)
+        """
+        sort_index = kw.get("sort_index")
+        reverse = kw.get("reverse", False)
+        if kw.get("sort_type") is not None:
+            raise ValueError("Pages can't be sorted with sort_type")
+        if sort_index:
+            if not hasattr(self._catalog[sort_index], "sort_topk"):
+                raise ValueError("Pages can't be sorted by %s" % sort_index)
+        elif reverse:
+            raise ValueError("Pages in reverse order need sort_index")
+        if cursor is not None:
+            after = decode_cursor(cursor, sort_index, reverse)
+        else:
+            after = None
+
+        kw["limit"] = limit
+        Q = self._make_query(queryobj, kw)
+        _, q = self._catalog.query(Q, after=after, **kw)
+        if not sort_index and after is None and \
+                not self._catalog.ordered_by_docid(q):
+            raise ValueError("Results of this query (e.g. ranked text "
+                             "search) need sort_index to be paginated")
+        qids = list(itertools.islice(q, limit))
+
+        if len(qids) < limit:
+            next_cursor = None
+        elif sort_index:
+            last = qids[-1]
+            value = self._catalog[sort_index]._rev_index[last]
+            next_cursor = encode_cursor((value, last), sort_index, reverse)
+        else:
+            next_cursor = encode_cursor(qids[-1], sort_index, reverse)
+
+        return self._load(qids, prefetch=prefetch), next_cursor
+
     def __len__(self):
         return len(self._objects)
 
@@ -284,12 +548,15 @@ class DB(object):
     encrypter = [AES256Encrypter, AES256EncrypterV0]
     appname = 'zerodb.com'
     compressor = None
+    _compressor = None  # Copy of compressor with dictionaries of this db
+    compression_dicts_name = "compression_dictionaries"
 
     def __init__(self, sock, key=None, username=None, password=None,
                  cert_file=None, key_file=None, server_cert=None,
                  security=None,
                  debug=False, pool_timeout=3600, pool_size=7,
                  autoreindex=True, wait_timeout=30,
+                 cache_file=None, slow_query_threshold=1.0, query_stats=True,
                  **kw):
         """
         :param str sock: UNIX (str) or TCP ((str, int)) socket
@@ -306,6 +573,14 @@ class DB(object):
                                   zerodb.crypto.kdf
 
         :param bool debug: Whether to log debug messages
+        :param str cache_file: Persistent client cache file. Records are kept
+            in it encrypted, as they come from the server. Processes forked
+            after connecting use it read-only
+        :param float slow_query_threshold: Log queries slower than this many
+            seconds to "zerodb.slow_query" logger (None not to log)
+        :param bool query_stats: Keep latency histograms and round trips of
+            queries per model and query shape in db.query_stats (and log
+            slow ones), False to turn off
         """
 
         if (cert_file or key_file) and not (cert_file and key_file):
@@ -332,6 +607,11 @@ class DB(object):
             assert len(sock) == 2
             sock = str(sock[0]), int(sock[1])
 
+        if query_stats:
+            self.query_stats = QueryStats(slow_query_threshold)
+        else:
+            self.query_stats = None
+
         self._autoreindex = autoreindex
         self._reindex_queue_processor = AutoReindexQueueProcessor(
             self, enabled=autoreindex)
@@ -347,6 +627,7 @@ class DB(object):
                 "sock": sock,
                 "ssl": ssl_context,
                 "cache_size": 2 ** 30,
+                "cache": cache_file,
                 "debug": debug,
                 "wait_timeout": wait_timeout,
                 "credentials": credentials,
@@ -361,6 +642,8 @@ class DB(object):
 
         # For multi-threading
         self.__pid = os.getpid()
+        # Only the process which opened the cache file can write to it
+        self.__cache_pid = self.__pid
 
         self._init_db()
         self._models = {}
@@ -392,9 +675,47 @@ class DB(object):
         self.__conn_refs = {}
         self.__thread_local = threading.local()
         self.__thread_watcher = ThreadWatcher()
-        self._storage = client_storage(**self.__storage_kwargs)
+        storage_kwargs = self.__storage_kwargs
+        if storage_kwargs["cache"] and os.getpid() != self.__cache_pid:
+            storage_kwargs = dict(storage_kwargs, cache=SharedCache(
+                storage_kwargs["cache"], storage_kwargs["cache_size"]))
+        self._storage = client_storage(**storage_kwargs)
         self._db = SubDB(self._storage, **self.__db_kwargs)
         self._conn_open()
+        if hasattr(self.compressor, "add_dictionary"):
+            # Dictionaries are of this database, so they are kept in its own
+            # compressor which only its storage uses
+            self._compressor = self.compressor.copy()
+            self._compressor.reload_dictionaries = \
+                self._load_compression_dictionaries
+            self._storage.compressor = self._compressor
+            self.__dicts_lock = threading.Lock()
+            self._load_compression_dictionaries()
+
+    def explain(self, name="query"):
+        """
+        Context manager which profiles queries done inside it in this thread:
+        round trips, loaded records, cache hits and decryption per query
+        operator. See zerodb.util.explain
+
+            with db.explain() as profile:
+                db[Model].query(...)
+            print(profile.report())
+        """
+        return explain.explain(name)
+
+    def _load_compression_dictionaries(self):
+        # Also called when records compressed with dictionaries trained by
+        # other clients after we connected are met, from any thread and in
+        # the middle of a load. So it uses a connection of its own
+        with self.__dicts_lock:
+            conn = self._db.open(transaction.TransactionManager())
+            try:
+                dicts = conn.root().get(self.compression_dicts_name, {})
+                for class_name, data in dicts.items():
+                    self._compressor.add_dictionary(class_name, data)
+            finally:
+                conn.close()
 
     def _conn_open(self):
         """Opens db connection and registers a destuction callback"""
@@ -459,7 +780,12 @@ class DB(object):
         :rtype: int
         """
         if isinstance(obj, (list, set, tuple)):
-            return [self[o.__class__].add(o) for o in obj]
+            objs_by_model = defaultdict(list)
+            for o in obj:
+                objs_by_model[o.__class__].append(o)
+            for model, objs in six.iteritems(objs_by_model):
+                self[model].add_many(objs)
+            return [o._p_uid for o in obj]
         else:
             return self[obj.__class__].add(obj)
 
@@ -499,6 +825,38 @@ class DB(object):
         else:
             raise TypeError("ZeroDB object or list of these should be passed")
 
+    def train_compression(self, models, samples=1000, size=16384):
+        """
+        Train compression dictionaries on stored records of models and save
+        them in the database. Objects written after that are compressed
+        with these dictionaries. Other clients load them when they connect.
+
+        :param list models: Model classes to train dictionaries for
+        :param int samples: Max number of records to sample per model
+        :param int size: Size of each dictionary in bytes
+        """
+        if not hasattr(self._compressor, "train"):
+            raise TypeError("Compressor doesn't support dictionaries")
+        dicts = {}
+        for model in models:
+            objects = list(itertools.islice(self[model].all(), samples))
+            if not objects:
+                continue
+            self._connection.prefetch(objects)
+            records = [self._storage.loadBefore(o._p_oid, maxtid)[0]
+                       for o in objects]
+            class_name = "%s.%s" % (model.__module__, model.__name__)
+            dicts[class_name] = self._compressor.train(records, size=size)
+
+        with transaction.manager:
+            root = self._root
+            if self.compression_dicts_name not in root:
+                root[self.compression_dicts_name] = PersistentMapping()
+            root[self.compression_dicts_name].update(dicts)
+
+        for class_name, data in dicts.items():
+            self._compressor.add_dictionary(class_name, data)
+
     def pack(self):
         """
         Remove old versions of objects
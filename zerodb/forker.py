@@ -4,9 +4,11 @@ Forked :) from ZEO.tests.forker
 """
 import logging
 import os
+import socket
 import tempfile
 import threading
-from six.moves.queue import Empty
+import time
+from six.moves.queue import Empty, Queue
 
 from ZEO.tests.forker import stop_runner, whine
 from ZODB.utils import z64
@@ -179,3 +181,111 @@ def start_server(storage_conf=None, zeo_conf=None, port=None, keep=False,
         stop_runner(thread, tmpfile, qin, qout, stop_timeout)
 
     return addr, stop
+
+
+class LatencyProxy(object):
+    """
+    TCP proxy which delays data going both ways and limits bandwidth,
+    to see what round trips cost over a slow link (a round trip costs
+    2 * latency more than without the proxy)
+    """
+
+    def __init__(self, target, latency=0.05, bandwidth=None,
+                 host="127.0.0.1"):
+        """
+        :param target: Address of the server (UNIX socket or (host, port))
+        :param float latency: One-way delay, seconds
+        :param float bandwidth: Bytes per second each way (None for no limit)
+        """
+        self.target = target
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.closed = False
+        self._sockets = []
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((host, 0))
+        self._listener.listen(16)
+        self.addr = self._listener.getsockname()
+        self._spawn(self._accept)
+
+    def _spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while not self.closed:
+            try:
+                conn, _ = self._listener.accept()
+            except (socket.error, OSError):
+                break
+            if isinstance(self.target, str):
+                upstream = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            else:
+                upstream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                upstream.connect(self.target)
+            except (socket.error, OSError):
+                conn.close()
+                continue
+            for sock in (conn, upstream):
+                if sock.family == socket.AF_INET:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._sockets.extend([conn, upstream])
+            self._spawn(self._pipe, conn, upstream)
+            self._spawn(self._pipe, upstream, conn)
+
+    def _pipe(self, src, dst):
+        """
+        Read from src, send to dst when the data would arrive over the link
+        """
+        queue = Queue()
+        self._spawn(self._deliver, queue, dst)
+        link_free = 0
+        while True:
+            try:
+                data = src.recv(65536)
+            except (socket.error, OSError):
+                data = b""
+            now = time.time()
+            if not data:
+                queue.put((now + self.latency, None))
+                return
+            if self.bandwidth:
+                # Data is sent after whatever is in the link already
+                link_free = max(now, link_free) + len(data) / float(self.bandwidth)
+                queue.put((link_free + self.latency, data))
+            else:
+                queue.put((now + self.latency, data))
+
+    def _deliver(self, queue, dst):
+        while True:
+            deliver_at, data = queue.get()
+            delay = deliver_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                if data is None:
+                    dst.shutdown(socket.SHUT_WR)
+                    return
+                dst.sendall(data)
+            except (socket.error, OSError):
+                return
+
+    def close(self):
+        self.closed = True
+        for sock in [self._listener] + self._sockets:
+            try:
+                sock.close()
+            except (socket.error, OSError):
+                pass
+
+
+def start_proxy(target, latency=0.05, bandwidth=None):
+    """Start a proxy which emulates a slow network in front of a server.
+
+    Returns the address to connect to and the function to stop the proxy.
+    """
+    proxy = LatencyProxy(target, latency=latency, bandwidth=bandwidth)
+    return proxy.addr, proxy.close
@@ -1,14 +1,32 @@
 # We don't need two-way references given by IntIds, but we need a primary object storage
 # If we used IntIds and some objects storage we'd have *3* trees
 # But we want to minimize number of calls, so we make one primary IOBTree which has IDs and objects
-# Conflict avoidance method is copied from IntIds._generateId (need something better I guess)
+# To avoid conflicts, every connection reserves its own block of sequential IDs
+import itertools
 import persistent
 import random
+import weakref
 
 import six
 from BTrees.Length import Length
 from zerodb.trees import family32
 
+# {connection -> {oid of IdStore -> _Blocks}}. Kept outside of stores, so
+# that a store which is ghosted and loaded again goes on with its block
+_connection_blocks = weakref.WeakKeyDictionary()
+# {IdStore -> _Blocks} of stores which aren't in a connection yet
+_new_store_blocks = weakref.WeakKeyDictionary()
+
+
+class _Blocks(object):
+    """
+    Block of IDs which a connection takes IDs of a store from
+    """
+    token = None  # Identifies reservations of this connection
+    nextid = None
+    blockend = None
+    hint = None  # Free blocks are looked for from here
+
 
 class IdStore(persistent.Persistent):
     """
@@ -16,39 +34,132 @@ class IdStore(persistent.Persistent):
     for them
     """
 
-    _v_nextid = None
-
     family = family32
 
+    # Number of sequential IDs a connection reserves at once
+    block_size = 1024
+    # Concurrent writers pick one of this many free blocks
+    block_spread = 8
+    # Blocks are looked for from here on. Stores start at random blocks,
+    # so that IDs of different models don't coincide
+    first_block = 1
+
     def __init__(self, family=family32):
         """
         :param family: Family of BTrees to use
         """
         self.tree = family.IO.BTree()
         self.length = Length()
+        self._init_blocks()
+
+    def _init_blocks(self):
+        self.blocks = self.family.II.BTree()
+        maxblock = self.family.maxint // self.block_size
+        self.first_block = random.randrange(1, maxblock // 2)
+
+    def _free_blocks(self, start, stop):
+        """
+        Blocks from start to stop which are not reserved and not mostly
+        taken by IDs allocated the old (random) way
+        """
+        size = self.block_size
+        half = size // 2
+        block = start
+        for taken in itertools.chain(
+                self.blocks.keys(min=start, max=stop), [stop + 1]):
+            while block < taken:
+                used = self.tree.keys(min=block * size,
+                                      max=(block + 1) * size - 1)
+                # Only read as many IDs as we need to tell
+                if sum(1 for _ in itertools.islice(used, half)) < half:
+                    yield block
+                block += 1
+            block = taken + 1
+
+    def _get_blocks(self):
+        """
+        Block state of the connection the store is used in
+        """
+        jar = self._p_jar
+        if jar is None or self._p_oid is None:
+            return _new_store_blocks.setdefault(self, _Blocks())
+        stores = _connection_blocks.setdefault(jar, {})
+        state = stores.get(self._p_oid)
+        if state is None:
+            state = stores[self._p_oid] = \
+                _new_store_blocks.pop(self, None) or _Blocks()
+        return state
+
+    def _release_block(self, state):
+        """
+        Release the block we took all the IDs of, so that reservations
+        don't pile up. It's free again if its objects get removed
+        """
+        block = state.blockend // self.block_size - 1
+        if self.blocks.get(block) == state.token:
+            del self.blocks[block]
+
+    def _reserve_block(self, state):
+        """
+        Reserve a block of IDs for this connection.
+        Reservation is an insert of the block number to the blocks tree.
+        Concurrent writers insert different keys (which BTrees resolve
+        without conflicts) and insert returns False if the block is taken
+
+        :param _Blocks state: Block state of this connection
+        :return: First ID of the block or None if there are no blocks left
+        """
+        if not hasattr(self, "blocks"):
+            # Store with IDs allocated the old way
+            self._init_blocks()
+        if state.token is None:
+            state.token = random.randrange(1, self.family.maxint)
+
+        maxblock = self.family.maxint // self.block_size
+        start = max(self.first_block, state.hint or 0)
+        # First free blocks after the ones we know are taken, then the
+        # ones below first_block
+        candidates = list(itertools.islice(itertools.chain(
+            self._free_blocks(start, maxblock),
+            self._free_blocks(1, start - 1)), self.block_spread))
+        if candidates:
+            state.hint = candidates[0]
+        random.shuffle(candidates)
+        for block in candidates:
+            if self.blocks.insert(block, state.token):
+                state.blockend = (block + 1) * self.block_size
+                return block * self.block_size
 
     def _generateId(self):
         """Generate an id which is not yet taken.
 
-        This tries to allocate sequential ids so they fall into the same BTree
-        bucket, and randomizes if it stumbles upon a used one.
-
-        This algorithm is taken from zope.intid but it will cause performance
-        degradation due to fragmentation if used too often, we need something
-        better eventually
+        IDs are taken sequentially from a block reserved by this connection,
+        so that objects added together fall into the same BTree bucket and
+        IDs stay dense. A new block is reserved when the current one runs out
+        (and is released) or wasn't committed (transaction aborted).
+        If all the blocks are taken, IDs are random
         """
-        nextid = self._v_nextid
+        state = self._get_blocks()
+        nextid = state.nextid
         while True:
-            if nextid is None:
-                nextid = random.randrange(0, self.family.maxint)
+            if nextid is not None and nextid >= state.blockend:
+                self._release_block(state)
+            if nextid is None or nextid >= state.blockend or \
+                    self.blocks.get(nextid // self.block_size) != state.token:
+                nextid = self._reserve_block(state)
+                if nextid is None:
+                    return self._generateRandomId()
             uid = nextid
+            nextid += 1
+            if uid not in self.tree:
+                state.nextid = nextid
+                return uid
+
+    def _generateRandomId(self):
+        while True:
+            uid = random.randrange(0, self.family.maxint)
             if uid not in self.tree:
-                nextid += 1
-                if nextid > self.family.maxint:
-                    nextid = None
-                self._v_nextid = nextid
                 return uid
-            nextid = None
 
     def add(self, obj):
         """
@@ -70,6 +181,30 @@ class IdStore(persistent.Persistent):
                 self.length.change(1)
                 return uid
 
+    def add_many(self, objs):
+        """
+        Add many objects to the storage at once
+
+        :param list objs: Objects to store
+        :return: Unique IDs in the same order as objects
+        :rtype: list
+        """
+        if not hasattr(self, "length"):
+            self.length = Length(len(self.tree))
+        uids = []
+        added = 0
+        for obj in objs:
+            uid = self._generateId()
+            if self.tree.insert(uid, obj):
+                obj._p_uid = uid
+                added += 1
+            else:
+                uid = self.add(obj)
+            uids.append(uid)
+        # Length is changed once for the whole batch
+        self.length.change(added)
+        return uids
+
     def remove(self, iobj):
         """
         Remove object from the storage
@@ -19,8 +19,7 @@ All other user's ids are the oids of their root folders.
 
 Users have certs: {der -> pem_data}
 
-The Certs object is just a persistent container for the concatenation
-of all of the user certs.
+The Certs object is a persistent container of all of the user certs.
 
 """
 import hashlib
@@ -28,7 +27,7 @@ import os
 import ssl
 import uuid
 
-from BTrees.OOBTree import BTree
+from BTrees.OOBTree import BTree, OOTreeSet
 from ZODB.utils import p64
 import persistent
 import persistent.mapping
@@ -88,15 +87,44 @@ class User(persistent.Persistent):
 
 
 class Certs(persistent.Persistent):
+    """Certificates of all users, which clients are verified against
+
+    They are kept in a tree set, so that adding or removing one doesn't
+    rewrite all of them. The version changes on every change, so that
+    the server knows when to reload them. Old databases kept
+    certificates concatenated in one string, they are converted on the
+    first change.
+    """
+
+    version = 0
+    pems = None
 
     def __init__(self):
-        self.data = ''
+        self.pems = OOTreeSet()
+
+    def _upgrade(self):
+        if self.pems is None:
+            old = self.__dict__.pop('data', '')
+            self.pems = OOTreeSet(
+                pem.strip() for pem in old.split('\n\n') if pem.strip())
+
+    @property
+    def data(self):
+        """All the certificates concatenated"""
+        if self.pems is None:
+            return self.__dict__.get('data', '')
+        return ''.join('\n\n' + pem for pem in self.pems)
 
     def add(self, pem_data):
-        self.data += '\n\n' + pem_data
+        self._upgrade()
+        self.pems.add(pem_data.strip())
+        self.version += 1
 
     def remove(self, pem_data):
-        self.data = self.data.replace('\n\n' + pem_data, '')
+        self._upgrade()
+        if pem_data.strip() in self.pems:
+            self.pems.remove(pem_data.strip())
+        self.version += 1
 
 
 class Admin(persistent.Persistent):
@@ -0,0 +1,9 @@
+import ZODB.POSException
+
+
+class QuotaExceeded(ZODB.POSException.StorageError):
+    pass
+
+
+class TooManyTransactions(ZODB.POSException.StorageError):
+    pass
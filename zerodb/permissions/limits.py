@@ -0,0 +1,220 @@
+"""Per-user limits of a multi-tenant server
+
+Users are limited in bytes stored, concurrent transactions and loads per
+second. Except for the storage quota, limits don't raise errors: requests
+over them wait, and only connections of the same user are slowed down
+(every connection has its own thread). A transaction which waits for too
+long to start fails with TooManyTransactions.
+
+The commit lock is given out by fair queuing: the waiting transaction of
+the user who held the lock for the least time goes first, so that a user
+doing a huge import can't keep others from committing.
+"""
+import itertools
+import logging
+import sys
+import threading
+import time
+
+import ZEO.StorageServer
+import ZODB.POSException
+from ZEO.asyncio.server import Delay
+
+from .exceptions import QuotaExceeded, TooManyTransactions
+from .userstats import scan
+
+# Defaults, None for no limit
+max_bytes = None
+max_transactions = None
+max_loads_per_second = None
+
+# Seconds a transaction waits for other transactions of the user to end
+transaction_wait_timeout = 60
+
+# Loads which can be done at once after a pause, when loads are limited
+load_burst = 100
+
+
+class Limits(object):
+    """Limits of users and their usage, shared by all connections
+
+    Bytes stored by users are counted from commits made by the server, as
+    growth of the storage (the same as sizes of transactions in the file
+    storage). Usage from before can be loaded from the file storage with
+    load_usage, incrementally if a checkpoint file is given.
+    """
+
+    def __init__(self, max_bytes=max_bytes, max_transactions=max_transactions,
+                 max_loads_per_second=max_loads_per_second,
+                 load_burst=load_burst,
+                 transaction_wait_timeout=transaction_wait_timeout):
+        self.max_bytes = max_bytes
+        self.max_transactions = max_transactions
+        self.transaction_wait_timeout = transaction_wait_timeout
+        self.max_loads_per_second = max_loads_per_second
+        self.load_burst = load_burst
+
+        self.usage = {}  # {user_id -> bytes stored}
+        self._lock = threading.Lock()
+        self._transactions_changed = threading.Condition(self._lock)
+        self._transactions = {}  # {user_id -> transactions in progress}
+        self._buckets = {}  # {user_id -> [loads allowed, at time]}
+
+    def load_usage(self, path, checkpoint=None):
+        """Count bytes stored by users in a file storage"""
+        totals = scan(path, checkpoint)
+        with self._lock:
+            for user_id, (nbytes, objects) in totals.items():
+                self.usage[user_id] = nbytes
+
+    def add_usage(self, user_id, nbytes):
+        with self._lock:
+            self.usage[user_id] = self.usage.get(user_id, 0) + nbytes
+
+    def check_quota(self, user_id, size=0):
+        """Raise QuotaExceeded if the user can't store size bytes more"""
+        if self.max_bytes is None or user_id is None:
+            return
+        with self._lock:
+            used = self.usage.get(user_id, 0)
+        if used + size > self.max_bytes:
+            raise QuotaExceeded("Storage quota of %d bytes exceeded" %
+                                self.max_bytes)
+
+    def begin(self, user_id):
+        """Wait until the user can start one more transaction
+
+        :raises TooManyTransactions: if other transactions of the user
+            didn't end in transaction_wait_timeout seconds
+        """
+        with self._transactions_changed:
+            if self.max_transactions is not None:
+                deadline = time.time() + self.transaction_wait_timeout
+                while (self._transactions.get(user_id, 0) >=
+                       self.max_transactions):
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        raise TooManyTransactions(
+                            "More than %d transactions in progress" %
+                            self.max_transactions)
+                    self._transactions_changed.wait(timeout)
+            self._transactions[user_id] = (
+                self._transactions.get(user_id, 0) + 1)
+
+    def end(self, user_id):
+        with self._transactions_changed:
+            count = self._transactions.get(user_id, 0) - 1
+            if count > 0:
+                self._transactions[user_id] = count
+            else:
+                self._transactions.pop(user_id, None)
+            self._transactions_changed.notify_all()
+
+    def throttle_load(self, user_id):
+        """Wait until the user can load (token bucket)"""
+        rate = self.max_loads_per_second
+        if rate is None:
+            return
+        with self._lock:
+            now = time.time()
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                bucket = self._buckets[user_id] = [self.load_burst, now]
+            allowed = min(self.load_burst,
+                          bucket[0] + (now - bucket[1]) * rate) - 1
+            bucket[:] = [allowed, now]
+        if allowed < 0:
+            # Later loads of the user queue after this one
+            time.sleep(-allowed / rate)
+
+
+class FairLockManager(ZEO.StorageServer.LockManager):
+    """Commit lock given to waiting users by start-time fair queuing
+
+    Every user has a virtual time: the total time they held the lock,
+    but not less than of the last user who got it. When the lock is
+    released, it goes to the waiting transaction of the user with the
+    least virtual time (first come first served among equals), rather
+    than to whichever waiting connection gets to it first.
+
+    Transactions wait in our own queue, and the one chosen takes the lock
+    through the base class' lock, so that only one transaction at a time
+    ever asks for it.
+    """
+
+    def __init__(self, storage_id, stats, timeout):
+        super(FairLockManager, self).__init__(storage_id, stats, timeout)
+        self.vtime = 0.0
+        self.user_vtimes = {}  # {user_id -> virtual time}
+        self.queue = {}  # {ZEOStorage -> (func, delay, order it came in)}
+        self.holder = None  # ZEOStorage which has (or is taking) the lock
+        self.next = None  # Waiting ZEOStorage which gets the lock next
+        self._counter = itertools.count()
+        self._lock_start = None
+        self._queue_lock = threading.RLock()
+
+    def _user_vtime(self, zs):
+        return max(self.user_vtimes.get(zs.user_id, 0.0), self.vtime)
+
+    def lock(self, zs, func):
+        with self._queue_lock:
+            if self.holder is zs:
+                raise ZODB.POSException.StorageTransactionError(
+                    "Already voting (locked)")
+            if zs in self.queue:
+                raise ZODB.POSException.StorageTransactionError(
+                    "Already voting (waiting)")
+            if self.holder is not None and not self.holder.connected:
+                self.holder.log("Still locked after disconnected. "
+                                "Unlocking.", logging.CRITICAL)
+                self.release(self.holder)
+            if (self.holder is not None or self.next is not None or
+                    self.queue):
+                delay = Delay()
+                self.queue[zs] = (func, delay, next(self._counter))
+                return delay
+            self._hold(zs)
+        return super(FairLockManager, self).lock(zs, func)
+
+    def _hold(self, zs):
+        self.holder = zs
+        self._lock_start = time.time()
+
+    def _take(self, zs):
+        # Called in the thread of zs when it's its turn
+        with self._queue_lock:
+            if self.next is not zs or zs not in self.queue:
+                return
+            func, delay, _ = self.queue.pop(zs)
+            self.next = None
+            self._hold(zs)
+        try:
+            result = super(FairLockManager, self).lock(zs, func)
+        except Exception:
+            delay.error(sys.exc_info())
+        else:
+            delay.reply(result)
+
+    def release(self, zs):
+        super(FairLockManager, self).release(zs)
+        with self._queue_lock:
+            if self.holder is zs:
+                self.holder = None
+                held = time.time() - self._lock_start
+                self.user_vtimes[zs.user_id] = self._user_vtime(zs) + held
+            else:
+                self.queue.pop(zs, None)
+                if self.next is zs:
+                    self.next = None
+            if self.holder is None and self.next is None and self.queue:
+                self._wake()
+
+    def _wake(self):
+        self.next = min(self.queue, key=lambda zs: (
+            self._user_vtime(zs), self.queue[zs][2]))
+        self.vtime = self._user_vtime(self.next)
+        for user_id, vtime in list(self.user_vtimes.items()):
+            if vtime <= self.vtime:
+                # Same as the default
+                del self.user_vtimes[user_id]
+        self.next.call_soon_threadsafe(self._take, self.next)
@@ -1,8 +1,43 @@
+import threading
+
+from cachetools import LRUCache
 from ZODB.POSException import POSKeyError, StorageError
 from ZODB.utils import maxtid, u64, z64
 import ZODB.interfaces
 import zope.interface
 
+# Number of oids we remember owners of
+owner_cache_size = 2 ** 20
+
+
+class OwnerCache(object):
+    """Owners of oids, shared by all connections to a storage
+
+    Only the owner can overwrite a record, so once we know the owner it
+    stays the same. Commits update the cache with the committer as the
+    owner; records written bypassing OwnerStorage (by the server itself)
+    are forgotten.
+    """
+
+    def __init__(self, size=owner_cache_size):
+        self._owners = LRUCache(size)
+        self._lock = threading.Lock()
+
+    def get(self, oid):
+        with self._lock:
+            return self._owners.get(oid)
+
+    def update(self, oids, owner):
+        with self._lock:
+            for oid in oids:
+                self._owners[oid] = owner
+
+    def invalidate(self, oids):
+        with self._lock:
+            for oid in oids:
+                self._owners.pop(oid, None)
+
+
 @zope.interface.implementer(ZODB.interfaces.IMultiCommitStorage)
 class OwnerStorage(object):
     """Storage wrapper that adds/stript/checks owner id in record
@@ -26,9 +61,21 @@ class OwnerStorage(object):
     def supportsUndo(self):
         return False
 
-    def __init__(self, storage, user_id):
+    def __init__(self, storage, user_id, owners=None):
+        """
+        :param storage: Storage to wrap
+        :param bytes user_id: Owner id of this user
+        :param OwnerCache owners: Known owners of oids. If given, records
+            which are not in it are checked in bulk in tpc_vote rather
+            than one by one in store
+        """
         self.user_id = user_id
         self.storage = storage
+        self.owners = owners
+        self._unchecked = []
+        # Oids given to this user since its last transaction: nobody else
+        # has them, so there's nothing to check
+        self._new_oids = set()
 
     def __getattr__(self, name):
         return getattr(self.storage, name)
@@ -58,14 +105,55 @@ class OwnerStorage(object):
         self._check_permissions(data, oid)
         return data[:-len(self.user_id)]
 
-    def store(self, oid, serial, data, version, transaction):
+    def _check_owned(self, oid):
         try:
             old_data = self.storage.loadBefore(oid, maxtid)[0]
             self._check_permissions(old_data, oid)
+            return True
         except POSKeyError:
-            pass  # We store a new one
+            return False  # We store a new one
+
+    def new_oid(self):
+        oid = self.storage.new_oid()
+        self._new_oids.add(oid)
+        return oid
+
+    def store(self, oid, serial, data, version, transaction):
+        if oid in self._new_oids:
+            pass  # Nobody else could have stored it
+        elif self.owners is None:
+            self._check_owned(oid)
+        elif (oid != self.user_id and oid != z64 and
+              self.owners.get(oid) != self.user_id):
+            self._unchecked.append(oid)
         data += self.user_id
         self.storage.store(oid, serial, data, version, transaction)
 
+    def tpc_begin(self, transaction, *args):
+        self._unchecked = []
+        return self.storage.tpc_begin(transaction, *args)
+
+    def tpc_vote(self, transaction):
+        # Records stored in this transaction are not committed yet, so we
+        # still load the old ones. The commit lock is held, so nobody
+        # changes owners meanwhile
+        unchecked, self._unchecked = self._unchecked, []
+        owned = [oid for oid in unchecked if self._check_owned(oid)]
+        if self.owners is not None:
+            self.owners.update(owned, self.user_id)
+        return self.storage.tpc_vote(transaction)
+
+    def tpc_finish(self, transaction, *args):
+        result = self.storage.tpc_finish(transaction, *args)
+        # Once the transaction ends, records of the oids are checked as
+        # everything else, and oids which weren't used don't pile up
+        self._new_oids.clear()
+        return result
+
+    def tpc_abort(self, transaction):
+        self._unchecked = []
+        self._new_oids.clear()
+        return self.storage.tpc_abort(transaction)
+
     def __len__(self):
         return len(self.storage)
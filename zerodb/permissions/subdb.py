@@ -1,14 +1,68 @@
+import asyncio
+import logging
 import mock
+import socket
 import ssl
+import threading
 
+import transaction
 import ZEO.asyncio.mtacceptor
+import ZEO.asyncio.server
 import ZEO.Exceptions
 import ZEO.runzeo
 import ZEO.StorageServer
 import ZODB
 
 from .base import get_admin
-from .ownerstorage import OwnerStorage
+from .limits import FairLockManager
+from .ownerstorage import OwnerCache, OwnerStorage
+
+# Objects kept in memory by the database of users and certificates
+login_cache_size = 10000
+
+
+class Logins(object):
+    """Server-wide lookup of users logging in
+
+    Uses one long-lived connection, so users and certificates stay in
+    its cache between logins and are only reloaded when invalidated.
+    """
+
+    def __init__(self, db):
+        self._lock = threading.Lock()
+        self._transaction_manager = transaction.TransactionManager()
+        self._conn = db.open(self._transaction_manager)
+        self._transaction_manager.begin()
+        self._admin = get_admin(self._conn)
+        self._transaction_manager.abort()
+
+    def authenticate(self, der, credentials=None):
+        """Id of the user with this certificate (and credentials)
+
+        :raises ZEO.Exceptions.AuthError: if credentials are needed or wrong
+        """
+        with self._lock:
+            # Begin syncs the connection with invalidations
+            self._transaction_manager.begin()
+            try:
+                user_id = self._admin.uids[der]
+                if user_id is None:
+                    # Nobody cert.
+                    if not credentials:
+                        raise ZEO.Exceptions.AuthError()
+
+                if credentials:
+                    user = self._admin.users_by_name[credentials['name']]
+                    if ((user.id != user_id and user_id is not None) or
+                        not user.check_password(credentials['password'])
+                        ):
+                        raise ZEO.Exceptions.AuthError()
+                    user_id = user.id
+
+                return user_id
+            finally:
+                self._transaction_manager.abort()
+
 
 class Acceptor(ZEO.asyncio.mtacceptor.Acceptor):
 
@@ -16,23 +70,83 @@ class Acceptor(ZEO.asyncio.mtacceptor.Acceptor):
         super(Acceptor, self).__init__(storage_server, addr, ssl)
         [self.cert_storage_id] = storage_server.storages # TCBOO
         storage = storage_server.storages[self.cert_storage_id]
-        self.cert_db = ZODB.DB(storage)
-        self.invalidate = self.cert_db._mvcc_storage.invalidate
+        self.cert_db = ZODB.DB(storage, cache_size=login_cache_size)
+        self._invalidate = self.cert_db._mvcc_storage.invalidate
         with self.cert_db.transaction() as conn:
             self.certs_oid = get_admin(conn).certs._p_oid
+        self.logins = Logins(self.cert_db)
+        self._context = None
+        self._context_lock = threading.Lock()
+        self._certs_changes = 0
+
+    def invalidate(self, tid, oids):
+        self._invalidate(tid, oids)
+        if self.certs_oid in oids:
+            # Certificates changed, verify against the new ones
+            self._certs_changes += 1
+            self._context = None
 
     @property
     def ssl_context(self):
-        context = self.storage_server.create_ssl_context()
-        with self.cert_db.transaction() as conn:
-            certs = conn.get(self.certs_oid)
-            context.load_verify_locations(cadata=certs.data)
-        return context
+        with self._context_lock:
+            context = self._context
+            if context is None:
+                changes = self._certs_changes
+                context = self.storage_server.create_ssl_context()
+                with self.cert_db.transaction() as conn:
+                    certs = conn.get(self.certs_oid)
+                    context.load_verify_locations(cadata=certs.data)
+                if changes == self._certs_changes:
+                    # Otherwise we could have read certificates before
+                    # the change
+                    self._context = context
+            return context
 
     @ssl_context.setter
     def ssl_context(self, context):
         pass
 
+    def handle_accept(self):
+        """Run every connection in a thread with its own loop, like the
+        base class, but end the thread and loop if the SSL handshake fails.
+
+        The base class only stops the loop when a made connection is lost.
+        A client whose certificate isn't accepted (e.g. removed) never
+        makes one, and ZEO clients keep retrying, so every attempt left a
+        thread, a loop and its sockets behind until the server ran out of
+        selectable file descriptors. The base class has no hook for this.
+        """
+        if not hasattr(asyncio.BaseEventLoop, 'connect_accepted_socket'):
+            return super(Acceptor, self).handle_accept()
+
+        try:
+            sock, addr = self.accept()
+        except socket.error as msg:
+            logging.info("accepted failed: %s", msg)
+            return
+
+        def run():
+            loop = asyncio.new_event_loop()
+            zs = self.storage_server.create_client_handler()
+            protocol = ZEO.asyncio.server.ServerProtocol(loop, self.addr, zs)
+            protocol.stop = loop.stop
+
+            def connected(future):
+                if future.cancelled() or future.exception() is not None:
+                    loop.stop()
+
+            connecting = asyncio.ensure_future(
+                loop.connect_accepted_socket(
+                    (lambda: protocol), sock, ssl=self.ssl_context),
+                loop=loop)
+            connecting.add_done_callback(connected)
+            loop.run_forever()
+            loop.close()
+
+        thread = threading.Thread(target=run, name='zeo_client_hander')
+        thread.setDaemon(True)
+        thread.start()
+
 class ZEOStorage(ZEO.StorageServer.ZEOStorage):
 
     user_id = None
@@ -46,33 +160,98 @@ class ZEOStorage(ZEO.StorageServer.ZEOStorage):
         der = self.connection.transport.get_extra_info(
             'ssl_object').getpeercert(1)
 
-        with ZODB.DB(self.storage).transaction() as conn:
-            admin = get_admin(conn)
-            self.user_id = admin.uids[der]
-            if self.user_id is None:
-                # Nobody cert.
-                if not credentials:
-                    raise ZEO.Exceptions.AuthError()
-
-            if credentials:
-                user = admin.users_by_name[credentials['name']]
-                if ((user.id != self.user_id and self.user_id is not None) or
-                    not user.check_password(credentials['password'])
-                    ):
-                    raise ZEO.Exceptions.AuthError()
-                self.user_id = user.id
+        self.user_id = self.server.acceptor.logins.authenticate(
+            der, credentials)
 
-        self.storage = OwnerStorage(self.storage, self.user_id)
+        self.storage = OwnerStorage(self.storage, self.user_id,
+                                    self.server.owners[storage_id])
+        self.server.register_user(storage_id, self)
 
     def setup_delegation(self):
         super(ZEOStorage, self).setup_delegation()
         self.connection.methods = self.registered_methods
 
+    # Per-user limits, see zerodb.permissions.limits
+
+    _limited = False  # Counted in limits of concurrent transactions
+
+    def loadBefore(self, oid, tid):
+        limits = self.server.limits
+        if limits is not None:
+            limits.throttle_load(self.user_id)
+        return super(ZEOStorage, self).loadBefore(oid, tid)
+
+    def tpc_begin(self, id, *args, **kw):
+        limits = self.server.limits
+        if limits is None or self.transaction is not None:
+            return super(ZEOStorage, self).tpc_begin(id, *args, **kw)
+
+        limits.begin(self.user_id)
+        self._limited = True
+        try:
+            return super(ZEOStorage, self).tpc_begin(id, *args, **kw)
+        except Exception:
+            self._limited = False
+            limits.end(self.user_id)
+            raise
+
+    def vote(self, tid):
+        limits = self.server.limits
+        if limits is not None:
+            # Records of the transaction are about as big as its log
+            limits.check_quota(self.user_id, self.txnlog.size())
+        return super(ZEOStorage, self).vote(tid)
+
+    def tpc_finish(self, id):
+        limits = self.server.limits
+        # The commit lock is held, so only this transaction grows the storage
+        size = self.storage.getSize()
+        result = super(ZEOStorage, self).tpc_finish(id)
+        if limits is not None and result is not None:
+            limits.add_usage(self.user_id, self.storage.getSize() - size)
+        return result
+
+    def _clear_transaction(self):
+        super(ZEOStorage, self)._clear_transaction()
+        if self._limited:
+            self._limited = False
+            self.server.limits.end(self.user_id)
+
     def get_root_id(self):
         return self.user_id
 
 class StorageServer(ZEO.StorageServer.StorageServer):
 
+    def __init__(self, *args, **kw):
+        # zerodb.permissions.limits.Limits of users (None for no limits)
+        self.limits = kw.pop('limits', None)
+        super(StorageServer, self).__init__(*args, **kw)
+        # The acceptor doesn't accept connections before the loop starts,
+        # so nobody uses the default lock managers yet
+        self.lock_managers = dict(
+            (storage_id, FairLockManager(storage_id, lm.stats, lm.timeout))
+            for storage_id, lm in self.lock_managers.items())
+        self.owners = dict((storage_id, OwnerCache())
+                           for storage_id in self.storages)
+        # Users only get invalidations of their own commits, so we keep
+        # connections by user: {storage_id -> {user_id -> [ZEOStorage]}}
+        self.zeo_storages_by_user = dict(
+            (storage_id, {}) for storage_id in self.storages)
+
+    def register_user(self, storage_id, zeo_storage):
+        """ Internal: add an authenticated ZEOStorage to its user's group. """
+        by_user = self.zeo_storages_by_user[storage_id]
+        by_user.setdefault(zeo_storage.user_id, []).append(zeo_storage)
+
+    def close_conn(self, zeo_storage):
+        super(StorageServer, self).close_conn(zeo_storage)
+        for by_user in self.zeo_storages_by_user.values():
+            zeo_storages = by_user.get(zeo_storage.user_id)
+            if zeo_storages and zeo_storage in zeo_storages:
+                zeo_storages.remove(zeo_storage)
+                if not zeo_storages:
+                    del by_user[zeo_storage.user_id]
+
     def invalidate(self, conn, storage_id, tid, invalidated=(), info=None):
         """ Internal: broadcast info and invalidations to clients. """
 
@@ -83,22 +262,33 @@ class StorageServer(ZEO.StorageServer.StorageServer):
                 invq.pop()
             invq.insert(0, (tid, invalidated))
 
-        for zs in self.zeo_storages_by_storage_id[storage_id]:
-            if conn and zs.user_id == conn.user_id:
-                connection = zs.connection
-                if invalidated and zs is not conn:
-                    # zs.client.invalidateTransaction(tid, invalidated)
-                    connection.call_soon_threadsafe(
-                        connection.async,
-                        'invalidateTransaction', tid, invalidated)
-                elif info is not None:
-                    # zs.client.info(info)
-                    connection.call_soon_threadsafe(
-                        connection.async, 'info', info)
+            if conn is not None and conn.user_id is not None:
+                self.owners[storage_id].update(invalidated, conn.user_id)
+            else:
+                self.owners[storage_id].invalidate(invalidated)
+
+        if conn is not None:
+            zeo_storages = self.zeo_storages_by_user[storage_id].get(
+                conn.user_id, ())
+        else:
+            zeo_storages = ()
+
+        for zs in list(zeo_storages):
+            connection = zs.connection
+            if invalidated and zs is not conn:
+                # zs.client.invalidateTransaction(tid, invalidated)
+                connection.call_soon_threadsafe(
+                    connection.async,
+                    'invalidateTransaction', tid, invalidated)
+            elif info is not None:
+                # zs.client.info(info)
+                connection.call_soon_threadsafe(
+                    connection.async, 'info', info)
 
         # Update the cert storage db:
-        if storage_id == self.acceptor.cert_storage_id:
-            self.acceptor.invalidate(tid, invalidated)
+        acceptor = getattr(self, 'acceptor', None)
+        if acceptor is not None and storage_id == acceptor.cert_storage_id:
+            acceptor.invalidate(tid, invalidated)
 
     def create_client_handler(self):
         return ZEOStorage(self, self.read_only)
@@ -114,6 +304,10 @@ class ZeroDBOptions(ZEO.runzeo.ZEOOptions):
 
 
 class ZEOServer(ZEO.runzeo.ZEOServer):
+
+    # zerodb.permissions.limits.Limits of users (None for no limits)
+    limits = None
+
     def create_server(self):
         storages = self.storages
         options = self.options
@@ -126,6 +320,7 @@ class ZEOServer(ZEO.runzeo.ZEOServer):
             invalidation_age=options.invalidation_age,
             transaction_timeout=options.transaction_timeout,
             Acceptor=Acceptor,
+            limits=self.limits,
             )
 
         # See evil evil mock hack above :(
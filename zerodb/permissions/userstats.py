@@ -1,32 +1,270 @@
+"""Per-user storage accounting of a file storage
+
+Every transaction is written by one user, whose id is the last 8 bytes of
+each of its records. We count transaction sizes (with all the history) and
+numbers of objects created by every user.
+
+Only transaction and data record headers are read, not the data. A
+checkpoint with the position reached and the totals so far can be kept,
+so that the next run only reads new transactions. A full scan can be
+split between worker processes by byte offsets: every worker finds the
+first transaction at or after its offsets itself.
+"""
 import argparse
-import collections
+import binascii
+import json
+import multiprocessing
+import os
 import pprint
-import ZODB
-import ZODB.FileStorage
+import re
+
+from ZODB.FileStorage.format import FileStorageFormatter, TRANS_HDR_LEN
+from ZODB.FileStorage.format import CorruptedDataError
+from ZODB.utils import u64
 
 from zerodb.permissions.base import get_admin
 
 parser = argparse.ArgumentParser()
 parser.add_argument('path', help="Path to a file-storage file")
+parser.add_argument('--checkpoint',
+                    help="Keep totals in this file and only read "
+                         "transactions added since the last run")
+parser.add_argument('--workers', type=int, default=1,
+                    help="Number of processes reading the file")
+
+# Lengths of transactions (which follow them) start with zero bytes
+_tlen_re = re.compile(b'(?=\x00\x00\x00)')
+resync_chunk_size = 2 ** 16
+# Transactions checked after a guessed transaction boundary
+resync_walk = 4
+
+
+class Scanner(FileStorageFormatter):
+    """Reads headers of transactions in a file storage file"""
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._file.seek(0, 2)
+        self.size = self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+    def transactions(self, pos=4, end=None):
+        """Iterate (pos, header) of complete transactions from pos to end"""
+        end = self.size if end is None else end
+        while pos + TRANS_HDR_LEN <= end:
+            h = self._read_txn_header(pos)
+            if h.status == 'c' or pos + h.tlen + 8 > self.size:
+                # Commit in progress
+                break
+            yield pos, h
+            pos += h.tlen + 8
+
+    def tid_before(self, pos):
+        """Id of the transaction ending at pos, None if there's none"""
+        if pos <= 4 or pos > self.size:
+            return None
+        tlen = self._read_num(pos - 8)
+        if tlen < TRANS_HDR_LEN or tlen + 8 > pos - 4:
+            return None
+        try:
+            h = self._read_txn_header(pos - 8 - tlen)
+        except (CorruptedDataError, UnicodeDecodeError):
+            return None
+        if h.tlen != tlen or h.status not in ' pu':
+            return None
+        return h.tid
+
+    def _owner(self, h, pos):
+        while not h.plen:
+            if not h.back:
+                # Undone creation
+                return None
+            pos = h.back
+            h = self._read_data_header(pos)
+        self._file.seek(pos + h.recordlen() - 8)
+        return self._file.read(8)
+
+    def scan(self, pos=4, end=None, totals=None):
+        """Add bytes and created objects of transactions to totals
+
+        :param dict totals: {uid -> [bytes, objects]}
+        :returns: (totals, last tid, position after the last transaction)
+        """
+        if totals is None:
+            totals = {}
+        tid = None
+        for tpos, th in self.transactions(pos, end):
+            tend = tpos + th.tlen
+            owner = None
+            created = 0
+            pos = tpos + th.headerlen()
+            while pos < tend:
+                h = self._read_data_header(pos)
+                if owner is None:
+                    owner = self._owner(h, pos)
+                if not h.prev:
+                    created += 1
+                pos += h.recordlen()
+            if owner is not None:
+                total = totals.setdefault(owner, [0, 0])
+                total[0] += th.tlen + 8
+                total[1] += created
+            tid = th.tid
+            pos = tend + 8
+        return totals, tid, pos
+
+    def _is_boundary(self, pos):
+        """Whether a transaction ends (and the next one starts) at pos
+
+        Records are written by users, so bytes which look like a boundary
+        are only taken for one if resync_walk transactions after it (or all
+        up to the end of the file) have matching lengths and growing tids
+        """
+        tid = self.tid_before(pos)
+        if tid is None:
+            return False
+        for i in range(resync_walk):
+            if pos + TRANS_HDR_LEN > self.size:
+                return True
+            try:
+                h = self._read_txn_header(pos)
+            except (CorruptedDataError, UnicodeDecodeError):
+                return False
+            if h.tid <= tid or h.tlen < TRANS_HDR_LEN or \
+                    h.status not in ' puc':
+                return False
+            if h.status == 'c' or pos + h.tlen + 8 > self.size:
+                return True
+            if self._read_num(pos + h.tlen) != h.tlen:
+                return False
+            tid, pos = h.tid, pos + h.tlen + 8
+        return True
+
+    def resync(self, pos):
+        """Position of the first transaction at or after pos"""
+        if pos <= 4:
+            return 4
+        # The first transaction is at 4, the next ones are well after 8
+        pos = max(pos, 8)
+        while pos < self.size:
+            self._file.seek(pos - 8)
+            data = self._file.read(resync_chunk_size + 8)
+            for m in _tlen_re.finditer(data, 0, resync_chunk_size):
+                if self._is_boundary(pos + m.start()):
+                    return pos + m.start()
+            pos += resync_chunk_size
+        return self.size
+
+    def split(self, pos, parts):
+        """Byte offsets splitting the file from pos in parts"""
+        step = max((self.size - pos) // parts, 1)
+        bounds = [pos + i * step for i in range(parts)
+                  if pos + i * step < self.size]
+        return bounds + [self.size]
+
+
+def _scan(args):
+    path, pos, end, trusted = args
+    scanner = Scanner(path)
+    try:
+        if not trusted:
+            pos = scanner.resync(pos)
+        end = scanner.resync(end)
+        try:
+            # Transactions starting in [pos, end)
+            return (pos, end) + scanner.scan(pos, end)
+        except Exception:
+            if trusted:
+                raise
+            # Not a transaction after all, the part is read again
+            return (None, end, {}, None, pos)
+    finally:
+        scanner.close()
+
+
+def load_checkpoint(path):
+    with open(path) as f:
+        data = json.load(f)
+    return (data['pos'], binascii.unhexlify(data['tid']),
+            dict((binascii.unhexlify(uid), total)
+                 for uid, total in data['users'].items()))
+
+
+def save_checkpoint(path, pos, tid, totals):
+    data = dict(pos=pos, tid=binascii.hexlify(tid).decode(),
+                users=dict((binascii.hexlify(uid).decode(), total)
+                           for uid, total in totals.items()))
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.rename(path + '.tmp', path)
+
+
+def scan(path, checkpoint=None, workers=1):
+    """Totals of users in a file storage: {uid -> [bytes, objects]}
+
+    :param str checkpoint: File to resume from and save to
+    :param int workers: Number of processes reading the file
+    """
+    scanner = Scanner(path)
+    try:
+        pos, tid, totals = 4, None, {}
+        if checkpoint and os.path.exists(checkpoint):
+            pos, tid, totals = load_checkpoint(checkpoint)
+            if scanner.tid_before(pos) != tid:
+                # The file was packed or replaced, start over
+                pos, tid, totals = 4, None, {}
+
+        if workers > 1:
+            bounds = scanner.split(pos, workers)
+        else:
+            bounds = [pos, scanner.size]
+    finally:
+        scanner.close()
+
+    ranges = [(path, bounds[i], bounds[i + 1], i == 0)
+              for i in range(len(bounds) - 1)]
+    if len(ranges) > 1:
+        pool = multiprocessing.Pool(len(ranges))
+        try:
+            results = pool.map(_scan, ranges)
+        finally:
+            pool.close()
+    else:
+        results = [_scan(ranges[0])]
+
+    for start, end, part, part_tid, part_pos in results:
+        if start != pos:
+            # The previous part didn't end where this one was found to
+            # start: only trust a chain of transactions from the start
+            # of the scan, and read this part again from where it ended
+            part, part_tid, part_pos = _scan((path, pos, end, True))[2:]
+        for uid, (nbytes, objects) in part.items():
+            total = totals.setdefault(uid, [0, 0])
+            total[0] += nbytes
+            total[1] += objects
+        if part_tid is not None:
+            tid, pos = part_tid, part_pos
+
+    if checkpoint and tid is not None:
+        save_checkpoint(checkpoint, pos, tid, totals)
+
+    return totals
+
+
+def userstats(path, checkpoint=None, workers=1, conn=None):
+    """List of (uid, name, bytes, objects) of users in a file storage
+
+    :param conn: Admin's connection to the database, to get user names
+        from (names are None without it)
+    """
+    totals = scan(path, checkpoint, workers)
+    users = get_admin(conn).users if conn is not None else {}
+    return [(uid, users[uid].name if uid in users else None, nbytes, objects)
+            for (uid, (nbytes, objects)) in totals.items()]
 
-def userstats(path):
-    result = collections.defaultdict(int)
-    for transaction in ZODB.FileStorage.FileIterator(path):
-        for record in transaction:
-            if record.data:
-                result[record.data[-8:]] += (
-                    transaction._tend - transaction._tpos + 8)
-                break # We only needed one record to get the user.
-
-    storage = ZODB.FileStorage.FileStorage(path, read_only=True)
-    db = ZODB.DB(storage)
-    with db.transaction() as conn:
-        admin = get_admin(conn)
-        result = [(uid, admin.users[uid].name, total)
-                  for (uid, total) in result.items()
-                  ]
-
-    return result
 
 def main():
-    pprint(userstats(parser.parse_args().path))
+    args = parser.parse_args()
+    pprint.pprint(userstats(args.path, args.checkpoint, args.workers))
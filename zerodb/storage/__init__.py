@@ -1,12 +1,22 @@
 import six
 
+import ZEO.asyncio.client
 import ZEO.ClientStorage
 from itertools import chain
 from persistent import Persistent
 
+from zerodb.permissions.exceptions import QuotaExceeded, TooManyTransactions
 from . import transforming
 import logging
 
+# Raise errors of the server's per-user limits as they are, rather than as
+# ZEO.Exceptions.ServerException
+for exc_class in (QuotaExceeded, TooManyTransactions):
+    exc_name = 'zerodb.permissions.exceptions.' + exc_class.__name__
+    ZEO.asyncio.client.exc_classes[exc_name] = exc_class
+    ZEO.asyncio.client.exc_factories[exc_name] = \
+        ZEO.asyncio.client.create_Exception
+
 # TODO when it comes to the point we need to,
 # we'll have to configure which classes to use
 # with Zope interfaces
@@ -98,6 +108,36 @@ def btree_state_search(state, key):
     return i, state[i * 2]
 
 
+def estimate_length(tree):
+    """
+    Estimate number of elements in a BTree or TreeSet looking only at its
+    root node (buckets are not fetched)
+    """
+    state = tree.__getstate__()
+    if not state:
+        return 0
+
+    state = state[0]
+    if len(state) == 1 and isinstance(state[0], tuple):
+        # The only bucket is inlined in the tree state
+        items = state[0][0]
+        if hasattr(tree, "values"):
+            return len(items) // 2
+        else:
+            return len(items)
+
+    tree_type = type(tree)
+    # Buckets are usually somewhere between half-full and full
+    leaf_size = 2 * (getattr(tree_type, "max_leaf_size", None) or 120) // 3
+    n_children = (len(state) + 1) // 2
+    if isinstance(state[0], tree_type):
+        # Deep tree: assume one more level of internal nodes
+        internal_size = getattr(tree_type, "max_internal_size", None) or 500
+        return n_children * (2 * internal_size // 3) * leaf_size
+    else:
+        return n_children * leaf_size
+
+
 def parallel_traversal(trees, keys):
     """
     Traverse trees in parallel to fill up cache
@@ -0,0 +1,159 @@
+"""
+Client cache which lets forked processes reuse the persistent cache file of
+the parent process.
+
+ZEO's ClientCache with a path already keeps records on disk exactly as they
+come from the server (that is, still encrypted) and is validated against the
+last tid when the client connects. But the file is locked by the process
+which opened it, so forked workers can't open it again.
+"""
+import os
+import threading
+from struct import unpack
+
+from ZEO.cache import ClientCache, ZEC_HEADER_SIZE, magic
+from ZODB.utils import z64
+
+# status, size, oid, start_tid, end_tid, lver, ldata
+_header = ">cI8s8s8sHI"
+_header_size = 35
+
+
+class _Current(object):
+    """
+    Makes `oid in cache.current` work like for ZEO's ClientCache
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __contains__(self, oid):
+        return oid in self.cache.local.current or oid in self.cache._index
+
+
+class SharedCache(object):
+    """
+    Records of the parent's cache file are used read-only, new records go
+    to a private cache of this process.
+
+    The file is scanned once. As the parent keeps writing to it, every read
+    checks that the record is still where it was, otherwise it's a cache
+    miss. Records invalidated after the file's last tid are dropped when ZEO
+    verifies the cache on connect, as usual.
+    """
+
+    def __init__(self, path, size=200 * 2 ** 20):
+        """
+        :param str path: Cache file of the parent process
+        :param int size: Size of the private cache
+        """
+        self.path = path
+        self.local = ClientCache(None, size)
+        self.current = _Current(self)
+        self._lock = threading.RLock()
+        self._index = {}  # {oid -> (ofs, start_tid)}
+        self.tid = z64
+        self._f = None
+        if os.path.exists(path):
+            # Unbuffered, so that we see what the parent writes
+            self._f = open(path, 'rb', 0)
+            self._scan()
+
+    def _scan(self):
+        f = self._f
+        if f.read(len(magic)) != magic:
+            return
+        tid = f.read(8)
+        fsize = os.path.getsize(self.path)
+        ofs = ZEC_HEADER_SIZE
+        while ofs < fsize:
+            f.seek(ofs)
+            status = f.read(1)
+            if status == b'a':
+                size, oid, start_tid, end_tid = unpack(">I8s8s8s", f.read(28))
+                if end_tid == z64:
+                    self._index[oid] = (ofs, start_tid)
+            elif status == b'f':
+                size, = unpack(">I", f.read(4))
+            elif status and status in b'1234':
+                size = int(status)
+            else:
+                # The parent is writing here right now
+                break
+            if size <= 0:
+                break
+            ofs += size
+        self.tid = tid
+
+    def _read(self, oid, ofs, start_tid):
+        f = self._f
+        f.seek(ofs)
+        header = f.read(_header_size)
+        if len(header) < _header_size:
+            return None
+        status, size, saved_oid, saved_tid, _, lver, ldata = unpack(
+            _header, header)
+        if status != b'a' or saved_oid != oid or saved_tid != start_tid:
+            return None
+        data = f.read(ldata)
+        if len(data) != ldata or f.read(8) != oid:
+            return None
+        # Make sure the record wasn't overwritten while we were reading it
+        f.seek(ofs)
+        if f.read(21) != header[:21]:
+            return None
+        return data
+
+    def loadBefore(self, oid, before_tid):
+        result = self.local.loadBefore(oid, before_tid)
+        if result is not None:
+            return result
+        with self._lock:
+            entry = self._index.get(oid)
+            if entry is None:
+                return None
+            ofs, start_tid = entry
+            if before_tid and start_tid >= before_tid:
+                return None
+            data = self._read(oid, ofs, start_tid)
+            if data is None:
+                del self._index[oid]
+                return None
+            return data, start_tid, None
+
+    def load(self, oid, before_tid=None):
+        result = self.loadBefore(oid, before_tid)
+        if result is not None:
+            return result[:2]
+
+    def store(self, oid, start_tid, end_tid, data):
+        if end_tid is None:
+            with self._lock:
+                self._index.pop(oid, None)
+        self.local.store(oid, start_tid, end_tid, data)
+
+    def invalidate(self, oid, tid):
+        with self._lock:
+            self._index.pop(oid, None)
+        self.local.invalidate(oid, tid)
+
+    def clear(self):
+        with self._lock:
+            self._index.clear()
+        self.local.clear()
+
+    def setLastTid(self, tid):
+        self.local.setLastTid(tid)
+        self.tid = tid
+
+    def getLastTid(self):
+        return self.tid
+
+    def close(self):
+        self.local.close()
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def __len__(self):
+        return len(self.local) + len(self._index)
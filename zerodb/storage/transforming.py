@@ -1,25 +1,81 @@
+from cachetools import LRUCache
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from zc.zlibstorage import ZlibStorage
 from ZODB.utils import maxtid
 import logging
+import os
+import threading
+import time
 import zope.component
 import zope.interface
 from zerodb.transform import encrypt, decrypt, compress, decompress
 from zerodb.transform import get_encryption_signature
-from zerodb.util import encode_hex
+from zerodb.util import encode_hex, explain
 from zerodb.util.debug import debug_loads
 import zerodb.transform.interfaces
 
 _gsm = zope.component.getGlobalSiteManager()
 
+# Prefetched batches smaller than this are untransformed on demand
+# in the calling thread
+parallel_batch_size = 16
+
+# Max total size of records untransformed in advance, but not loaded yet
+prefetched_cache_size = 64 * 2 ** 20
+
+# Max number of prefetched oids we remember
+in_flight_max = 100000
+# Seconds after which prefetched records have surely arrived (so a later
+# load which misses the cache is a round trip of its own)
+in_flight_timeout = 1.0
+
+
+class WorkerPool(object):
+    """
+    Pool of threads to map functions over batches.
+    AES-GCM (libsodium or PyCryptodome) and zlib release the GIL,
+    so untransforming in threads scales with number of cores.
+    The pool is recreated in a forked process
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or cpu_count()
+        self._pool = None
+        self._pid = None
+
+    def map(self, f, items):
+        if self.workers < 2 or len(items) < 2:
+            return list(map(f, items))
+        if self._pool is None or self._pid != os.getpid():
+            self._pool = ThreadPool(self.workers)
+            self._pid = os.getpid()
+        chunksize = max(1, len(items) // (self.workers * 4))
+        return self._pool.map(f, items, chunksize)
+
+    def close(self):
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool.terminate()
+        self._pool = None
+
+
 class TransformingStorage(ZlibStorage):
     """
     Storage which can transform (encrypt and/or compress) data.
     """
+    copied_methods = tuple(
+        m for m in ZlibStorage.copied_methods if m != 'close')
+
+    # Compressor of this storage only (e.g. one with dictionaries of this
+    # database). None means the globally registered ones
+    compressor = None
 
     def __init__(self, base, *args, **kw):
         """
         :param base: Storage to transform
         :param bool debug: Output debug log messages
+        :param int workers: Number of threads to untransform prefetched
+            records with (number of CPUs by default, 1 to disable)
         """
         self.base = base
 
@@ -28,6 +84,17 @@ class TransformingStorage(ZlibStorage):
             self._debug_download_size = 0
             self._debug_download_count = 0
 
+        self._workers = WorkerPool(kw.pop("workers", None))
+        self._prefetched = LRUCache(prefetched_cache_size,
+                                    getsizeof=lambda r: len(r[0]) or 1)
+        self._prefetched_lock = threading.Lock()
+        # Oids being prefetched, not to count their loads as round trips.
+        # Prefetch and loads happen in different threads
+        self._in_flight = {}  # {oid -> time it was prefetched}
+        self._in_flight_lock = threading.Lock()
+        # Round trips and loads of every thread, see counts()
+        self._counts = threading.local()
+
         for name in self.copied_methods:
             v = getattr(base, name, None)
             if v is not None:
@@ -37,9 +104,9 @@ class TransformingStorage(ZlibStorage):
 
         base.registerDB(self)
 
-        self._transform = lambda data: encrypt(compress(data), no_cipher_name=True)
-        self._transform_named = lambda data: encrypt(compress(data), no_cipher_name=False)
-        self._untransform = lambda data: decompress(decrypt(data))
+        self._transform = lambda data: encrypt(self._compress(data), no_cipher_name=True)
+        self._transform_named = lambda data: encrypt(self._compress(data), no_cipher_name=False)
+        self._untransform = lambda data: self._decompress(decrypt(data))
 
         self._root_oid = base.get_root_id()
 
@@ -62,14 +129,46 @@ class TransformingStorage(ZlibStorage):
         :return: Object and its serial number and following serial number
         :rtype: tuple
         """
-        if self.debug:
-            if oid not in self._cache.current:
-                in_cache = False
-            else:
-                in_cache = True
+        profile = explain.current()
+        counts = self._counts
+
+        with self._prefetched_lock:
+            record = self._prefetched.pop((oid, tid), None)
+        counts.loads = getattr(counts, "loads", 0) + 1
+        if record is not None:
+            if profile is not None:
+                profile.loads += 1
+                profile.cache_hits += 1
+            return record
+
+        in_cache = oid in self._cache.current
+        round_trip = False
+        with self._in_flight_lock:
+            # Unless prefetch has already asked for it (once the record is
+            # in the cache, it has arrived)
+            sent = self._in_flight.pop(oid, None)
+        if not in_cache:
+            round_trip = (sent is None or
+                          time.time() - sent >= in_flight_timeout)
+            if round_trip:
+                counts.round_trips = getattr(counts, "round_trips", 0) + 1
 
         data, serial, tend = self.base.loadBefore(oid, tid)
-        out_data = self._untransform(data)
+        if profile is not None:
+            t0 = time.time()
+            out_data = self._untransform(data)
+            profile.decrypt_time += time.time() - t0
+            profile.loads += 1
+            if in_cache:
+                profile.cache_hits += 1
+            else:
+                profile.cache_misses += 1
+                if round_trip:
+                    profile.round_trips += 1
+            profile.encrypted_bytes += len(data)
+            profile.decrypted_bytes += len(out_data)
+        else:
+            out_data = self._untransform(data)
 
         if self.debug and not in_cache:
             logging.debug(
@@ -84,6 +183,91 @@ class TransformingStorage(ZlibStorage):
 
         return out_data, serial, tend
 
+    def prefetch(self, oids, tid):
+        """
+        Bulk-fetch records and untransform them in parallel, so that
+        following loadBefore calls get the data ready
+
+        :param list oids: Object IDs
+        :param str tid: Transaction timestamp to load before
+        """
+        oids = list(oids)
+        profile = explain.current()
+        missing = set(oid for oid in oids if oid not in self._cache.current)
+        if missing:
+            counts = self._counts
+            counts.round_trips = getattr(counts, "round_trips", 0) + 1
+            if profile is not None:
+                profile.round_trips += 1
+            with self._in_flight_lock:
+                if len(self._in_flight) > in_flight_max:
+                    self._in_flight.clear()
+                now = time.time()
+                for oid in missing:
+                    self._in_flight[oid] = now
+        self.base.prefetch(oids, tid)
+        if len(oids) < parallel_batch_size or self._workers.workers < 2:
+            return
+
+        def load(oid):
+            try:
+                record = self.base.loadBefore(oid, tid)
+                if record is None:
+                    return None
+                data, serial, tend = record
+                t0 = time.time()
+                out_data = self._untransform(data)
+                return out_data, serial, tend, len(data), time.time() - t0
+            except Exception:
+                # Whoever loads it for real will get the error
+                return None
+
+        records = self._workers.map(load, oids)
+
+        if profile is not None:
+            for record in records:
+                if record is not None:
+                    profile.encrypted_bytes += record[3]
+                    profile.decrypted_bytes += len(record[0])
+                    profile.decrypt_time += record[4]
+
+        with self._prefetched_lock:
+            for oid, record in zip(oids, records):
+                if record is not None:
+                    self._prefetched[(oid, tid)] = record[:3]
+
+        if self.debug:
+            for oid, record in zip(oids, records):
+                if record is not None and oid in missing:
+                    self._debug_download_size += record[3]
+                    self._debug_download_count += 1
+
+    def counts(self):
+        """
+        Round trips and loads done by the current thread so far (cheap
+        counters which are always on, unlike explain)
+
+        :returns: (round trips, loads)
+        """
+        counts = self._counts
+        return getattr(counts, "round_trips", 0), getattr(counts, "loads", 0)
+
+    def _compress(self, data):
+        if self.compressor is not None:
+            return self.compressor.compress(data)
+        return compress(data)
+
+    def _decompress(self, data):
+        compressor = self.compressor
+        if compressor is not None and \
+                data.startswith(b".c%s$" % compressor.name):
+            return compressor.decompress(data)
+        return decompress(data)
+
+    def close(self):
+        self._workers.close()
+        self.base.close()
+
     def store(self, oid, serial, data, version, transaction):
         if oid == self._root_oid:
             _transform = self._transform_named
@@ -9,11 +9,14 @@ import os
 import pytest
 import shutil
 import tempfile
+from contextlib import contextmanager
 
 import ZEO.tests.testssl    # FIXME Adds zope.testing requirement
 
 import zerodb
+import zerodb.forker
 from zerodb.crypto import kdf
+from zerodb.util import explain
 
 TEST_PASSPHRASE = "v3ry 53cr3t pa$$w0rd"
 
@@ -22,8 +25,12 @@ __all__ = [
     "TEST_PASSPHRASE",
     "tempdir",
     "do_zeo_server",
+    "do_slow_proxy",
     "zeo_server",
+    "wan_server",
+    "do_db",
     "db",
+    "max_roundtrips",
 ]
 
 
@@ -50,8 +57,27 @@ def zeo_server(request, tempdir):
     return sock
 
 
+def do_slow_proxy(request, sock, latency=0.05, bandwidth=None):
+    """
+    Address of a proxy to sock which adds latency (each way) and limits
+    bandwidth (bytes per second)
+    """
+    addr, stop = zerodb.forker.start_proxy(
+            sock, latency=latency, bandwidth=bandwidth)
+    request.addfinalizer(stop)
+    return addr
+
+
 @pytest.fixture(scope="module")
-def db(request, zeo_server, dbclass=zerodb.DB):
+def wan_server(request, zeo_server):
+    """
+    zeo_server behind a 50 ms (each way), 1 MB/s link
+    """
+    return do_slow_proxy(request, zeo_server, latency=0.05,
+                         bandwidth=2 ** 20)
+
+
+def do_db(request, zeo_server, dbclass=zerodb.DB):
     zdb = dbclass(zeo_server,
                   username='root', password=TEST_PASSPHRASE,
                   security=kdf.key_from_password,
@@ -66,6 +92,11 @@ def db(request, zeo_server, dbclass=zerodb.DB):
     return zdb
 
 
+@pytest.fixture(scope="module")
+def db(request, zeo_server):
+    return do_db(request, zeo_server)
+
+
 @pytest.fixture(scope="module")
 def admin_db(request, zeo_server):
     h, _ = kdf.hash_password(
@@ -77,3 +108,24 @@ def admin_db(request, zeo_server):
                 server_cert=ZEO.tests.testssl.server_cert),
             credentials=dict(name='root', password=h),
             wait_timeout=11)
+
+
+@contextmanager
+def max_roundtrips(n):
+    """
+    Fail if code inside makes more than n round trips to the server:
+    loads of records which are not in the client cache (and were not
+    prefetched) and prefetch batches. Yields zerodb.util.explain.Section
+    with the details
+    """
+    if explain.current() is None:
+        recording = explain.explain("max_roundtrips")
+    else:
+        recording = explain.section("max_roundtrips")
+    with recording as profile:
+        yield profile
+    round_trips = profile.total("round_trips")
+    if round_trips > n:
+        raise AssertionError(
+            "%s round trips, expected at most %s\n%s" % (
+                round_trips, n, profile.report()))
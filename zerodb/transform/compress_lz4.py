@@ -0,0 +1,10 @@
+from .compress_common import CommonCompressor
+
+try:
+    import lz4.block
+    lz4_compressor = CommonCompressor(
+        name=b"lz4", compress=lz4.block.compress,
+        decompress=lz4.block.decompress)
+
+except ImportError:
+    lz4_compressor = None
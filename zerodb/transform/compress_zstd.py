@@ -0,0 +1,106 @@
+import threading
+
+from .compress_common import CommonCompressor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def record_class(data):
+    """
+    Class name ("module.name") of a pickled ZODB record, None if we can't
+    tell without unpickling
+    """
+    # Protocol header, then GLOBAL opcode: c<module>\n<name>\n
+    start = 2 if data.startswith(b"\x80") else 0
+    if data[start:start + 1] != b"c":
+        return None
+    end = data.find(b"\n", start)
+    end = data.find(b"\n", end + 1)
+    if end < 0:
+        return None
+    return data[start + 1:end].replace(b"\n", b".").decode("ascii", "replace")
+
+
+class ZstdCompressor(CommonCompressor):
+    """
+    zstd compression which uses dictionaries trained per class of records.
+    Small pickles of the same class share most of their bytes, so they
+    compress much better with a dictionary than on their own.
+    Frames record id of the dictionary they were compressed with
+    """
+
+    # Called (without arguments) to add dictionaries which aren't known yet,
+    # e.g. ones trained by another client after we connected
+    reload_dictionaries = None
+
+    def __init__(self, level=3):
+        super(ZstdCompressor, self).__init__(
+            name=b"zstd", compress=self._compress_record,
+            decompress=self._decompress_record)
+        self.level = level
+        self.dicts = {}  # {class name -> ZstdCompressionDict}
+        self._dicts_by_id = {}  # {dict_id -> ZstdCompressionDict}
+        # (De)compressor objects aren't thread-safe
+        self._local = threading.local()
+
+    def copy(self):
+        """
+        Compressor with the same settings and its own set of dictionaries
+        """
+        return type(self)(level=self.level)
+
+    def add_dictionary(self, class_name, data):
+        """
+        Use dictionary data (bytes) for records of class class_name
+        """
+        d = zstandard.ZstdCompressionDict(data)
+        self.dicts[class_name] = d
+        self._dicts_by_id[d.dict_id()] = d
+
+    def train(self, samples, size=16384):
+        """
+        Train a dictionary on sample records (which are of the same class)
+
+        :returns: Dictionary data to store and pass to add_dictionary
+        """
+        return zstandard.train_dictionary(size, samples).as_bytes()
+
+    def _get(self, kind, d):
+        cache = getattr(self._local, kind, None)
+        if cache is None:
+            cache = {}
+            setattr(self._local, kind, cache)
+        key = d.dict_id() if d is not None else 0
+        if key not in cache:
+            kw = {"dict_data": d} if d is not None else {}
+            if kind == "compressors":
+                cache[key] = zstandard.ZstdCompressor(level=self.level, **kw)
+            else:
+                cache[key] = zstandard.ZstdDecompressor(**kw)
+        return cache[key]
+
+    def _compress_record(self, data):
+        d = self.dicts.get(record_class(data))
+        return self._get("compressors", d).compress(data)
+
+    def _decompress_record(self, data):
+        dict_id = zstandard.get_frame_parameters(data).dict_id
+        d = None
+        if dict_id:
+            d = self._dicts_by_id.get(dict_id)
+            if d is None and self.reload_dictionaries is not None:
+                self.reload_dictionaries()
+                d = self._dicts_by_id.get(dict_id)
+            if d is None:
+                raise LookupError(
+                    "Compression dictionary %s is not loaded" % dict_id)
+        return self._get("decompressors", d).decompress(data)
+
+
+if zstandard is not None:
+    zstd_compressor = ZstdCompressor()
+else:
+    zstd_compressor = None
@@ -0,0 +1,146 @@
+"""
+Attributing storage work (round trips, loaded records, decryption) to
+query operators, indexes and loading of objects.
+
+    with explain() as profile:
+        db[Model].query(Gt("x", 1) & Eq("y", 2), limit=10)
+    print(profile.report())
+
+Work is recorded in the innermost section which is active in the current
+thread. Results are lazy, so whatever is read while iterating over them
+outside of the block is not counted.
+"""
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+_local = threading.local()
+
+counters = ("round_trips", "loads", "cache_hits", "cache_misses",
+            "encrypted_bytes", "decrypted_bytes", "decrypt_time")
+
+
+class Section(object):
+    """
+    Counters of one part of the query. Repeated sections with the same
+    name under one parent are merged
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.children = []
+        self.calls = 0
+        self.time = 0.0
+        for counter in counters:
+            setattr(self, counter, 0)
+
+    def child(self, name):
+        for section in self.children:
+            if section.name == name:
+                return section
+        section = Section(name)
+        self.children.append(section)
+        return section
+
+    def total(self, counter):
+        """
+        Value of a counter including children
+        """
+        return getattr(self, counter) + sum(
+            c.total(counter) for c in self.children)
+
+    def totals(self):
+        return {counter: self.total(counter) for counter in counters}
+
+    def report(self, level=0):
+        """
+        Human-readable table of sections (counters include children)
+        """
+        lines = []
+        if level == 0:
+            lines.append("%-40s %9s %5s %6s %6s %6s %10s %10s %10s" % (
+                "", "ms", "rt", "loads", "hits", "misses",
+                "encrypted", "decrypted", "decrypt ms"))
+        t = self.totals()
+        lines.append("%-40s %9.2f %5d %6d %6d %6d %10d %10d %10.2f" % (
+            ("  " * level + self.name)[:40], self.time * 1000,
+            t["round_trips"], t["loads"], t["cache_hits"], t["cache_misses"],
+            t["encrypted_bytes"], t["decrypted_bytes"],
+            t["decrypt_time"] * 1000))
+        for child in self.children:
+            lines.append(child.report(level + 1))
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return "<Section %s %r>" % (self.name, self.totals())
+
+
+def current():
+    """
+    Innermost active section of this thread, or None if not explaining
+    """
+    stack = getattr(_local, "stack", None)
+    if stack:
+        return stack[-1]
+
+
+@contextmanager
+def explain(name="query"):
+    """
+    Profile everything done in this thread inside the block
+    """
+    root = Section(name)
+    saved = getattr(_local, "stack", None)
+    _local.stack = [root]
+    t0 = time.time()
+    try:
+        yield root
+    finally:
+        root.time += time.time() - t0
+        root.calls += 1
+        _local.stack = saved
+
+
+@contextmanager
+def section(name):
+    """
+    Record work inside the block in a subsection (if explaining)
+    """
+    parent = current()
+    if parent is None:
+        yield None
+        return
+    child = parent.child(name)
+    _local.stack.append(child)
+    t0 = time.time()
+    try:
+        yield child
+    finally:
+        child.time += time.time() - t0
+        child.calls += 1
+        _local.stack.pop()
+
+
+def describe(query):
+    if hasattr(query, "index_name"):
+        return str(query)
+    return type(query).__name__
+
+
+def profiled(f):
+    """
+    Make a section out of every call of query's _apply
+    """
+    if getattr(f, "_profiled", False):
+        return f
+
+    @functools.wraps(f)
+    def wrapper(self, *args, **kw):
+        if current() is None:
+            return f(self, *args, **kw)
+        with section(describe(self)):
+            return f(self, *args, **kw)
+
+    wrapper._profiled = True
+    return wrapper
@@ -1,21 +1,40 @@
+import heapq
 import six
 from persistent import Persistent
-from itertools import islice, count
+from itertools import chain, islice, count
 from six.moves import zip as izip, map as imap
 from cachetools import LRUCache
 from zerodb.storage import prefetch
 
 
+def merge_unique(*iterables):
+    """
+    Lazily merge sorted iterables into one sorted iterable without duplicates
+    """
+    last = None
+    for item in heapq.merge(*iterables):
+        if item != last:
+            yield item
+            last = item
+
+
 class Sliceable(object):
-    def __init__(self, f, cache_size=1000, length=None):
+    def __init__(self, f, cache_size=1000, length=None, ordered=False,
+                 container=None):
         """
         Makes a sliceable, cached list-like interface to an iterator
         :param callable f: Function which inits the iterator
+        :param bool ordered: Whether iterator yields values in increasing order
+            (so that it can be lazily merged with others)
+        :param container: Set-like object with the same values (e.g. TreeSet
+            we iterate over), to check membership without iterating
         """
         self.f = f
         self.cache = LRUCache(cache_size)
         self.stop = 0
         self.length = length
+        self.ordered = ordered
+        self.container = container
         self.iterator = iter(f())
 
     def __iter__(self):
@@ -148,6 +167,30 @@ class DBList(Sliceable):
         super(DBList, self).__init__(f, **kw)
 
 
+class ProjectionList(Sliceable):
+    batch_size = 100
+
+    def __init__(self, query_f, project, **kw):
+        """
+        :param function query_f: Function which returns results of the query in format (size, uids)
+        :param function project: Function which turns a list of uids into a list of rows
+        """
+        def f():
+            self.length, uids = query_f()
+            uids = iter(uids)
+
+            def batches():
+                while True:
+                    batch = list(islice(uids, self.batch_size))
+                    if not batch:
+                        return
+                    yield project(batch)
+
+            return chain.from_iterable(batches())
+
+        super(ProjectionList, self).__init__(f, **kw)
+
+
 class ListPrefetch(Sliceable):
     prefetch_size = 20
 
@@ -0,0 +1,130 @@
+"""
+Statistics of queries: latency histograms and round trips per model and
+query shape, and a log of slow queries. Always on unless turned off with
+DB(..., query_stats=False): it costs a few counters per query and load.
+
+Results of queries without limit are lazy, so only the work done before
+iterating over them is measured.
+
+Query shape is the query tree with values thrown away, e.g.
+And(Eq(name), InRange(salary)) sort=salary limit. Queries which differ only
+in values are counted together.
+"""
+import json
+import logging
+import threading
+
+logger = logging.getLogger("zerodb.slow_query")
+
+# Upper bounds of histogram buckets, in seconds: 1 ms to ~65 s
+bucket_bounds = tuple(0.001 * 2 ** i for i in range(17))
+
+
+def query_shape(query, sort_index=None, limit=None):
+    """
+    Query tree without values
+    """
+    children = list(query.iter_children())
+    if hasattr(query, "index_name"):
+        shape = "%s(%s)" % (type(query).__name__, query.index_name)
+    elif len(children) == 1 and hasattr(query, "queries"):
+        # And or Or of one query (e.g. of one keyword argument)
+        shape = query_shape(children[0])
+    else:
+        shape = "%s(%s)" % (type(query).__name__, ", ".join(
+            sorted(query_shape(q) for q in children)))
+    if sort_index:
+        shape += " sort=%s" % sort_index
+    if limit:
+        shape += " limit"
+    return shape
+
+
+class Histogram(object):
+    """
+    Counts of values in exponentially growing buckets
+    """
+
+    def __init__(self, bounds=bucket_bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        i = 0
+        for bound in self.bounds:
+            if value <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket where p percent of values are
+        """
+        if not self.count:
+            return None
+        need = self.count * p / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= need and count:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+
+class QueryStats(object):
+    """
+    Statistics of queries of one DB, safe to use from many threads
+    """
+
+    def __init__(self, slow_threshold=1.0):
+        """
+        :param float slow_threshold: Queries slower than this many seconds
+            are logged to "zerodb.slow_query" logger (None not to log)
+        """
+        self.slow_threshold = slow_threshold
+        self._lock = threading.Lock()
+        self._stats = {}  # {(model, shape) -> [Histogram, round trips]}
+
+    def record(self, model, shape, seconds, round_trips=0, loads=0):
+        with self._lock:
+            entry = self._stats.get((model, shape))
+            if entry is None:
+                entry = self._stats[(model, shape)] = [Histogram(), 0]
+            entry[0].add(seconds)
+            entry[1] += round_trips
+
+        if self.slow_threshold is not None and seconds >= self.slow_threshold:
+            logger.warning(json.dumps({
+                "model": model, "shape": shape,
+                "seconds": round(seconds, 6),
+                "round_trips": round_trips, "loads": loads},
+                sort_keys=True))
+
+    def snapshot(self):
+        """
+        List of dicts with stats per model and shape, most time first
+        """
+        with self._lock:
+            items = [(key, entry[0], entry[1])
+                     for key, entry in self._stats.items()]
+        result = []
+        for (model, shape), hist, round_trips in items:
+            result.append({
+                "model": model, "shape": shape, "count": hist.count,
+                "seconds": hist.total, "max": hist.max,
+                "p50": hist.percentile(50), "p90": hist.percentile(90),
+                "p99": hist.percentile(99),
+                "round_trips": round_trips})
+        result.sort(key=lambda s: s["seconds"], reverse=True)
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()